@@ -10,6 +10,8 @@ import serial
 import os
 import popen2
 import signal
+
+from trm.drivers.lakeshore import Lakeshore, BinaryLogWriter
   
 
 def AsciiPrint( var, hdr="" ):
@@ -18,54 +20,6 @@ def AsciiPrint( var, hdr="" ):
     print "[",ord(a),"]",
   print ""
 
-# Lakshore device serial interface
-class lake:
-    def __init__(self, port='/dev/ttyS0'):
-        self.com = serial.Serial(port, 9600, serial.SEVENBITS,
-                                 serial.PARITY_ODD, serial.STOPBITS_ONE,
-                                 2, 0, 0)
-#        print self.com
-        if not self.com.isOpen():
-            self.com.open()
-        self.com.flushInput()
-        self.com.flushOutput()
-        #self.com.close()
-
-    def shutDown(self):
-      if self.com.isOpen():
-        self.com.close()
-
-    def cmd(self, cmd):
-#        print 'lake> command <%s>'%(cmd)
-        tmp = cmd + '\r\n'
-        if not self.com.isOpen():
-            self.com.open()
-        self.com.flushInput()
-        self.com.flushOutput()
-        #print "Command:",tmp
-        #AsciiPrint(tmp, "Command: ")
-        self.com.write(tmp)
-        # Test
-#        time.sleep(1)
-#        n = self.com.inWaiting()
-#        print 'lake> got ' + repr(n) + ' bytes'
-#        rep = self.com.read(n)
-        #
-        rep = self.com.readline()
-        #print "Reply:",rep
-        rep = re.sub('\r', '', rep)
-        rep = re.sub('\n', '', rep)
-        return rep
-#        rep = ''
-#        l = self.com.read(1)
-##        print 'lake> got <' + l + '>', ord(l)
-#        while l not in ['\r','\n']:
-#            rep = rep + l
-#            l = self.com.read(1)
-##        print 'lake> reply <%s>'%(rep)
-#        self.com.close()
-#        return rep
-
 if __name__=='__main__':
 
     quiet = 0
@@ -73,16 +27,19 @@ if __name__=='__main__':
     output = None
     interval=0.0
     port='/dev/ttyS0'
+    binary = 0
 
-    options = "hql:o:i:p:"
-    long_options = ["help", "quiet", "logfile=", "output=", "interval=","port="]
+    options = "hqbl:o:i:p:"
+    long_options = ["help", "quiet", "binary", "logfile=", "output=", "interval=","port="]
     (optval, args) = getopt.getopt(sys.argv[1:],options, long_options)
     for (opt,val) in optval:
         if opt == "-q" or opt == "--quiet":
             quiet = 1 
+        elif opt == "-b" or opt == "--binary":
+            binary = 1
         elif opt == "-l" or opt == "--logfile":
             logfile = val
-        elif opt == "-l" or opt == "--logfile":
+        elif opt == "-o" or opt == "--output":
             output = val
         elif opt == "-i" or opt == "--interval":
             interval = float(val)
@@ -90,11 +47,12 @@ if __name__=='__main__':
             port = val
         else:
             print "Usage:"
-            print "\t%s [--quiet] [--logfile=name] [--output=name] [--port=name] --interval=n" % sys.argv[0]
+            print "\t%s [--quiet] [--binary] [--logfile=name] [--output=name] [--port=name] --interval=n" % sys.argv[0]
             print "interval is required, and represents a time in seconds (float value, minimum 1 second)"
+            print "--binary also writes a binary log with the same name as the output but ending .bin"
             sys.exit(0)
 
-    ls = lake(port)
+    ls = Lakeshore(port)
 
     #ovveride Ctrl-c to shutdown cleanly
     def shutdown_handler(signal,frame):
@@ -136,7 +94,7 @@ if __name__=='__main__':
     msg = 'Day,Date,Month,Year,Time,Temp A(K),Temp B(K),Heater (%)'
     if not quiet: print msg
 
-    version = ls.cmd('*IDN? ')
+    version = ls.query('*IDN? ')
     #print "Lakeshore version:", version
     if ( os.path.exists(output) ):
       fp = open(output, 'a+')
@@ -152,16 +110,22 @@ if __name__=='__main__':
         fp.write(output+"\n")
         fp.close()
 
+    # binary log, for quick access by other programs
+    if binary:
+      bout = os.path.splitext(output)[0] + '.bin'
+      if not quiet: print 'Creating binary temperature file %s'%(bout)
+      writer = BinaryLogWriter(bout)
+
+    # keep the port open between readings
+    ls.openSession()
+
     while 1:
       try:
-        tempa = ls.cmd('KRDG? A')
-        tempb = ls.cmd('KRDG? B')
-        heater = ls.cmd('HTR? ')
-        ls.shutDown()
+        reading = ls.read()
 
         # Display/log result
-        now = strftime('%a,%d,%b,%Y,%H:%M:%S', localtime())
-        msg = '%s,%s,%s,%s'%(now, tempa[1:], tempb[1:], heater[1:])
+        now = strftime('%a,%d,%b,%Y,%H:%M:%S', localtime(reading.time))
+        msg = '%s,%.3f,%.3f,%.1f'%(now, reading.tempa, reading.tempb, reading.heater)
         if not quiet: print msg
 
         fp = open(output, 'a+')
@@ -169,6 +133,9 @@ if __name__=='__main__':
         fp.flush()
         fp.close()
 
+        if binary:
+          writer.append(reading)
+
         time.sleep(float(interval))
 
       except Exception, err:
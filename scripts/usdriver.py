@@ -33,6 +33,10 @@ import trm.drivers.slide       as slide
 import trm.drivers.uspec       as uspec
 import trm.drivers.filterwheel as fwheel
 import trm.drivers.lakeshore   as lake
+import trm.drivers.httpclient  as httpclient
+import trm.drivers.poller      as poller
+import trm.drivers.template    as template
+import trm.drivers.tcs         as tcs
 
 class SetWheel(object):
     """
@@ -103,6 +107,15 @@ class GUI(tk.Tk):
         # Construct the response logging window
         g.rlog = drvs.LabelGuiLogger('RSP', self, 5, 56, 'Response log')
 
+        # Background poller of the server status, needed by the
+        # information frame and the run timer
+        g.poller = poller.StatusPoller()
+        g.poller.start()
+
+        # Background poller of the TCS, for the information frame and Start
+        g.tcs = tcs.TcsClient()
+        g.tcs.start()
+
         # Instrument parameters frame.
         g.ipars = uspec.InstPars(self)
 
@@ -140,6 +153,15 @@ class GUI(tk.Tk):
                 g.clog.warn('Switching off Lakeshore access (settings)')
                 g.cpars['ccd_temperature_on'] = False
 
+        if not g.cpars['template_from_server']:
+            # parse the application templates now rather than on the
+            # first 'Start'
+            try:
+                template.preload()
+            except Exception, err:
+                g.clog.warn('Failed to load application templates')
+                g.clog.warn(str(err))
+
         # Switcher frame to select between setup, observe, focal plane slide
         switch = drvs.Switch(topLhsFrame)
 
@@ -234,6 +256,14 @@ class GUI(tk.Tk):
 
         # Filter selector. First create a FilterWheel
         g.wheel = fwheel.FilterWheel()
+        if g.cpars['filter_wheel_on']:
+            # put the wheel into serial mode and find where it is now, in
+            # the background, rather than on the first 'Start'. Errors end
+            # up in g.FIFO.
+            t = drvs.FifoThread(
+                lambda : g.wheel.ready() or g.wheel.getPos(), g.FIFO)
+            t.daemon = True
+            t.start()
 
         # create the SetWheel, attach to the Filters label.
         # This allows you to change the filter
@@ -345,6 +375,15 @@ class GUI(tk.Tk):
             except Exception, err:
                 g.clog.warn('Error closing filter wheel: ' + str(err))
 
+            # stop polling and close connections to the servers
+            g.poller.stop()
+            g.tcs.stop()
+            httpclient.client().close()
+
+            g.clog.debug('Widget options set = {0:d}, skipped = {1:d}'.format(
+                *drvs.CachedConfig.stats()))
+            for task, cost in g.astro.costs.iteritems():
+                g.clog.debug('AstroFrame ' + task + ': ' + str(cost))
 
             try:
 
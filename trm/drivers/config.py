@@ -132,6 +132,35 @@ ULTRASPEC = \
 #                          usdriver.
 #
 # MDIST_WARN            = number of degrees from Moon at which to warn
+#
+# HTTP_TIMEOUT          = default timeout for requests to the ATC servers, seconds
+#
+# HTTP_RETRIES          = number of times to retry a failed status request to the
+#                         ATC servers. Commands such as 'GO' are never retried.
+#
+# HTTP_BACKOFF          = delay before the first retry, doubling with each retry
+#                         thereafter, seconds
+#
+# HTTP_MAX_CONNECTIONS  = maximum number of simultaneous connections to any one
+#                         server. Connections are kept open between requests.
+#
+# STATUS_POLL_INTERVAL  = interval between background polls of the servers for
+#                         the run status, run and frame numbers, seconds
+#
+# CHECK_DELAY           = delay before the instrument settings are checked after
+#                         the last of a series of changes to an entry field,
+#                         milliseconds. Changes made within this time of each
+#                         other are checked together.
+#
+# ASTRO_INTERVAL        = interval between updates of the Sun and Moon in the
+#                         'Time & Sky' panel, seconds. The clock ticks once a
+#                         second regardless.
+#
+# TCS_POLL_INTERVAL     = interval between background polls of the telescope
+#                         control system for the position, seconds
+#
+# TCS_STATS_WINDOW      = period over which the drift rates of the telescope
+#                         and rotator are measured, seconds
 """,
      ['http_camera_server', 'http://localhost:9980/'],
      ['http_data_server', 'http://localhost:9981/'],
@@ -147,6 +176,15 @@ ULTRASPEC = \
      ['rtplot_server_port', 5100],
      ['confirm_on_quit', False],
      ['mdist_warn', 15.],
+     ['http_timeout', 5.],
+     ['http_retries', 2],
+     ['http_backoff', 0.1],
+     ['http_max_connections', 2],
+     ['status_poll_interval', 1.],
+     ['check_delay', 200],
+     ['astro_interval', 10.],
+     ['tcs_poll_interval', 2.],
+     ['tcs_stats_window', 60.],
      """
 # ===============================
 #
@@ -245,6 +283,8 @@ def readCpars(guide, fname):
     The routine loads the values straight into the global cpars as a
     dictionary.  The values it looks for and their types are defined by
     'guide' which contains a list. See config.ULTRASPEC for an example.
+    Any parameters missing from the file take their default values from
+    'guide' so that files written by older versions can still be read.
 
     """
 
@@ -293,7 +333,9 @@ def readCpars(guide, fname):
     for entry in guide:
         if isinstance(entry, (list, tuple)):
             key, value = entry
-            if isinstance(value,bool):
+            if key not in item:
+                g.cpars[key.lower()] = value
+            elif isinstance(value,bool):
                 if item[key].lower() == 'false' or item[key] == '0' or \
                    item[key].lower() == 'no':
                     g.cpars[key.lower()] = False
@@ -13,20 +13,25 @@ import socket, errno
 import Tkinter as tk
 import tkFont, tkFileDialog
 import xml.etree.ElementTree as ET
-import urllib, urllib2
+import xml.parsers.expat as expat
+import urllib, urllib2, urlparse
 import logging, time, datetime
 import BaseHTTPServer, SocketServer
-import threading, subprocess
-import math, json
+import threading, subprocess, Queue
+import math, json, zlib, StringIO
+import collections, functools
 
 # third party
 import ephem
 
 # mine
-import tcs
 import slide
 import globals as g
 import lakeshore as lake
+import httpclient
+import template
+import ephemeris
+import visibility
 
 def addStyle(root):
     """
@@ -80,8 +85,62 @@ class Boolean(tk.IntVar):
         if self.callback:
             self.callback(g.cpars[self.flag])
 
+class CachedConfig(object):
+    """
+    Mixin for Tk widgets which remembers the options set through
+    configure (or config) and only passes on to Tk those that have changed.
+    This saves a round-trip to Tcl, and a redisplay, for each option that
+    is set to the value that it already has, as happens a great deal in
+    the regularly-updated information frames.
+
+    The class attributes 'applied' and 'suppressed' count the options
+    passed on and not passed on over all widgets using the mixin.
+
+    Options set by other routes, e.g. when the widget is created, are not
+    known; the first setting of such an option is always passed on.
+    """
+
+    applied    = 0
+    suppressed = 0
+
+    # short names of options
+    ALIASES = {'bg' : 'background', 'fg' : 'foreground', 'bd' : 'borderwidth'}
+
+    def configure(self, cnf=None, **kw):
+        # queries go straight through
+        if isinstance(cnf, basestring) or (cnf is None and not kw):
+            return tk.Misc.configure(self, cnf)
+
+        opts = dict(cnf) if cnf else {}
+        opts.update(kw)
+
+        if not hasattr(self, '_cachedOptions'):
+            self._cachedOptions = {}
+        cache = self._cachedOptions
+
+        changed = {}
+        for key, value in opts.iteritems():
+            key = self.ALIASES.get(key, key)
+            if key not in cache or cache[key] != value:
+                changed[key] = value
+
+        CachedConfig.suppressed += len(opts) - len(changed)
+        if changed:
+            tk.Misc.configure(self, changed)
+            cache.update(changed)
+            CachedConfig.applied += len(changed)
+
+    config = configure
 
-class IntegerEntry(tk.Entry):
+    @classmethod
+    def stats(cls):
+        """
+        Returns (applied, suppressed), the numbers of options passed on to
+        Tk and skipped as unchanged.
+        """
+        return (cls.applied, cls.suppressed)
+
+class IntegerEntry(CachedConfig, tk.Entry):
     """
     Defines an Entry field which only accepts integer input.
     This is the base class for several varieties of integer
@@ -339,14 +398,14 @@ class IntegerEntry(tk.Entry):
             # If the value is different update appropriately
             # Store new value.
             self._value = newvalue
-            self._variable.set(self.newvalue)
+            self._variable.set(newvalue)
             if self.checker:
-                self.checker(*dummy)
+                deferCheck(self, self.checker, *dummy)
         else:
             # Store new value
             self._value = value
             if self.checker:
-                self.checker(*dummy)
+                deferCheck(self, self.checker, *dummy)
 
     # following are callbacks for bindings
     def _dadd1(self, event):
@@ -731,7 +790,7 @@ class ListInt (IntegerEntry):
         """
         return True
 
-class FloatEntry(tk.Entry):
+class FloatEntry(CachedConfig, tk.Entry):
     """
     Defines an Entry field which only accepts floating point input.
     """
@@ -888,14 +947,14 @@ class FloatEntry(tk.Entry):
             # If the value is different update appropriately
             # Store new value.
             self._value = newvalue
-            self._variable.set(self.newvalue)
+            self._variable.set(newvalue)
             if self.checker:
-                self.checker(*dummy)
+                deferCheck(self, self.checker, *dummy)
         else:
             # Store new value
             self._value = value
             if self.checker:
-                self.checker(*dummy)
+                deferCheck(self, self.checker, *dummy)
 
     # following are callbacks for bindings
     def _dadd(self, event):
@@ -1069,7 +1128,7 @@ class Expose (RangedFloat):
         self.fmin = fmin
         self.set(self.fmin)
 
-class TextEntry (tk.Entry):
+class TextEntry (CachedConfig, tk.Entry):
     """
     Sub-class of Entry for basic text input. Not a lot to
     it but it keeps things neater and it has a check for
@@ -1280,52 +1339,82 @@ def saveXML(root):
     g.clog.info('Saved setup to' + fname)
     return True
 
-def postXML(root):
+def _post(url, sxml):
+    """
+    Posts an application to a server, returning its ReadServer
+    """
+    response = httpclient.client().post(
+        url, sxml, headers={'Content-type': 'text/xml'}, timeout=5, retries=0)
+    return ReadServer(response.read())
+
+def startPost(root):
     """
-    Posts the current setup to the camera and data servers.
+    Starts posting the current setup to the camera and data servers, both
+    at once, on the worker pool. Returns the two Tasks, to be passed to
+    'postResult' once done, or None if the servers are not active.
 
     root : (xml.etree.ElementTree.Element)
     The current setup.
 
     """
-    g.clog.debug('Entering postXML')
+    g.clog.debug('Entering startPost')
 
     if not g.cpars['cdf_servers_on']:
-        g.clog.warn('postXML: servers are not active')
-        return False
+        g.clog.warn('startPost: servers are not active')
+        return None
 
     # Write setup to an xml string
     sxml = ET.tostring(root)
+    g.clog.debug('content length = ' + str(len(sxml)))
 
-    # Send the xml to the camera server
-    url = g.cpars['http_camera_server'] + g.HTTP_PATH_CONFIG
-    g.clog.debug('Camera URL = ' + url)
+    # Send the xml to the camera and data servers
+    curl = g.cpars['http_camera_server'] + g.HTTP_PATH_CONFIG
+    g.clog.debug('Camera URL = ' + curl)
+    durl = g.cpars['http_data_server'] + g.HTTP_PATH_CONFIG
+    g.clog.debug('Data server URL = ' + durl)
 
-    opener = urllib2.build_opener()
-    g.clog.debug('content length = ' + str(len(sxml)))
-    req = urllib2.Request(url, data=sxml, headers={'Content-type': 'text/xml'})
-    response = opener.open(req, timeout=5)
-    csr = ReadServer(response.read())
+    pool = workers()
+    return (pool.submit('camera post', _post, curl, sxml),
+            pool.submit('data server post', _post, durl, sxml))
+
+def postResult(tasks):
+    """
+    Waits for the posts started by 'startPost' and reports the servers'
+    responses. Returns True if both were OK.
+
+    tasks : the Tasks returned by startPost
+    """
+    ctask, dtask = tasks
+    csr = ctask.result()
     g.rlog.warn(csr.resp())
     if not csr.ok:
         g.clog.warn('Camera response was not OK')
         return False
 
-    # Send the xml to the data server
-    url = g.cpars['http_data_server'] + g.HTTP_PATH_CONFIG
-    g.clog.debug('Data server URL = ' + url)
-    req = urllib2.Request(url, data=sxml, headers={'Content-type': 'text/xml'})
-    response = opener.open(req, timeout=5) # ?? need to check whether this is needed
-    fsr = ReadServer(response.read())
+    fsr = dtask.result()
     g.rlog.warn(fsr.resp())
-    if not csr.ok:
+    if not fsr.ok:
         g.clog.warn('Fileserver response was not OK')
         return False
 
-    g.clog.debug('Leaving postXML')
+    g.clog.debug('Posted: camera {0:.0f} ms, data server '
+                 '{1:.0f} ms'.format(1000.*ctask.elapsed,
+                                     1000.*dtask.elapsed))
     return True
 
-class ActButton(tk.Button):
+def postXML(root):
+    """
+    Posts the current setup to the camera and data servers, waiting for
+    both. See 'startPost' to avoid waiting.
+
+    root : (xml.etree.ElementTree.Element)
+    The current setup.
+
+    """
+    tasks = startPost(root)
+    return tasks is not None and postResult(tasks)
+
+class ActButton(CachedConfig, tk.Button):
     """
     Base class for action buttons. This keeps an internal flag
     representing whether the button should be active or not.
@@ -1466,6 +1555,7 @@ class Stop(ActButton):
                     g.clog.warn('Failed to stop run')
                     self.stopped_ok = False
                 self.stopping   = False
+                g.poller.refresh()
             except Exception, err:
                 g.clog.warn('Failed to stop run. Error = ' + str(err))
                 self.stopping   = False
@@ -1669,48 +1759,51 @@ class ReadServer(object):
 
     Set the following attributes:
 
-     root    : the xml.etree.ElementTree.Element at the root of the xml
+     root    : the xml.etree.ElementTree.Element at the root of the xml,
+               less the camera_status and filesave_status blocks. This is
+               only built when first needed.
      camera  : true if the response was from the camera server (else filesave)
      ok      : whether response is OK or not (True/False)
      err     : message if ok == False
      state   : state of the camera. Possibilties are:
                'IDLE', 'BUSY', 'ERROR', 'ABORT', 'UNKNOWN'
      run     : current or last run number
+
+    The responses are dominated by the camera_status and filesave_status
+    blocks which are never needed, so rather than build the whole tree the
+    response is scanned with expat for the few top-level elements that
+    are used.
     """
 
+    # top-level elements picked out of the response
+    FIELDS = ('source', 'status', 'state', 'lastfile')
+
     def __init__(self, resp):
         # Store the entire response
-        self.root = ET.fromstring(resp)
+        self._resp = resp
+        self._root = None
+
+        # Scan for the elements of interest
+        fields = self._scan(resp)
 
         # Identify the source: camera or filesave
-        cfind = self.root.find('source')
-        if cfind is None:
+        if 'source' not in fields:
             self.camera = None
             self.ok     = False
             self.err    = 'Could not identify source'
             self.state  = None
             return
 
-        self.camera = cfind.text.find('Camera') > -1
-
-        # strip excess stuff
-        camstat = self.root.find('camera_status')
-        if camstat is not None:
-            self.root.remove(camstat)
-
-        filestat = self.root.find('filesave_status')
-        if filestat is not None:
-            self.root.remove(filestat)
+        self.camera = fields['source'][1].find('Camera') > -1
 
         # Work out whether it was happy
-        sfind = self.root.find('status')
-        if sfind is None:
+        if 'status' not in fields:
             self.ok    = False
             self.err   = 'Could not identify status'
             self.state = None
             return
 
-        att = sfind.attrib
+        att = fields['status'][0]
         if 'software' in att and 'errnum' in att:
             self.ok = att['software'] == 'OK'
             if self.ok:
@@ -1719,27 +1812,75 @@ class ReadServer(object):
                 self.err = 'server errnum = ' + str(att['errnum'])
 
         # Determine state of the camera / data server
-        sfind = self.root.find('state')
-        if sfind is None:
+        if 'state' not in fields:
             self.ok     = False
             self.err    = 'Could not identify state'
             self.state  = None
             return
 
+        att = fields['state'][0]
         if self.camera:
-            self.state = sfind.attrib['camera']
+            self.state = att['camera']
         else:
-            self.state = sfind.attrib['server']
+            self.state = att['server']
 
         # Find current run number (set it to 0 if we fail)
         # this only works for  the 'fstatus' command as
         # opposed to 'status' for which the above works
-        sfind = self.root.find('lastfile')
-        if sfind is not None and 'path' in sfind.attrib:
-            self.run = int(sfind.attrib['path'][-3:])
+        att = fields['lastfile'][0] if 'lastfile' in fields else {}
+        if 'path' in att:
+            self.run = int(att['path'][-3:])
         else:
             self.run = 0
 
+    def _scan(self, resp):
+        """
+        Returns a dictionary keyed by the names of those elements in FIELDS
+        which are direct children of the root, each entry being a tuple of
+        the element's attributes and its text. Everything else in the
+        response, including the subtrees of the elements found, is skipped.
+        """
+        fields = {}
+        current = [None, 0]  # [field being read, depth]
+
+        def start(tag, attrib):
+            current[1] += 1
+            if current[1] == 2 and tag in self.FIELDS and tag not in fields:
+                fields[tag] = (attrib, [])
+                current[0] = tag
+
+        def end(tag):
+            if current[1] == 2:
+                current[0] = None
+            current[1] -= 1
+
+        def data(text):
+            if current[0] is not None:
+                fields[current[0]][1].append(text)
+
+        parser = expat.ParserCreate()
+        parser.returns_unicode = False
+        parser.StartElementHandler  = start
+        parser.EndElementHandler    = end
+        parser.CharacterDataHandler = data
+        parser.Parse(resp, True)
+
+        return dict((tag, (attrib, ''.join(text)))
+                    for tag, (attrib, text) in fields.iteritems())
+
+    @property
+    def root(self):
+        if self._root is None:
+            root = ET.fromstring(self._resp)
+
+            # strip excess stuff
+            for name in ('camera_status', 'filesave_status'):
+                stat = root.find(name)
+                if stat is not None:
+                    root.remove(stat)
+            self._root = root
+        return self._root
+
     def resp(self):
         return ET.tostring(self.root)
 
@@ -1774,7 +1915,8 @@ def execCommand(command):
         url = g.cpars['http_camera_server'] + g.HTTP_PATH_EXEC + \
             '?' + command
         g.clog.info('execCommand, command = "' + command + '"')
-        response = urllib2.urlopen(url)
+        # commands such as GO must not be repeated, hence no retries
+        response = httpclient.client().get(url, retries=0)
         rs  = ReadServer(response.read())
 
         g.rlog.info('Camera response =\n' + rs.resp())
@@ -1819,7 +1961,7 @@ def execServer(name, app):
 
     g.clog.debug('execServer, url = ' + url)
 
-    response = urllib2.urlopen(url)
+    response = httpclient.client().get(url, retries=0)
     rs  = ReadServer(response.read())
     if not rs.ok:
         g.clog.warn('Response from ' + name + ' server not OK')
@@ -2028,6 +2170,9 @@ class SetupServers(ActButton):
 
             # set flag indicating that the servers have been initialised
             g.cpars['servers_initialised'] = True
+
+            # templates from the server may have changed
+            template.cache().refresh()
             return True
         else:
             g.clog.warn('Setup servers failed')
@@ -2085,6 +2230,7 @@ class PowerOn(ActButton):
                     'Failed to determine run number at start of run')
                 g.clog.warn(str(err))
                 g.info.run.configure(text='UNDEF')
+            g.poller.refresh()
             return True
         else:
             g.clog.warn('Power on failed\n')
@@ -2530,35 +2676,194 @@ class ExpertMenu(tk.Menu):
             else:
                 self.root.entryconfig(index,state=tk.DISABLED)
 
+class RtplotWins(object):
+    """
+    The window parameters served to rtplot, held as the encoded reply so
+    that the server never has to touch the GUI. 'publish' is called from
+    the GUI thread (InstPars.check) and the server's threads read the
+    result with 'current', or wait for it to change with 'wait'.
+    Attributes::
+
+      version : number incremented each time the windows change
+      etag    : HTTP entity tag of the reply, a checksum of its content
+      payload : the reply, '' if no windows have been published
+    """
+
+    def __init__(self):
+        self.version = 0
+        self.payload = ''
+        self.etag    = self._etag('')
+        self._cond   = threading.Condition(threading.Lock())
+
+    @staticmethod
+    def _etag(payload):
+        return '"{0:08x}"'.format(zlib.crc32(payload) & 0xffffffff)
+
+    def publish(self, payload):
+        """
+        Sets the reply, incrementing the version if it has changed.
+        Returns True if it has.
+        """
+        with self._cond:
+            if payload == self.payload:
+                return False
+            self.payload  = payload
+            self.etag     = self._etag(payload)
+            self.version += 1
+            self._cond.notify_all()
+            return True
+
+    def current(self):
+        """
+        Returns (version, etag, payload)
+        """
+        with self._cond:
+            return (self.version, self.etag, self.payload)
+
+    def wait(self, version, timeout):
+        """
+        Waits until the version differs from 'version' or for timeout
+        seconds, whichever comes first. Returns (version, etag, payload)
+        """
+        end = time.time() + timeout
+        with self._cond:
+            while self.version == version:
+                remaining = end - time.time()
+                if remaining <= 0.:
+                    break
+                self._cond.wait(remaining)
+            return (self.version, self.etag, self.payload)
+
 class RtplotHandler(BaseHTTPServer.BaseHTTPRequestHandler):
     """
-    Handler for requests from rtplot. It accesses the window
-    parameters via the 'server' attribute; the Server class
-    that comes next stores these in on instantiation.
+    Handler for requests from rtplot. It serves the window
+    parameters published by InstPars via the 'server' attribute;
+    the Server class that comes next stores these in on
+    instantiation. Connections are kept open between requests, and
+    requests with an 'If-None-Match' header that matches the current
+    ETag get an empty '304 Not Modified' reply. The paths are::
+
+      /wait?version=N&timeout=T : waits until the version is not N, or
+                                  for T seconds (default WAIT, at most
+                                  MAXWAIT), then replies as for any other
+                                  path. N defaults to the current version.
+      /stream                   : server-sent events (text/event-stream).
+                                  Sends the windows straight away and
+                                  then each time they change, as a
+                                  'windows' event with the version as its
+                                  id, one line of the reply per 'data'
+                                  line.
+      anything else             : the windows, straight away
     """
+    protocol_version = 'HTTP/1.1'
+
+    # default and maximum waits of /wait, and the interval between the
+    # comments /stream sends to keep the connection alive, seconds
+    WAIT      = 30.
+    MAXWAIT   = 300.
+    HEARTBEAT = 15.
+
     def do_GET(self):
+        url   = urlparse.urlparse(self.path)
+        query = urlparse.parse_qs(url.query)
+        if url.path == '/stream':
+            self._stream()
+            return
+
+        if url.path == '/wait':
+            try:
+                version = int(query['version'][0]) if 'version' in query \
+                    else self.server.wins.current()[0]
+                timeout = float(query.get('timeout', [self.WAIT])[0])
+                if math.isnan(timeout) or math.isinf(timeout):
+                    raise ValueError('timeout must be finite')
+                timeout = min(timeout, self.MAXWAIT)
+            except ValueError:
+                self.send_error(400, 'version and timeout must be finite numbers')
+                return
+            version, etag, payload = self.server.wins.wait(version, timeout)
+        else:
+            version, etag, payload = self.server.wins.current()
+
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('X-Version', str(version))
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        if payload == '':
+            payload = 'No valid data available\r\n'
         self.send_response(200)
         self.send_header('Content-type', 'text/plain')
+        self.send_header('Content-Length', str(len(payload)))
+        self.send_header('ETag', etag)
+        self.send_header('X-Version', str(version))
         self.end_headers()
-        wins = self.server.instpars.getRtplotWins()
-        if wins == '':
-            self.wfile.write('No valid data available\r\n')
-        else:
-            self.wfile.write(wins)
+        self.wfile.write(payload)
+
+    def _stream(self):
+        """
+        Sends server-sent events until the client goes away
+        """
+        self.close_connection = 1
+        wins = self.server.wins
+        version, etag, payload = wins.current()
+        try:
+            self.send_response(200)
+            self.send_header('Content-type', 'text/event-stream')
+            self.send_header('Cache-Control', 'no-cache')
+            self.send_header('Connection', 'close')
+            self.end_headers()
+
+            while True:
+                if payload == '':
+                    payload = 'No valid data available'
+                event = 'id: {0:d}\nevent: windows\n'.format(version) + \
+                    ''.join('data: ' + line + '\n'
+                            for line in payload.splitlines()) + '\n'
+                self.wfile.write(event)
+                self.wfile.flush()
+
+                last = version
+                while version == last:
+                    version, etag, payload = wins.wait(last, self.HEARTBEAT)
+                    if version == last:
+                        self.wfile.write(': keep-alive\n\n')
+                        self.wfile.flush()
+        except socket.error:
+            # client has disconnected. Drop whatever could not be sent so
+            # that it is not flushed again as the request ends.
+            self.wfile = StringIO.StringIO()
+
+    def finish(self):
+        try:
+            BaseHTTPServer.BaseHTTPRequestHandler.finish(self)
+        except socket.error:
+            # the client went away with data still to be sent, which is
+            # how /stream normally ends
+            self.rfile.close()
 
-class RtplotServer (SocketServer.TCPServer):
+    def log_message(self, format, *args):
+        # rtplot polls rapidly, so requests are not logged
+        pass
+
+class RtplotServer (SocketServer.ThreadingMixIn, SocketServer.TCPServer):
     """
     Server for requests from rtplot.
     The response delivers the binning factors, number of windows and
-    their positions.
+    their positions. Each client is served by its own thread.
     """
+    daemon_threads = True
+
     def __init__(self, instpars, port):
         # '' opens port on localhost and makes it visible
         # outside localhost
         try:
             SocketServer.TCPServer.__init__(
                 self, ('', port), RtplotHandler)
-            self.instpars = instpars
+            self.wins = instpars.rtplotWins
         except socket.error, err:
             errorcode =  err[0]
             if errorcode == errno.EADDRINUSE:
@@ -2581,7 +2886,7 @@ class RtplotServer (SocketServer.TCPServer):
             except Exception, e:
                 g.clog.warn('RtplotServer.run', e)
 
-class Timer(tk.Label):
+class Timer(CachedConfig, tk.Label):
     """
     Run Timer class. Updates @10Hz, checks
     run status @1Hz. Switches button statuses
@@ -2591,6 +2896,7 @@ class Timer(tk.Label):
         tk.Label.__init__(self, master, text='{0:<d} s'.format(0), font=g.ENTRY_FONT)
         self.id    = None
         self.count = 0
+        self.startTime = 0.
 
     def start(self):
         """
@@ -2603,15 +2909,18 @@ class Timer(tk.Label):
     def update(self):
         """
         Updates @ 10Hz to give smooth running clock, checks
-        run status @1Hz to reduce load on servers.
+        run status @1Hz from the status poller's snapshot.
         """
         try:
             self.count += 1
             delta = int(round(time.time()-self.startTime))
             self.configure(text='{0:<d} s'.format(delta))
 
-            if self.count % 10 == 0:
-                if not isRunActive():
+            snap = g.poller.snapshot
+            if self.count % 10 == 0 and snap.time > self.startTime:
+                if snap.error is not None and snap.active is None:
+                    raise DriverError(snap.error)
+                if snap.active is False:
                     g.observe.start.enable()
                     g.observe.stop.disable()
                     g.setup.resetSDSUhard.enable()
@@ -2635,7 +2944,7 @@ class Timer(tk.Label):
             self.after_cancel(self.id)
         self.id = None
 
-class Ilabel(tk.Label):
+class Ilabel(CachedConfig, tk.Label):
     """
     Class to define an information label which uses the same font
     as the entry fields rather than the default font
@@ -2669,6 +2978,8 @@ class InfoFrame(tk.LabelFrame):
         self.mdist   = Ilabel(self,text='UNDEF')
         self.fpslide = Ilabel(self,text='UNDEF')
         self.lake    = Ilabel(self,text='UNDEF')
+        self.drift   = Ilabel(self,text='UNDEF')
+        self.rotlim  = Ilabel(self,text='UNDEF')
 
         # left-hand side
         tk.Label(self,text='Run:').grid(row=0,column=0,padx=5,sticky=tk.W)
@@ -2709,6 +3020,9 @@ class InfoFrame(tk.LabelFrame):
         tk.Label(self,text='HA:').grid(row=5,column=3,padx=5,sticky=tk.W)
         self.ha.grid(row=5,column=4,padx=5,sticky=tk.W)
 
+        tk.Label(self,text='Drift:').grid(row=6,column=3,padx=5,sticky=tk.W)
+        self.drift.grid(row=6,column=4,padx=5,sticky=tk.W)
+
         # right-hand side
         tk.Label(self,text='PA:').grid(row=0,column=6,padx=5,sticky=tk.W)
         self.pa.grid(row=0,column=7,padx=5,sticky=tk.W)
@@ -2728,11 +3042,8 @@ class InfoFrame(tk.LabelFrame):
         tk.Label(self,text='CCD temp:').grid(row=5,column=6,padx=5,sticky=tk.W)
         self.lake.grid(row=5,column=7,padx=5,sticky=tk.W)
 
-        # these are used to judge whether we are tracking or not
-        self.ra_old    = 0.
-        self.dec_old   = 0.
-        self.pa_old    = 0.
-        self.tracking  = False
+        tk.Label(self,text='Rot. lim:').grid(row=6,column=6,padx=5,sticky=tk.W)
+        self.rotlim.grid(row=6,column=7,padx=5,sticky=tk.W)
 
         # start
         self.count = 0
@@ -2754,44 +3065,32 @@ class InfoFrame(tk.LabelFrame):
                 if g.cpars['telins_name'] == 'TNO-USPEC':
                     try:
 
-                        # Poll TCS for ra,dec etc.
-                        ra,dec,pa,focus,tracking,engpa = tcs.getTntTcs()
+                        # latest sample from the TCS client
+                        samp = g.tcs.sample()
+                        ra, dec, pa = samp.ra, samp.dec, samp.pa
+                        focus, engpa = samp.focus, samp.engpa
 
                         self.ra.configure(text=d2hms(ra/15., 1, False))
                         self.dec.configure(text=d2hms(dec, 0, True))
-                        while pa < 0.:
-                            pa += 360.
-                        while pa > 360.:
-                            pa -= 360.
                         self.pa.configure(text='{0:6.2f}'.format(pa))
 
                         # check for significant changes in position to flag
                         # tracking failures. I have removed a test of tflag
                         # to be True because the telescope often switches to
                         # "slewing" status even when nominally tracking.
-                        if abs(ra-self.ra_old) < 1.e-3 and \
-                           abs(dec-self.dec_old) < 1.e-3:
-                            self.tracking = True
+                        if g.tcs.tracking():
                             self.ra.configure(bg=g.COL['main'])
                             self.dec.configure(bg=g.COL['main'])
                         else:
-                            self.tracking = False
                             self.ra.configure(bg=g.COL['warn'])
                             self.dec.configure(bg=g.COL['warn'])
 
                         # check for changing sky PA
-                        if abs(pa-self.pa_old) > 0.1 and \
-                           abs(pa-self.pa_old-360.) > 0.1 and \
-                           abs(pa-self.pa_old+360.) > 0.1:
+                        if g.tcs.paChanging():
                             self.pa.configure(bg=g.COL['warn'])
                         else:
                             self.pa.configure(bg=g.COL['main'])
 
-                        # store current values for comparison with next
-                        self.ra_old  = ra
-                        self.dec_old = dec
-                        self.pa_old  = pa
-
                         # set engineering PA, warn if within 20 degrees
                         # of limits
                         self.engpa.configure(text='{0:+6.1f}'.format(engpa))
@@ -2808,43 +3107,39 @@ class InfoFrame(tk.LabelFrame):
                         # set focus
                         self.focus.configure(text='{0:+5.2f}'.format(focus))
 
-                        # create a Body for the target, calculate most of the
-                        # stuff that we don't get from the telescope
-                        star = ephem.FixedBody()
-                        star._ra  = math.radians(ra)
-                        star._dec = math.radians(dec)
-                        star.compute(g.astro.obs)
-
-                        lst = g.astro.obs.sidereal_time()
-                        ha  = (math.degrees(lst)-ra)/15.
-                        if ha > 12.:
-                            ha -= 12.
-                        elif ha < -12.:
-                            ha += 12.
-                        self.ha.configure(text=d2hms(ha, 0, True))
-
-                        dalt = math.degrees(star.alt)
-                        daz  = math.degrees(star.az)
-                        self.alt.configure(text='{0:<4.1f}'.format(dalt))
-                        self.az.configure(text='{0:<5.1f}'.format(daz))
-
-                        # warn about the TV mast. Basically checks whether alt
-                        # and az lie in roughly triangular shape presented by
-                        # the mast. First move azimuth 5 deg closer to the
-                        # mast to give a bit of warning.
-                        if daz > 33.5:
-                            daz = min(33.5,daz-5.)
+                        # drift rate on the sky and time until the rotator
+                        # hits a limit, from the recent TCS samples. Warn
+                        # if within 20 minutes of a limit.
+                        drift = g.tcs.history.drift()
+                        if drift is None:
+                            self.drift.configure(text='UNDEF')
+                            self.rotlim.configure(text='UNDEF',
+                                                  bg=g.COL['main'])
                         else:
-                            daz = max(33.5,daz+5.)
-
-                        if daz > 25.5 and daz < 50.0 and \
-                           dalt < 73.5 and \
-                           ((daz < 33.5 and \
-                             dalt < 73.5-(33.5-daz)/ \
-                             (33.5-25.5)*(73.5-21.5)) or \
-                            (daz > 33.5 and \
-                             dalt < 73.5- \
-                             (daz-33.5)/(50.0-33.5)*(73.5-21.5))):
+                            self.drift.configure(
+                                text='{0:<5.2f}"/m'.format(
+                                math.hypot(drift.raRate, drift.decRate)))
+                            if drift.toLimit is None:
+                                self.rotlim.configure(text='--',
+                                                      bg=g.COL['main'])
+                            else:
+                                self.rotlim.configure(
+                                    text='{0:<5.0f} m'.format(drift.toLimit))
+                                if drift.toLimit < 20.:
+                                    self.rotlim.configure(bg=g.COL['warn'])
+                                else:
+                                    self.rotlim.configure(bg=g.COL['main'])
+
+                        # everything else that we don't get from the
+                        # telescope comes from the visibility engine
+                        sky = g.astro.vis.at(ra, dec, time.time())
+
+                        self.ha.configure(text=d2hms(sky.ha, 0, True))
+                        self.alt.configure(text='{0:<4.1f}'.format(sky.alt))
+                        self.az.configure(text='{0:<5.1f}'.format(sky.az))
+
+                        # warn about the TV mast
+                        if sky.obstructed:
                             self.alt.configure(bg=g.COL['warn'])
                             self.az.configure(bg=g.COL['warn'])
                         else:
@@ -2853,14 +3148,13 @@ class InfoFrame(tk.LabelFrame):
 
                         # set airmass
                         self.airmass.configure(
-                            text='{0:<4.2f}'.format(
-                            1./math.sin(star.alt)))
+                            text='{0:<4.2f}'.format(sky.airmass))
 
                         # distance to the moon. Warn if too close
                         # (configurable) to it.
-                        md = math.degrees(ephem.separation(g.astro.moon,star))
-                        self.mdist.configure(text='{0:<7.2f}'.format(md))
-                        if md < g.cpars['mdist_warn']:
+                        self.mdist.configure(
+                            text='{0:<7.2f}'.format(sky.mdist))
+                        if sky.mdist < g.cpars['mdist_warn']:
                             self.mdist.configure(bg=g.COL['warn'])
                         else:
                             self.mdist.configure(bg=g.COL['main'])
@@ -2874,6 +3168,8 @@ class InfoFrame(tk.LabelFrame):
                         self.az.configure(text='UNDEF')
                         self.airmass.configure(text='UNDEF')
                         self.mdist.configure(text='UNDEF')
+                        self.drift.configure(text='UNDEF')
+                        self.rotlim.configure(text='UNDEF')
                         g.clog.warn('TCS error: ' + str(err))
                 else:
                     g.clog.debug('TCS error: could not recognise ' +
@@ -2882,60 +3178,20 @@ class InfoFrame(tk.LabelFrame):
             if g.cpars['cdf_servers_on'] and \
                g.cpars['servers_initialised']:
 
-                # get run number (set by the 'Start' button')
-                try:
-                    # if no run is active, get run number from
-                    # ultracam servers
-                    if not isRunActive():
-                        run = getRunNumber(True)
-                        self.run.configure(text='{0:03d}'.format(run))
-
-                    # get the value of the run being displayed, regardless of
-                    # whether we just managed to update it
-                    rtxt = self.run.cget('text')
-
-                    # if the value comes back as undefined, try to work out
-                    # the run number from the FileServer directory listing
-                    if rtxt == 'UNDEF':
-                        url = g.cpars['http_file_server'] + '?action=dir'
-                        response = urllib2.urlopen(url)
-                        resp = response.read()
-
-                        # parse response from server
-                        ldir = resp.split('<li>')
-                        runs = [entry[entry.find('>run')+1:\
-                                      entry.find('>run')+7] \
-                                for entry in ldir \
-                                if entry.find('getdata">run') > -1]
-                        runs.sort()
-                        rtxt = runs[-1][3:]
-                        run = int(rtxt)
-                        self.run.configure(text='{0:03d}'.format(run))
-                    else:
-                        run = int(rtxt)
-
-                    # OK, we have managed to get the run number
-                    rstr = 'run{0:03d}'.format(run)
-                    try:
-                        url = g.cpars['http_file_server'] + rstr + '?action=get_num_frames'
-                        response = urllib2.urlopen(url)
-                        rstr = response.read()
-                        ind = rstr.find('nframes="')
-                        if ind > -1:
-                            ind += 9
-                            nframe = int(rstr[ind:ind+rstr[ind:].find('"')])
-                            self.frame.configure(text='{0:d}'.format(nframe))
-                    except Exception, err:
-                        if err.code == 404:
-#                            g.clog.debug('Error trying to set frame: ' +
-#                                             str(err))
-                            self.frame.configure(text='0')
-                        else:
-                            g.clog.debug('Error occurred trying to set frame')
-                            self.frame.configure(text='UNDEF')
-
-                except Exception, err:
-                    g.clog.debug('Error trying to set run: ' + str(err))
+                # run and frame numbers come from the status poller so
+                # that slow servers do not hold up the GUI. Snapshots
+                # taken before the current run was started are ignored
+                # to avoid undoing the run number set by 'Start'.
+                snap = g.poller.snapshot
+                if snap.time > self.timer.startTime:
+                    if snap.run is not None:
+                        self.run.configure(text='{0:03d}'.format(snap.run))
+                    if snap.nframe is not None:
+                        self.frame.configure(text='{0:d}'.format(snap.nframe))
+                    elif snap.run is not None:
+                        self.frame.configure(text='UNDEF')
+                    if snap.error is not None:
+                        g.clog.debug(snap.error)
 
             # get the current filter, which is set during the start
             # operation
@@ -2943,20 +3199,26 @@ class InfoFrame(tk.LabelFrame):
                 self.filter.configure(text=g.start_filter)
 
             # get the slide position
-            # poll at 5x slower rate than the frame
+            # poll at 5x slower rate than the frame. The slide usually
+            # answers from its cached position.
             if self.count % 5 == 0 and g.cpars['focal_plane_slide_on']:
-                try:
-                    pos_ms,pos_mm,pos_px = g.fpslide.slide.return_position()
-                    self.fpslide.configure(text='{0:d}'.format(
-                        int(round(pos_px))))
-                    if pos_px < 1050.:
-                        self.fpslide.configure(bg=g.COL['warn'])
-                    else:
-                        self.fpslide.configure(bg=g.COL['main'])
-                except Exception, err:
-                    g.clog.warn('Slide error: ' + str(err))
-                    self.fpslide.configure(text='UNDEF')
+                if g.fpslide.slide.moving:
+                    self.fpslide.configure(text='MOVING')
                     self.fpslide.configure(bg=g.COL['warn'])
+                else:
+                    try:
+                        pos_ms,pos_mm,pos_px = \
+                            g.fpslide.slide.return_position()
+                        self.fpslide.configure(text='{0:d}'.format(
+                            int(round(pos_px))))
+                        if pos_px < 1050.:
+                            self.fpslide.configure(bg=g.COL['warn'])
+                        else:
+                            self.fpslide.configure(bg=g.COL['main'])
+                    except Exception, err:
+                        g.clog.warn('Slide error: ' + str(err))
+                        self.fpslide.configure(text='UNDEF')
+                        self.fpslide.configure(bg=g.COL['warn'])
 
             # get the CCD temperature poll at 5x slower rate than the frame
             if self.count % 5 == 0 and g.cpars['ccd_temperature_on']:
@@ -3009,17 +3271,15 @@ class AstroFrame(tk.LabelFrame):
         self.moonalt   = Ilabel(self)
         self.moonphase = Ilabel(self)
 
-        # observatory info
-        self.obs      = ephem.Observer()
-
+        # tables of the Sun and Moon for the observatory, which are
+        # re-built in the background when they are close to running out.
+        # Targets are placed with the visibility engine.
         tins = g.TINS[g.cpars['telins_name']]
-        self.obs.lat       = tins['latitude']
-        self.obs.lon       = tins['longitude']
-        self.obs.elevation = tins['elevation']
-
-        # generate Sun and Moon
-        self.sun = ephem.Sun()
-        self.moon = ephem.Moon()
+        self.eph = ephemeris.Ephemeris(
+            tins['latitude'], tins['longitude'], tins['elevation'],
+            time.time() - ephemeris.STEP)
+        self.vis = visibility.Visibility(self.eph)
+        self.rebuilding = False
 
         # arrange time info
         tk.Label(self,text='MJD:').grid(
@@ -3065,139 +3325,130 @@ class AstroFrame(tk.LabelFrame):
         g.clog.info('Latitude = ' + tins['latitude'] + ' N')
         g.clog.info('Elevation = ' + str(tins['elevation']) + ' m')
 
-        # parameters used to reduce re-calculation of sun rise etc, and
-        # to provide info for other widgets
+        # parameters to provide info for other widgets
         self.lastRiset = 0
         self.lastAstro = 0
-        self.counter   = 0
+
+        # time spent on each of the two tasks
+        self.costs = {'clock' : Cost(), 'sky' : Cost()}
 
         # start
-        self.update()
+        self.tick()
+        self.sky()
 
-    def update(self):
+    def tick(self):
         """
-        Updates @ 10Hz to give smooth running clock.
+        Updates the UTC, MJD and LST once per second, just after each tick
+        of the system clock so that the clock display does not lag.
         """
-
+        start = time.time()
         try:
-
-            # update counter
-            self.counter += 1
-
-            # current time in seconds since start of UNIX
-            utc = time.time()
-            self.obs.date = ephem.Date(g.UNIX0-g.EPH0+utc/g.DAY)
-
-            # configure times
+            utc = start
             self.utc.configure(text=time.strftime('%H:%M:%S',time.gmtime(utc)))
             self.mjd.configure(text='{0:11.5f}'.format(
                 g.UNIX0-g.MJD0+utc/g.DAY))
-            lst = g.DAY*(self.obs.sidereal_time()/math.pi/2.)
+            lst = g.DAY*(self.eph.lst(utc)/math.pi/2.)
             self.lst.configure(text=time.strftime('%H:%M:%S',time.gmtime(lst)))
 
-            if self.counter % 100 == 1:
-                # only re-compute Sun & Moon info once every 100 calls
-
-                # re-compute sun
-                self.obs.pressure = 1010.
-                self.sun.compute(self.obs)
-
-                self.sunalt.configure(
-                    text='{0:+03d} deg'.format(
-                        int(round(math.degrees(self.sun.alt)))))
-
-                if self.obs.date > self.lastRiset and \
-                   self.obs.date > self.lastAstro:
-                    # Only re-compute rise and setting times when necessary,
-                    # and only re-compute when both rise/set and astro
-                    # twilight times have gone by
-
-                    # turn off refraction for both sunrise & set and astro
-                    # twilight calculation.
-                    self.obs.pressure = 0.
-
-                    # For sunrise and set we set the horizon down to match a
-                    # standard amount of refraction at the horizon
-                    self.obs.horizon  = '-0:34'
-                    sunset  = self.obs.next_setting(self.sun)
-                    sunrise = self.obs.next_rising(self.sun)
-
-                    # Astro twilight: geometric centre at -18 deg
-                    self.obs.horizon = '-18'
-                    astroset  = self.obs.next_setting(self.sun, use_center=True)
-                    astrorise = self.obs.next_rising(self.sun, use_center=True)
-
-                    if sunrise > sunset:
-                        # In the day time we report the upcoming sunset and
-                        # end of evening twilight
-                        self.lriset.configure(text='Sets:', font=g.DEFAULT_FONT)
-                        self.lastRiset = sunset
-                        self.lastAstro = astroset
-
-                    elif astrorise > astroset and astrorise < sunrise:
-                        # During evening twilight, we report the sunset just
-                        # passed and end of evening twilight
-                        self.lriset.configure(text='Sets:', font=g.DEFAULT_FONT)
-                        self.obs.horizon  = '-0:34'
-                        self.lastRiset = self.obs.previous_setting(self.sun)
-                        self.lastAstro = astroset
-
-                    elif astrorise > astroset and astrorise < sunrise:
-                        # During night, report upcoming start of morning
-                        # twilight and sunrise
-                        self.lriset.configure(text='Rises:',
-                                              font=g.DEFAULT_FONT)
-                        self.obs.horizon  = '-0:34'
-                        self.lastRiset = sunrise
-                        self.lastAstro = astrorise
+        except Exception, err:
+            # catchall
+            g.clog.warn('AstroFrame.tick: error = ' + str(err))
 
-                    else:
-                        # During morning twilight report start of twilight
-                        # just passed and upcoming sunrise
-                        self.lriset.configure(text='Rises:',
-                                              font=g.DEFAULT_FONT)
-                        self.obs.horizon  = '-18'
-                        self.lastRiset = sunrise
-                        self.lastAstro = self.obs.previous_rising(
-                            self.sun, use_center=True)
-
-                    # Configure the corresponding text fields
-                    ntime = g.DAY*(self.lastRiset + g.EPH0 - g.UNIX0)
-                    self.riset.configure(
-                        text=time.strftime('%H:%M:%S',time.gmtime(ntime)))
-                    ntime = g.DAY*(self.lastAstro + g.EPH0 - g.UNIX0)
-                    self.astro.configure(
-                        text=time.strftime('%H:%M:%S',time.gmtime(ntime)))
-
-                # re-compute moon
-                self.obs.pressure = 1010.
-                self.moon.compute(self.obs)
-                self.moonra.configure(text='{0}'.format(self.moon.ra))
-                self.moondec.configure(text='{0}'.format(self.moon.dec))
-                self.moonalt.configure(
-                    text='{0:+03d} deg'.format(
-                        int(round(math.degrees(self.moon.alt)))))
-                self.moonphase.configure(
-                    text='{0:02d} %'.format(
-                        int(round(100.*self.moon.moon_phase))))
+        now = time.time()
+        self.costs['clock'].add(now-start)
+
+        # run again 5 milli-seconds after the next second starts
+        self.after(int(1000.*(1.-math.fmod(now,1.)))+5, self.tick)
+
+    def sky(self):
+        """
+        Updates the Sun and Moon info every 'astro_interval' seconds. The
+        Sun and Moon come from the tables in self.eph so this is cheap.
+        """
+        start = time.time()
+        try:
+
+            utc = start
+            eph = self.eph
+
+            # start making new tables in good time
+            if utc > eph.end - ephemeris.REBUILD and not self.rebuilding:
+                self.rebuilding = True
+                t = FifoThread(self.rebuild, g.FIFO, args=(utc,))
+                t.daemon = True
+                t.start()
+
+            self.sunalt.configure(
+                text='{0:+03d} deg'.format(
+                    int(round(math.degrees(eph.sunAlt(utc))))))
+
+            rising, riset, astro = eph.twilight(utc)
+            if rising:
+                self.lriset.configure(text='Rises:', font=g.DEFAULT_FONT)
+            else:
+                self.lriset.configure(text='Sets:', font=g.DEFAULT_FONT)
+            self.lastRiset = riset
+            self.lastAstro = astro
+
+            # Configure the corresponding text fields
+            self.riset.configure(
+                text=time.strftime('%H:%M:%S',time.gmtime(riset)))
+            self.astro.configure(
+                text=time.strftime('%H:%M:%S',time.gmtime(astro)))
+
+            # moon
+            ra, dec, alt, phase = eph.moon(utc)
+            self.moonra.configure(text='{0}'.format(ephem.hours(ra)))
+            self.moondec.configure(text='{0}'.format(ephem.degrees(dec)))
+            self.moonalt.configure(
+                text='{0:+03d} deg'.format(
+                    int(round(math.degrees(alt)))))
+            self.moonphase.configure(
+                text='{0:02d} %'.format(
+                    int(round(100.*phase))))
 
         except Exception, err:
             # catchall
-            g.clog.warn('AstroFrame.update: error = ' + str(err))
+            g.clog.warn('AstroFrame.sky: error = ' + str(err))
 
-        # run again after 100 milli-seconds
-        self.after(100, self.update)
+        self.costs['sky'].add(time.time()-start)
+
+        self.after(int(1000.*g.cpars['astro_interval']), self.sky)
+
+    def rebuild(self, utc):
+        """
+        Makes new tables starting at utc. Runs in a thread; the new tables
+        replace the old in one step so the display never sees partial
+        tables.
+        """
+        try:
+            tins = g.TINS[g.cpars['telins_name']]
+            eph = ephemeris.Ephemeris(
+                tins['latitude'], tins['longitude'], tins['elevation'],
+                utc - ephemeris.STEP)
+            vis = visibility.Visibility(eph)
+            self.eph, self.vis = eph, vis
+        finally:
+            self.rebuilding = False
 
 
 # various helper routines
 
-def isRunActive():
+def isRunActive(maxage=None):
     """
     Polls the data server to see if a run is active
+
+    maxage : if set, the state from the status poller (g.poller) is
+             returned instead if it is no more than maxage seconds old.
     """
+    if maxage is not None and g.poller is not None:
+        snap = g.poller.snapshot
+        if snap.active is not None and time.time() - snap.time <= maxage:
+            return snap.active
+
     if g.cpars['cdf_servers_on']:
         url = g.cpars['http_data_server'] + 'status'
-        response = urllib2.urlopen(url, timeout=2)
+        response = httpclient.client().get(url, timeout=2)
         rs  = ReadServer(response.read())
         if not rs.ok:
             raise DriverError('isRunActive error: ' + str(rs.err))
@@ -3229,7 +3480,7 @@ def getRunNumber(nocheck=False):
 
     if nocheck or isRunActive():
         url = g.cpars['http_data_server'] + 'fstatus'
-        response = urllib2.urlopen(url)
+        response = httpclient.client().get(url)
         rs  = ReadServer(response.read())
         if rs.ok:
             return rs.run
@@ -3238,6 +3489,42 @@ def getRunNumber(nocheck=False):
     else:
         raise DriverError('getRunNumber error')
 
+def getRunFromDirectory():
+    """
+    Works out the current run number from the FileServer directory listing,
+    for use when the data server cannot be asked. Throws exceptions if it
+    can't determine it.
+    """
+    url = g.cpars['http_file_server'] + '?action=dir'
+    response = httpclient.client().get(url)
+    resp = response.read()
+
+    # parse response from server
+    ldir = resp.split('<li>')
+    runs = [entry[entry.find('>run')+1:entry.find('>run')+7] \
+            for entry in ldir if entry.find('getdata">run') > -1]
+    if not runs:
+        raise DriverError('getRunFromDirectory error: no runs found')
+    runs.sort()
+    return int(runs[-1][3:])
+
+def getFrameNumber(run):
+    """
+    Asks the FileServer for the number of frames in a run. Raises a
+    urllib2.HTTPError with code 404 if the run has no data yet.
+
+    run : the run number
+    """
+    url = g.cpars['http_file_server'] + \
+        'run{0:03d}?action=get_num_frames'.format(run)
+    response = httpclient.client().get(url)
+    rstr = response.read()
+    ind = rstr.find('nframes="')
+    if ind > -1:
+        ind += 9
+        return int(rstr[ind:ind+rstr[ind:].find('"')])
+    raise DriverError('getFrameNumber error: no frame number in reply')
+
 def checkSimbad(target, maxobj=5, timeout=5):
     """
     Sends off a request to Simbad to check whether a target is recognised.
@@ -3426,15 +3713,16 @@ class WinPairs (tk.Frame):
         ybin  = self.ybin.value()
         npair = self.npair.value()
 
+        # background colours of the entries. These are only set once
+        # all checks are done to avoid needless changes
+        cols = {}
+
         # individual pair checks
         for xslw, xsrw, ysw, nxw, nyw in \
                 zip(self.xsl[:npair], self.xsr[:npair], self.ys[:npair],
                     self.nx[:npair], self.ny[:npair]):
-            xslw.config(bg=g.COL['main'])
-            xsrw.config(bg=g.COL['main'])
-            ysw.config(bg=g.COL['main'])
-            nxw.config(bg=g.COL['main'])
-            nyw.config(bg=g.COL['main'])
+            for w in (xslw, xsrw, ysw, nxw, nyw):
+                cols[w] = 'main'
             status = status if xslw.ok() else False
             status = status if xsrw.ok() else False
             status = status if ysw.ok() else False
@@ -3448,20 +3736,20 @@ class WinPairs (tk.Frame):
 
             # Are unbinned dimensions consistent with binning factors?
             if nx is None or nx % xbin != 0:
-                nxw.config(bg=g.COL['error'])
+                cols[nxw] = 'error'
                 status = False
 
             if ny is None or ny % ybin != 0:
-                nyw.config(bg=g.COL['error'])
+                cols[nyw] = 'error'
                 status = False
 
             # overlap checks
             if xsl is None or xsr is None or xsl >= xsr:
-                xsrw.config(bg=g.COL['error'])
+                cols[xsrw] = 'error'
                 status = False
 
             if xsl is None or xsr is None or nx is None or xsl + nx > xsr:
-                xsrw.config(bg=g.COL['error'])
+                cols[xsrw] = 'error'
                 status = False
 
             # Are the windows synchronised? This means that they would
@@ -3478,15 +3766,15 @@ class WinPairs (tk.Frame):
 
             # Range checks
             if xsl is None or nx is None or xsl + nx - 1 > xslw.imax:
-                xslw.config(bg=g.COL['error'])
+                cols[xslw] = 'error'
                 status = False
 
             if xsr is None or nx is None or xsr + nx - 1 > xsrw.imax:
-                xsrw.config(bg=g.COL['error'])
+                cols[xsrw] = 'error'
                 status = False
 
             if ys is None or ny is None or ys + ny - 1 > ysw.imax:
-                ysw.config(bg=g.COL['error'])
+                cols[ysw] = 'error'
                 status = False
 
         # Pair overlap checks. Compare one pair with the next one upstream
@@ -3507,9 +3795,12 @@ class WinPairs (tk.Frame):
                 ny2  = nyw2.value()
 
                 if ys1 + ny1 > ys2:
-                    ysw2.config(bg=g.COL['error'])
+                    cols[ysw2] = 'error'
                     status = False
 
+        for w, col in cols.iteritems():
+            setBackground(w, g.COL[col])
+
         if synced:
             self.sbutt.config(bg=g.COL['main'])
             self.sbutt.disable()
@@ -3755,15 +4046,17 @@ class Windows (tk.Frame):
         ybin = self.ybin.value()
         nwin = self.nwin.value()
 
+        # background colours of the entries. These are only set once
+        # all checks are done to avoid needless changes
+        cols = {}
+
         # individual window checks
         for xsw, ysw, nxw, nyw in \
                 zip(self.xs[:nwin], self.ys[:nwin],
                     self.nx[:nwin], self.ny[:nwin]):
 
-            xsw.config(bg=g.COL['main'])
-            ysw.config(bg=g.COL['main'])
-            nxw.config(bg=g.COL['main'])
-            nyw.config(bg=g.COL['main'])
+            for w in (xsw, ysw, nxw, nyw):
+                cols[w] = 'main'
             status = status if xsw.ok() else False
             status = status if ysw.ok() else False
             status = status if nxw.ok() else False
@@ -3775,11 +4068,11 @@ class Windows (tk.Frame):
 
             # Are unbinned dimensions consistent with binning factors?
             if nx is None or nx % xbin != 0:
-                nxw.config(bg=g.COL['error'])
+                cols[nxw] = 'error'
                 status = False
 
             if ny is None or ny % ybin != 0:
-                nyw.config(bg=g.COL['error'])
+                cols[nyw] = 'error'
                 status = False
 
             # Are the windows synchronised? This means that they
@@ -3796,11 +4089,11 @@ class Windows (tk.Frame):
 
             # Range checks
             if xs is None or nx is None or xs + nx - 1 > xsw.imax:
-                xsw.config(bg=g.COL['error'])
+                cols[xsw] = 'error'
                 status = False
 
             if ys is None or ny is None or ys + ny - 1 > ysw.imax:
-                ysw.config(bg=g.COL['error'])
+                cols[ysw] = 'error'
                 status = False
 
         # Overlap checks. Compare each window with the next one, requiring
@@ -3819,9 +4112,12 @@ class Windows (tk.Frame):
                 ny2  = nyw2.value()
 
                 if ys2 < ys1 + ny1:
-                    ysw2.config(bg=g.COL['error'])
+                    cols[ysw2] = 'error'
                     status = False
 
+        for w, col in cols.iteritems():
+            setBackground(w, g.COL[col])
+
         if synced:
             self.sbutt.config(bg=g.COL['main'])
             self.sbutt.disable()
@@ -3958,6 +4254,91 @@ def d2hms(d, decp, sign):
         form += str(3+decp) + '.' + str(decp) + 'f}'
         return form.format(h,m,s)
 
+# checks waiting to be run by deferCheck, keyed by checker
+_deferred = {}
+
+def deferCheck(widget, checker, *args):
+    """
+    Arranges for checker(*args) to be run when the GUI is next idle, or
+    once no further request has arrived for 'check_delay' milliseconds if
+    that is set. Each request cancels the one before, so that a burst of
+    changes, e.g. from holding down a mouse button over an entry field,
+    results in just one check, with the arguments of the last request,
+    once the burst is over.
+
+    widget  : the widget requesting the check
+    checker : the function to run
+    """
+    if checker in _deferred:
+        owner, afterId = _deferred[checker]
+        owner.after_cancel(afterId)
+
+    def run():
+        del _deferred[checker]
+        checker(*args)
+
+    delay = g.cpars.get('check_delay', 0) if g.cpars is not None else 0
+    if delay > 0:
+        _deferred[checker] = (widget, widget.after(delay, run))
+    else:
+        _deferred[checker] = (widget, widget.after_idle(run))
+
+def setBackground(widget, colour):
+    """
+    Sets the background colour of a widget, if it has changed.
+
+    widget : the widget
+    colour : the colour
+    """
+    if isinstance(widget, CachedConfig) or widget.cget('bg') != colour:
+        widget.config(bg=colour)
+
+def lruCache(maxsize=256):
+    """
+    Decorator which caches the results of a function of hashable arguments,
+    discarding the least recently used results once there are more than
+    maxsize of them. Thread safe. The decorated function gains 'cacheInfo'
+    which returns (hits, misses, size) and 'cacheClear' to empty the cache.
+
+    maxsize : maximum number of results to store
+    """
+    def decorator(func):
+        cache = collections.OrderedDict()
+        lock  = threading.Lock()
+        stats = [0, 0]
+
+        @functools.wraps(func)
+        def wrapper(*args):
+            with lock:
+                if args in cache:
+                    stats[0] += 1
+                    result = cache.pop(args)
+                    cache[args] = result
+                    return result
+                stats[1] += 1
+
+            result = func(*args)
+            with lock:
+                cache[args] = result
+                while len(cache) > maxsize:
+                    cache.popitem(last=False)
+            return result
+
+        def cacheInfo():
+            with lock:
+                return (stats[0], stats[1], len(cache))
+
+        def cacheClear():
+            with lock:
+                cache.clear()
+                stats[:] = [0, 0]
+
+        wrapper.cacheInfo  = cacheInfo
+        wrapper.cacheClear = cacheClear
+        return wrapper
+
+    return decorator
+
 class FifoThread(threading.Thread):
     """
     Adds a fifo Queue to a thread in order to store up disasters which are
@@ -3983,5 +4364,122 @@ class FifoThread(threading.Thread):
                     ''.join(traceback.format_tb(tb))
             self.fifo.put((error, tback))
 
+class Cost(object):
+    """
+    Records the time taken by a repeated task. Attributes::
+
+      ncall : number of times the task has run
+      total : total time taken, seconds
+      worst : longest time taken by one run, seconds
+    """
+    def __init__(self):
+        self.ncall = 0
+        self.total = 0.
+        self.worst = 0.
+
+    def add(self, dt):
+        """
+        Adds the time taken by one run
+        """
+        self.ncall += 1
+        self.total += dt
+        self.worst  = max(self.worst, dt)
+
+    def __str__(self):
+        mean = self.total/self.ncall if self.ncall else 0.
+        return '{0:d} calls, mean = {1:.2f} ms, max = {2:.2f} ms'.format(
+            self.ncall, 1000.*mean, 1000.*self.worst)
+
+class Task(object):
+    """
+    A function submitted to a WorkerPool, which works as a 'future' for its
+    result. Attributes::
+
+      name    : label for the task, used in messages
+      elapsed : time the function took to run, seconds (None until done)
+    """
+    def __init__(self, name, func, args):
+        self.name    = name
+        self.elapsed = None
+        self._func   = func
+        self._args   = args
+        self._value  = None
+        self._error  = None
+        self._done   = threading.Event()
+
+    def run(self):
+        """
+        Runs the function, storing its return value or exception
+        """
+        start = time.time()
+        try:
+            self._value = self._func(*self._args)
+        except Exception:
+            self._error = sys.exc_info()
+        self.elapsed = time.time() - start
+        self._done.set()
+
+    def done(self):
+        """
+        Returns True once the function has finished
+        """
+        return self._done.is_set()
+
+    def result(self, timeout=None):
+        """
+        Waits for the function to finish and returns its value. An
+        exception raised by the function is raised again here. Raises a
+        DriverError if it does not finish within timeout seconds.
+        """
+        if not self._done.wait(timeout):
+            raise DriverError(self.name + ' did not finish within ' +
+                              str(timeout) + ' seconds')
+        if self._error is not None:
+            t, v, tb = self._error
+            raise t, v, tb
+        return self._value
+
+class WorkerPool(object):
+    """
+    A fixed number of daemon threads which run Tasks in the order
+    submitted, so that slow operations (hardware access, posts to the
+    servers) can be carried out at the same time.
+    """
+    def __init__(self, nworker, name='Worker'):
+        self._queue = Queue.Queue()
+        for n in range(nworker):
+            t = threading.Thread(target=self._work,
+                                 name='{0:s}-{1:d}'.format(name, n+1))
+            t.daemon = True
+            t.start()
+
+    def _work(self):
+        while True:
+            self._queue.get().run()
+
+    def submit(self, name, func, *args):
+        """
+        Queues func(*args) to be run and returns its Task
+        """
+        task = Task(name, func, args)
+        self._queue.put(task)
+        return task
+
+# Number of threads in the shared WorkerPool
+NWORKER = 4
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def workers():
+    """
+    Returns the WorkerPool shared by all users, creating it on first use
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = WorkerPool(NWORKER)
+        return _pool
+
 class DriverError(Exception):
     pass
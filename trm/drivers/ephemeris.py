@@ -0,0 +1,261 @@
+#!/usr/bin/env python
+
+"""
+Precomputed tables of the Sun and Moon for the 'Time & Sky' display.
+
+Computing the sidereal time and the positions of the Sun and Moon with
+pyephem every time the display is updated is expensive, while the
+quantities themselves change slowly and smoothly. An Ephemeris computes
+them once on a regular grid covering a night or more and then interpolates
+linearly. The times of sunset, sunrise and astronomical twilight over
+the same period are computed at the same time.
+
+All times are UNIX times (seconds) and all angles are radians.
+"""
+
+from __future__ import print_function
+import bisect, math
+
+import ephem
+
+import globals as g
+
+# Default grid spacing and length, seconds
+STEP     = 60.
+DURATION = 30.*3600.
+
+# Users should make new tables once less than this remains, seconds
+REBUILD  = 6.*3600.
+
+def toUnix(date):
+    """
+    Converts an ephem.Date to a UNIX time
+    """
+    return g.DAY*(date + g.EPH0 - g.UNIX0)
+
+def toEphem(utc):
+    """
+    Converts a UNIX time to an ephem.Date
+    """
+    return ephem.Date(g.UNIX0-g.EPH0+utc/g.DAY)
+
+def _unwrap(angles):
+    """
+    Removes jumps of 2*pi from a list of angles, in place
+    """
+    offset = 0.
+    for i in xrange(1, len(angles)):
+        diff = angles[i] + offset - angles[i-1]
+        if diff > math.pi:
+            offset -= 2.*math.pi
+        elif diff < -math.pi:
+            offset += 2.*math.pi
+        angles[i] += offset
+
+class Ephemeris(object):
+    """
+    Tables of the local sidereal time, the altitude of the Sun, and the
+    position, altitude and phase of the Moon for a site over a period of
+    time, together with the times of sunset, sunrise and the start and end
+    of astronomical twilight. Attributes::
+
+      start : UNIX time of the first grid point
+      end   : UNIX time of the last grid point
+      step  : grid spacing, seconds
+    """
+
+    def __init__(self, lat, lon, elevation, start, duration=DURATION,
+                 step=STEP):
+        """
+        lat       : latitude, North positive (anything ephem accepts, e.g.
+                    '18 34')
+        lon       : longitude, East positive
+        elevation : height above sea level, metres
+        start     : UNIX time to start the tables
+        duration  : length of the tables, seconds
+        step      : grid spacing, seconds
+        """
+        self._site = (lat, lon, elevation)
+        obs = ephem.Observer()
+        obs.lat       = lat
+        obs.lon       = lon
+        obs.elevation = elevation
+        obs.pressure  = 1010.
+
+        sun  = ephem.Sun()
+        moon = ephem.Moon()
+
+        npoint = int(math.ceil(duration/step)) + 1
+        self.start = start
+        self.step  = step
+        self.end   = start + (npoint-1)*step
+
+        self._lst, self._sunalt = [], []
+        self._moonra, self._moondec, self._moonalt, self._moonphase = \
+            [], [], [], []
+
+        for n in xrange(npoint):
+            obs.date = toEphem(start + n*step)
+            self._lst.append(float(obs.sidereal_time()))
+            sun.compute(obs)
+            self._sunalt.append(float(sun.alt))
+            moon.compute(obs)
+            self._moonra.append(float(moon.ra))
+            self._moondec.append(float(moon.dec))
+            self._moonalt.append(float(moon.alt))
+            self._moonphase.append(moon.moon_phase)
+
+        _unwrap(self._lst)
+        _unwrap(self._moonra)
+
+        # Sunrise and set, and astronomical twilight, from a day before to
+        # a day after the tables so that the previous and next events are
+        # always known. Refraction is turned off for both. For sunrise and
+        # set the horizon is set down to match a standard amount of
+        # refraction at the horizon; astronomical twilight is when the
+        # geometric centre is at -18.
+        obs.pressure = 0.
+        obs.horizon  = '-0:34'
+        self._sets   = self._events(obs, sun, obs.next_setting, False)
+        self._rises  = self._events(obs, sun, obs.next_rising, False)
+        obs.horizon  = '-18'
+        self._asets  = self._events(obs, sun, obs.next_setting, True)
+        self._arises = self._events(obs, sun, obs.next_rising, True)
+
+    def _events(self, obs, body, method, use_center):
+        """
+        Returns a list of UNIX times of successive events from a day before
+        the start of the tables to a day after their end.
+        """
+        times = []
+        obs.date = toEphem(self.start - g.DAY)
+        try:
+            while True:
+                date = method(body, use_center=use_center)
+                utc  = toUnix(date)
+                times.append(utc)
+                if utc > self.end + g.DAY:
+                    break
+                obs.date = ephem.Date(date + ephem.minute)
+        except (ephem.AlwaysUpError, ephem.NeverUpError):
+            pass
+        return times
+
+    def _interp(self, table, utc):
+        """
+        Linear interpolation in a table
+        """
+        x = (utc - self.start)/self.step
+        n = min(max(int(x), 0), len(table)-2)
+        return table[n] + (table[n+1]-table[n])*(x-n)
+
+    def covers(self, utc):
+        """
+        Returns True if utc lies within the tables
+        """
+        return self.start <= utc <= self.end
+
+    def lst(self, utc):
+        """
+        Returns the local sidereal time, radians
+        """
+        return self._interp(self._lst, utc) % (2.*math.pi)
+
+    def sunAlt(self, utc):
+        """
+        Returns the altitude of the Sun, radians
+        """
+        return self._interp(self._sunalt, utc)
+
+    def moon(self, utc):
+        """
+        Returns (ra, dec, alt, phase) of the Moon, the apparent topocentric
+        RA and Dec, altitude (radians) and fraction illuminated.
+        """
+        return (self._interp(self._moonra, utc) % (2.*math.pi),
+                self._interp(self._moondec, utc),
+                self._interp(self._moonalt, utc),
+                self._interp(self._moonphase, utc))
+
+    def moonSeparation(self, utc, ra, dec):
+        """
+        Returns the angular distance (radians) from the Moon of a position
+
+        ra  : right ascension, radians
+        dec : declination, radians
+        """
+        mra, mdec, malt, phase = self.moon(utc)
+        return float(ephem.separation((mra, mdec), (ra, dec)))
+
+    def twilight(self, utc):
+        """
+        Returns (rising, riset, astro) to describe the Sun at time utc.
+        'rising' is False from sunrise until the end of evening twilight
+        when riset is the time of sunset and astro is the time of the end of
+        evening twilight. Otherwise it is True, and riset is the time of
+        sunrise and astro the start of morning twilight.
+
+        The times come from the tables where they cover utc and are
+        computed directly otherwise, e.g. if new tables are late.
+        """
+        events = self._tableEvents(utc)
+        if events is None:
+            events = self._directEvents(utc)
+        sunset, lastset, sunrise, astroset, astrorise, lastarise = events
+
+        if sunrise > sunset:
+            # In the day time we report the upcoming sunset and
+            # end of evening twilight
+            return (False, sunset, astroset)
+
+        elif astrorise > astroset and astrorise < sunrise:
+            # During evening twilight, we report the sunset just
+            # passed and end of evening twilight
+            return (False, lastset, astroset)
+
+        elif astrorise < astroset and astrorise < sunrise:
+            # During night, report upcoming start of morning
+            # twilight and sunrise
+            return (True, sunrise, astrorise)
+
+        else:
+            # During morning twilight report start of twilight
+            # just passed and upcoming sunrise
+            return (True, sunrise, lastarise)
+
+    def _tableEvents(self, utc):
+        """
+        Returns (sunset, lastset, sunrise, astroset, astrorise, lastarise),
+        the next and last sunset, the next sunrise, the next end and start
+        of astronomical twilight and the last start of it, from the tables,
+        or None if they do not have events either side of utc.
+        """
+        found = []
+        for times in (self._sets, self._rises, self._asets, self._arises):
+            n = bisect.bisect_right(times, utc)
+            if n < 1 or n >= len(times):
+                return None
+            found.append((times[n], times[n-1]))
+        (sunset, lastset), (sunrise, lastrise), (astroset, lastaset), \
+            (astrorise, lastarise) = found
+        return (sunset, lastset, sunrise, astroset, astrorise, lastarise)
+
+    def _directEvents(self, utc):
+        """
+        As _tableEvents, but computed with pyephem.
+        """
+        obs = ephem.Observer()
+        obs.lat, obs.lon, obs.elevation = self._site
+        obs.pressure = 0.
+        obs.date = toEphem(utc)
+        sun = ephem.Sun()
+
+        obs.horizon = '-0:34'
+        sunset  = toUnix(obs.next_setting(sun))
+        lastset = toUnix(obs.previous_setting(sun))
+        sunrise = toUnix(obs.next_rising(sun))
+        obs.horizon = '-18'
+        astroset  = toUnix(obs.next_setting(sun, use_center=True))
+        astrorise = toUnix(obs.next_rising(sun, use_center=True))
+        lastarise = toUnix(obs.previous_rising(sun, use_center=True))
+        return (sunset, lastset, sunrise, astroset, astrorise, lastarise)
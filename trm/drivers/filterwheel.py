@@ -12,7 +12,7 @@ Two main classes::
 """
 import Tkinter as tk
 import tkMessageBox
-import serial, time
+import serial, time, threading
 
 import globals as g
 import drivers as drvs
@@ -20,17 +20,36 @@ import drivers as drvs
 class FilterWheel(object):
     """
     Class to control the ULTRASPEC filterwheel.
+
+    Once connected and in serial mode (see 'ready') the wheel is left that
+    way until 'close' is called, so that repeated use does not have to
+    repeat the handshake. The position is remembered after each successful
+    'goto' or 'home' and forgotten after any error, so 'getPos' only asks
+    the wheel when it has to or when asked to verify. Commands are
+    serialised with a lock so the wheel can be used from several threads.
     """
 
     def __init__(self,port='/dev/filterwheel', default_timeout=2):
         """
         initialise filter wheel object. doesnt actually connect
         """
-        self.port = '/dev/filterwheel'
+        self.port = port
         self.baudrate = 19200
         self.default_timeout = default_timeout
         self.connected   = False
         self.initialised = False
+        self.position    = None
+        self.lock        = threading.RLock()
+
+    def ready(self):
+        """
+        connects and enables serial mode if that has not been done already
+        """
+        with self.lock:
+            if not self.connected:
+                self.connect()
+            if not self.initialised:
+                self.init()
 
     def connect(self):
         """
@@ -73,18 +92,24 @@ class FilterWheel(object):
         if not self.initialised and comm != 'WSMODE':
             raise FilterWheelError('Filter wheel not initialised')
 
-        if comm == 'WHOME' or comm.startswith('WGOTO'):
-            g.clog.debug('Filterwheel: setting timeout to 30 secs')
-            self.ser.setTimeout(30)
-        else:
-            g.clog.debug('Filterwheel: setting timeout to ' +
-                         str(self.default_timeout) + ' secs')
-            self.ser.setTimeout(self.default_timeout)
-
-        g.clog.debug('Filterwheel: sending command = ' + comm)
-        self.ser.write(comm+'\r\n',)
-        retVal = self.ser.readline()
-        g.clog.debug('Filterwheel: received = ' + retVal.strip())
+        with self.lock:
+            if comm == 'WHOME' or comm.startswith('WGOTO'):
+                g.clog.debug('Filterwheel: setting timeout to 30 secs')
+                self.ser.setTimeout(30)
+            else:
+                g.clog.debug('Filterwheel: setting timeout to ' +
+                             str(self.default_timeout) + ' secs')
+                self.ser.setTimeout(self.default_timeout)
+
+            try:
+                g.clog.debug('Filterwheel: sending command = ' + comm)
+                self.ser.write(comm+'\r\n',)
+                retVal = self.ser.readline()
+                g.clog.debug('Filterwheel: received = ' + retVal.strip())
+            except:
+                # no longer sure where the wheel is
+                self.position = None
+                raise
 
         # return command with leading and trailing whitespace removed
         return retVal.strip()
@@ -96,13 +121,15 @@ class FilterWheel(object):
         """
         # disable serial mode operation for the serial port
         g.clog.debug('Filterwheel: closing serial port')
-        if self.initialised:
-            self.sendCommand('WEXITS')
-            self.initialised = False
+        with self.lock:
+            self.position = None
+            if self.initialised:
+                self.sendCommand('WEXITS')
+                self.initialised = False
 
-        if self.connected:
-            self.ser.close()
-            self.connected = False
+            if self.connected:
+                self.ser.close()
+                self.connected = False
 
         g.clog.debug('Filterwheel: closed serial port')
 
@@ -114,13 +141,16 @@ class FilterWheel(object):
         confused state
         """
         g.clog.debug('Filterwheel: homing the wheel')
-        response = self.sendCommand('WHOME')
-        if response == 'ER=1':
-            raise FilterWheelError('Filter wheel homing took too many steps')
-        elif response == 'ER=3':
-            raise FilterWheelError('Could not ID filter wheel after HOME')
-        elif response == 'ER=6':
-            raise FilterWheelError('Filter wheel is slipping')
+        with self.lock:
+            self.position = None
+            response = self.sendCommand('WHOME')
+            if response == 'ER=1':
+                raise FilterWheelError('Filter wheel homing took too many steps')
+            elif response == 'ER=3':
+                raise FilterWheelError('Could not ID filter wheel after HOME')
+            elif response == 'ER=6':
+                raise FilterWheelError('Filter wheel is slipping')
+            self.position = 1
         g.clog.debug('Filterwheel: home returned ' + response)
 
     def getID(self):
@@ -134,15 +164,26 @@ class FilterWheel(object):
             raise FilterWheelError('Bad filter wheel ID\n'+response.strip())
         return response
 
-    def getPos(self):
+    def getPos(self, verify=False):
         """
-        gets current position of wheel (from 1 to 6)
+        gets current position of wheel (from 1 to 6). The wheel is only
+        asked if the position is not known or verify=True.
         """
-        g.clog.debug('Filterwheel: getting position')
-        response = self.sendCommand('WFILTR')
-        g.clog.debug('Poisition response = ' + response.strip())
-        filtNum = int(response)
-        return filtNum
+        with self.lock:
+            if self.position is not None and not verify:
+                g.clog.debug('Filterwheel: position = ' + str(self.position))
+                return self.position
+
+            g.clog.debug('Filterwheel: getting position')
+            response = self.sendCommand('WFILTR')
+            g.clog.debug('Poisition response = ' + response.strip())
+            try:
+                filtNum = int(response)
+            except ValueError:
+                raise FilterWheelError('bad position from filter wheel = [' +
+                                       response + ']')
+            self.position = filtNum
+            return filtNum
 
     def getNames(self):
         """
@@ -163,36 +204,48 @@ class FilterWheel(object):
         if position > 6 or position < 1:
             raise FilterWheelError('Invalid filter wheel position')
 
-        response = self.sendCommand('WGOTO'+repr(position))
-
-        if response == 'ER=4':
-            raise FilterWheelError('filter wheel is stuck')
-        elif response == 'ER=5':
-            raise FilterWheelError('requested position (' +
-                                   position + ') not valid')
-        elif response == 'ER=6':
-            raise FilterWheelError('filter wheel is slipping')
-        elif response != '*':
-            raise FilterWheelError('unrecognised error = [' +
-                                   response.strip() + ']')
+        with self.lock:
+            self.position = None
+            response = self.sendCommand('WGOTO'+repr(position))
+
+            if response == 'ER=4':
+                raise FilterWheelError('filter wheel is stuck')
+            elif response == 'ER=5':
+                raise FilterWheelError('requested position (' +
+                                       str(position) + ') not valid')
+            elif response == 'ER=6':
+                raise FilterWheelError('filter wheel is slipping')
+            elif response != '*':
+                raise FilterWheelError('unrecognised error = [' +
+                                       response.strip() + ']')
+            self.position = position
 
     def reboot(self):
         """
         use this to fix a non-responding filter wheel
         """
         g.clog.debug('Filterwheel: rebooting')
-        self.close()
-        time.sleep(2)
-        self.connect()
-        self.init()
-        self.home()
+        with self.lock:
+            self.close()
+            time.sleep(2)
+            self.connect()
+            self.init()
+            self.home()
 
 class WheelController(tk.Toplevel):
     """
     Class to allow control of the filter wheel. Opens in
     a new window.
+
+    Moves can take up to 30 seconds, so every operation on the wheel is
+    run by the worker pool (drvs.workers) while the window shows how long
+    it has been going. Only one operation is allowed at a time; requests
+    made while one is in progress are refused.
     """
 
+    # interval between checks of the progress of an operation, millisecs
+    POLL = 250
+
     def __init__(self, wheel):
         """
         wheel   : a FilterWheel instance representing the wheel
@@ -203,33 +256,22 @@ class WheelController(tk.Toplevel):
         self.title('Filter selector')
         self.wheel = wheel
 
+        # operation in progress (a drvs.Task), its start time, the function
+        # to call with its result, and the id of the next progress check
+        self.task    = None
+        self.tstart  = None
+        self.onDone  = None
+        self.afterId = None
+
         toplab = tk.Label(self,text='Current filter: ')
         toplab.grid(row=0,column=0,pady=3)
 
-        # current index
-        try:
-            # Try to connect to the wheel. Raises an Exception
-            # if no wheel available
-            if not self.wheel.connected:
-                self.wheel.connect()
-                self.wheel.init()
-
-            findex = self.wheel.getPos()-1
-
-            self.current = drvs.Ilabel(
-                self,text=g.cpars['active_filter_names'][findex])
-
-        except Exception, err:
-            g.clog.warn('Failed to get current filter position.\n')
-            g.clog.warn('Error: ' + str(err) + '\n')
-            self.current = drvs.Ilabel(self,text='UNKNOWN')
-            findex = 0
-
+        self.current = drvs.Ilabel(self,text='UNKNOWN')
         self.current.grid(row=0,column=1, sticky=tk.W, pady=3)
 
         self.filter = drvs.Choice(
             self, g.cpars['active_filter_names'],
-            initial=g.cpars['active_filter_names'][findex],
+            initial=g.cpars['active_filter_names'][0],
             width=width-1)
         self.filter.grid(row=1,column=0)
 
@@ -242,67 +284,166 @@ class WheelController(tk.Toplevel):
         self.init = drvs.ActButton(self, width, self._init, text='init wheel')
         self.init.grid(row=2, column=1)
 
+        self.status = drvs.Ilabel(self,text='')
+        self.status.grid(row=3,column=0,columnspan=2,sticky=tk.W,pady=3)
+
         # override the 'x' to kill the window
         self.protocol("WM_DELETE_WINDOW", self._close)
 
-    def _go(self, *args):
-        if drvs.isRunActive():
-            tkMessageBox.showwarning(
-                'Run active',
-                'Sorry; you cannot change filters during a run.')
+        # current index. Connects to the wheel if need be.
+        self._submit('checking position', self._getPos, (), self._gotPos)
+
+    def _getPos(self):
+        self.wheel.ready()
+        return self.wheel.getPos(verify=True)
+
+    def _gotPos(self, position, err):
+        if err is None:
+            fname = g.cpars['active_filter_names'][position-1]
+            self.current.configure(text=fname)
+            self.filter.set(fname)
+        else:
+            g.clog.warn('Failed to get current filter position.\n')
+            g.clog.warn('Error: ' + str(err) + '\n')
+
+    def _submit(self, name, func, args, onDone):
+        """
+        Starts an operation on the wheel unless one is already in progress,
+        in which case it is refused. 'func(*args)' is run by the worker
+        pool and onDone(result, err) is called once it has finished, where
+        'err' is None unless it raised an exception. Returns True if the
+        operation was started.
+        """
+        if self.task is not None:
+            g.clog.warn('Filter wheel busy ' + self.task.name +
+                        '; please wait until it has finished')
+            return False
+
+        self.task   = drvs.workers().submit(name, func, *args)
+        self.tstart = time.time()
+        self.onDone = onDone
+        for button in (self.go, self.home, self.init):
+            button.disable()
+        self._poll()
+        return True
+
+    def _poll(self):
+        """
+        Shows the progress of the operation in progress and calls its
+        onDone once it has finished.
+        """
+        if not self.task.done():
+            self.status.configure(text='{0:s} ... {1:.0f} s'.format(
+                self.task.name, time.time()-self.tstart))
+            self.afterId = self.after(self.POLL, self._poll)
             return
 
+        task, onDone = self.task, self.onDone
+        self.task, self.onDone, self.afterId = None, None, None
+        self.status.configure(text='')
+        for button in (self.go, self.home, self.init):
+            button.enable()
         try:
-            if not self.wheel.connected:
-                self.wheel.connect()
-                self.wheel.init()
-            findex = self.filter.options.index(self.filter.value())+1
+            result, err = task.result(), None
+        except Exception, err:
+            result = None
+        onDone(result, err)
+
+    def _starting(self):
+        """
+        Returns True, with a warning, if a run is being started. Start
+        sets the filter itself and must not have it changed before the
+        run begins.
+        """
+        if g.observe.start.pending is not None:
+            g.clog.warn('The filter wheel cannot be used while a run is ' +
+                        'being started')
+            return True
+        return False
+
+    def _go(self, *args):
+        if self._starting():
+            return
+
+        findex = self.filter.options.index(self.filter.value())+1
+        name   = g.cpars['active_filter_names'][findex-1]
+        if self._submit('moving to ' + name, self._move, (findex,),
+                        self._moved):
             g.clog.info('Moving to filter position = ' + str(findex) +
-                        ', name = ' + g.cpars['active_filter_names'][findex-1])
-            self.wheel.goto(findex)
+                        ', name = ' + name)
+
+    def _move(self, findex):
+        # the run state is checked here rather than in _go since it may
+        # need to ask the data server. Returns None during a run.
+        if drvs.isRunActive(2*g.cpars['status_poll_interval']):
+            return None
+        self.wheel.ready()
+        self.wheel.goto(findex)
+        return findex
+
+    def _moved(self, findex, err):
+        if err is None and findex is None:
+            g.clog.warn('Filter not changed as a run is active')
+            tkMessageBox.showwarning(
+                'Run active',
+                'Sorry; you cannot change filters during a run.')
+        elif err is None:
             self.current.configure(
                 text=g.cpars['active_filter_names'][findex-1])
             g.clog.info('Filter moved successfully')
-        except Exception, err:
+        else:
+            self.current.configure(text='UNKNOWN')
             g.clog.warn('Filter change failed.')
             g.clog.warn('Error: ' + str(err))
             g.clog.warn('You might want to try an "init".')
 
     def _home(self, *args):
-        g.clog.info('Homing filter wheel ...')
-        try:
-            if not self.wheel.connected:
-                self.wheel.connect()
-                self.wheel.init()
-            self.wheel.home()
+        if self._starting():
+            return
+
+        if self._submit('homing', self._homeWheel, (), self._homed):
+            g.clog.info('Homing filter wheel ...')
+
+    def _homeWheel(self):
+        self.wheel.ready()
+        self.wheel.home()
+
+    def _homed(self, result, err):
+        if err is None:
             self.current.configure(text=g.cpars['active_filter_names'][0])
             g.clog.info('Filter homed\n')
-        except Exception, err:
+        else:
+            self.current.configure(text='UNKNOWN')
             g.clog.warn('Could not home wheel.')
             g.clog.warn('Error: ' + str(err))
             g.clog.warn('You might want to try an "init".')
 
     def _init(self, *args):
-        g.clog.info('Initialising filter wheel ...')
-        try:
-            self.wheel.reboot()
+        if self._starting():
+            return
+
+        if self._submit('initialising', self.wheel.reboot, (),
+                        self._initialised):
+            g.clog.info('Initialising filter wheel ...')
+
+    def _initialised(self, result, err):
+        if err is None:
             self.current.configure(text=g.cpars['active_filter_names'][0])
             g.clog.info('Filter wheel initialised')
-        except Exception, err:
+        else:
+            self.current.configure(text='UNKNOWN')
             g.clog.warn('Could not initialise wheel.')
             g.clog.warn('Error: ' + str(err))
             g.clog.warn('You might want to try again once or twice, or stop & restart usdriver, or perhaps the wheel needs adjusting. See the online ultraspec manual.')
 
     def _close(self, *args):
         """
-        Closes the wheel, and deletes the window
+        Deletes the window. The wheel is left in serial mode, ready for
+        the next run; it is closed when usdriver exits. An operation in
+        progress carries on, but is no longer reported.
         """
-        try:
-            self.wheel.close()
-            g.clog.info('Filter wheel closed')
-        except Exception, err:
-            g.clog.warn('Problem closing wheel.')
-            g.clog.warn('Error: ' + str(err))
+        if self.afterId is not None:
+            self.after_cancel(self.afterId)
         self.destroy()
 
 
@@ -44,6 +44,8 @@ wheel   : filter wheel controller
 star_filter : filter at last press of 'Start'
 lakeshore : connection to Lakeshore CCD temperature
 logfile : file to log usdriver messages
+poller  : background poller of the server status
+tcs     : background poller of the telescope control system
 """
 
 from __future__ import print_function
@@ -94,6 +96,8 @@ TINS = {\
         'elevation'  : 2457.,     # Elevation above sea level, metres
         'app'        : 'tno.xml', # Application for the telescope
         'plateScale' : 0.452,     # Arcsecs/unbinned pixel
+        'mast'       : (25.5, 33.5, 50.0, 21.5, 73.5, 5.), # TV mast: az of
+                       # left, peak, right; alt of base, peak; margin (deg)
         'zerop'      : {\
             'u' : 22.29, # update 06/11/13
             'g' : 25.20,
@@ -168,5 +172,11 @@ start_filter = None
 # Lakeshore temperature control
 lakeshore = None
 
+# Background poller of the server status
+poller = None
+
+# Background poller of the TCS
+tcs = None
+
 # Logging file
 logfile = None
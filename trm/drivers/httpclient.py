@@ -0,0 +1,264 @@
+#!/usr/bin/env python
+
+"""
+Shared HTTP client for talking to the ATC camera, data and file servers.
+
+urllib2 builds a new opener and opens a new TCP connection for every
+request. With the status polls that usdriver makes every second or two,
+connection setup ends up dominating the latency of each poll. This module
+instead keeps persistent (HTTP/1.1 keep-alive) connections to each server
+in a small per-host pool which all the server-access routines share.
+
+Errors are raised as urllib2.URLError (or urllib2.HTTPError for replies
+with status >= 400) so that code written for urllib2 continues to work.
+
+The parameters below are taken from the configuration parameters if set::
+
+  http_timeout         : default timeout for requests, seconds
+  http_retries         : default number of retries for a failed request
+  http_backoff         : delay before the first retry (doubled for each
+                         subsequent retry), seconds
+  http_max_connections : maximum number of simultaneous connections per host
+"""
+
+from __future__ import print_function
+import httplib, urllib2, urlparse
+import socket, select, threading, time
+
+import globals as g
+
+# Defaults used if the configuration parameters are not available
+TIMEOUT         = 5.
+RETRIES         = 2
+BACKOFF         = 0.1
+MAX_CONNECTIONS = 2
+
+# Methods which can be repeated safely once they have reached the server
+IDEMPOTENT = ('GET', 'HEAD')
+
+def _cpar(name, default):
+    """
+    Returns configuration parameter 'name', or the default if the
+    parameters have not been loaded or it is not defined.
+    """
+    if g.cpars is not None and name in g.cpars:
+        return g.cpars[name]
+    return default
+
+class Response(object):
+    """
+    A completely read reply from a server. Attributes::
+
+      status  : HTTP status code (int)
+      reason  : HTTP reason phrase
+      headers : dictionary of headers, lower-case keys
+      body    : the body of the response (string)
+    """
+
+    def __init__(self, status, reason, headers, body):
+        self.status  = status
+        self.reason  = reason
+        self.headers = headers
+        self.body    = body
+
+    def read(self):
+        """
+        Returns the body, for compatibility with urllib2 responses.
+        """
+        return self.body
+
+class HostPool(object):
+    """
+    Pool of persistent connections to a single host:port. At most
+    'maxconn' connections are in use at any one time; further requests
+    wait for one to be released. Idle connections are kept for re-use,
+    and checked before re-use in case the server has closed them.
+    """
+
+    def __init__(self, host, port, maxconn):
+        self.host  = host
+        self.port  = port
+        self._idle = []
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(maxconn)
+
+    def acquire(self, timeout):
+        """
+        Gets a connection, re-using an idle one if possible. Returns
+        (conn, reused) where 'reused' is True if the connection has
+        been used before.
+        """
+        self._slots.acquire()
+        while True:
+            with self._lock:
+                conn = self._idle.pop() if self._idle else None
+            if conn is None or self._alive(conn):
+                break
+            # closed by the server while idle
+            conn.close()
+
+        if conn is None:
+            return (httplib.HTTPConnection(
+                self.host, self.port, timeout=timeout), False)
+
+        # the timeout may differ from the previous request
+        conn.timeout = timeout
+        if conn.sock is not None:
+            conn.sock.settimeout(timeout)
+        return (conn, True)
+
+    @staticmethod
+    def _alive(conn):
+        """
+        Returns False if the server has closed an idle connection. An idle
+        connection should have nothing to read, so anything readable
+        (normally the end of file) means that it cannot be used.
+        """
+        if conn.sock is None:
+            return True
+        try:
+            readable, w, x = select.select([conn.sock], [], [], 0)
+        except (select.error, socket.error):
+            return False
+        return not readable
+
+    def release(self, conn, keep):
+        """
+        Returns a connection to the pool, or closes it if keep=False
+        """
+        if keep:
+            with self._lock:
+                self._idle.append(conn)
+        else:
+            conn.close()
+        self._slots.release()
+
+    def close(self):
+        """
+        Closes all idle connections
+        """
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+class HttpClient(object):
+    """
+    HTTP client with a pool of keep-alive connections for each host.
+    Use 'client()' to get the instance shared by all of usdriver.
+    """
+
+    def __init__(self):
+        self._pools = {}
+        self._lock  = threading.Lock()
+
+    def _pool(self, host, port):
+        with self._lock:
+            key = (host, port)
+            if key not in self._pools:
+                self._pools[key] = HostPool(
+                    host, port, _cpar('http_max_connections', MAX_CONNECTIONS))
+            return self._pools[key]
+
+    def request(self, method, url, data=None, headers=None, timeout=None,
+                retries=None):
+        """
+        Sends a request and reads the reply. Arguments::
+
+          method  : 'GET' or 'POST'
+          url     : the full URL, e.g. 'http://localhost:9980/status'
+          data    : body to send with a POST
+          headers : dictionary of extra headers
+          timeout : timeout, seconds. Defaults to 'http_timeout'
+          retries : number of times to retry after a failure, with
+                    exponential backoff. Defaults to 'http_retries'. Use 0
+                    for commands that must not be repeated.
+
+        If a connection that has been used before fails before the request
+        has been sent, the request is sent again at once on a fresh
+        connection since this normally just means that the server closed an
+        idle connection. This does not count against 'retries'. Once a
+        request has been sent it is only repeated if 'retries' allows and
+        the method is one of IDEMPOTENT, since the server may have acted on
+        it.
+
+        Returns a Response. Raises urllib2.HTTPError if the status is 400 or
+        more, and urllib2.URLError for connection failures.
+        """
+        if timeout is None:
+            timeout = _cpar('http_timeout', TIMEOUT)
+        if retries is None:
+            retries = _cpar('http_retries', RETRIES)
+        backoff = _cpar('http_backoff', BACKOFF)
+
+        parts = urlparse.urlsplit(url)
+        if parts.scheme != 'http':
+            raise urllib2.URLError('unsupported URL scheme in ' + url)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        pool = self._pool(parts.hostname, parts.port or 80)
+
+        hdrs = {} if headers is None else dict(headers)
+        attempt = 0
+        while True:
+            conn, reused = pool.acquire(timeout)
+            sent = False
+            try:
+                conn.request(method, path, data, hdrs)
+                sent = True
+                resp = conn.getresponse()
+                body = resp.read()
+            except (httplib.HTTPException, socket.error), err:
+                pool.release(conn, False)
+                if reused and not sent and \
+                        not isinstance(err, socket.timeout):
+                    continue
+                if attempt >= retries or \
+                        (sent and method not in IDEMPOTENT):
+                    raise urllib2.URLError(err)
+                time.sleep(backoff*2**attempt)
+                attempt += 1
+                continue
+
+            pool.release(conn, not resp.will_close)
+            break
+
+        rhdrs = dict((k.lower(), v) for k, v in resp.getheaders())
+        if resp.status >= 400:
+            raise urllib2.HTTPError(url, resp.status, resp.reason, rhdrs, None)
+        return Response(resp.status, resp.reason, rhdrs, body)
+
+    def get(self, url, **kwargs):
+        """
+        GET request. See 'request' for the keyword arguments.
+        """
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, data, **kwargs):
+        """
+        POST request. See 'request' for the keyword arguments.
+        """
+        return self.request('POST', url, data, **kwargs)
+
+    def close(self):
+        """
+        Closes all idle connections
+        """
+        with self._lock:
+            pools = self._pools.values()
+        for pool in pools:
+            pool.close()
+
+_client = None
+_client_lock = threading.Lock()
+
+def client():
+    """
+    Returns the HttpClient shared by all users, creating it if need be.
+    """
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = HttpClient()
+        return _client
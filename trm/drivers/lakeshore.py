@@ -1,12 +1,29 @@
-import serial, os
+import serial, os, time, threading, contextlib, struct
+from collections import namedtuple
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 # error class for lakeshore
 class LakeshoreError(Exception):
     pass
 
+class Reading(namedtuple('Reading', 'time tempa tempb heater')):
+    """
+    One reading of the Lakeshore: time.time() at which it was made, the A
+    and B temperatures (K) and the heater power (%)
+    """
+    __slots__ = ()
+
 # Lakshore device serial interface
 class Lakeshore(object):
-    '''python class to communicate with the lakeshore temperature controller'''
+    '''python class to communicate with the lakeshore temperature controller
+
+    By default the port is opened and closed for each query. Within a
+    session (see 'openSession' and 'session') it is kept open. Queries are serialised with
+    a lock so one Lakeshore can be shared between threads.'''
+
     def __init__(self, port='/dev/ttyS0'):
         # create serial port object with timeout of 2 secs
         self.com = serial.Serial(port, 9600, serial.SEVENBITS, serial.PARITY_ODD, serial.STOPBITS_ONE, 2, 0, 0)
@@ -15,37 +32,89 @@ class Lakeshore(object):
         self.com.flushInput()
         self.com.flushOutput()
         self.com.close()
+        self._lock    = threading.RLock()
+        self._session = 0
 
     def shutDown(self):
         try:
-            if self.com.isOpen():
-                self.com.close()
+            with self._lock:
+                self._session = 0
+                if self.com.isOpen():
+                    self.com.close()
         except:
             raise LakeshoreError('Could not close down connection')
 
+    def openSession(self):
+        '''keeps the port open until closeSession is called. Sessions can be
+        nested or overlap between threads; the port is closed when the last
+        one ends.'''
+        with self._lock:
+            self._session += 1
+
+    def closeSession(self):
+        '''ends a session started by openSession'''
+        with self._lock:
+            self._session = max(0, self._session - 1)
+            if not self._session and self.com.isOpen():
+                self.com.close()
+
+    @contextlib.contextmanager
+    def session(self):
+        '''context manager which keeps the port open while in use, e.g.
+
+          with ls.session():
+              while True:
+                  reading = ls.read()
+        '''
+        self.openSession()
+        try:
+            yield self
+        finally:
+            self.closeSession()
+
     def _cmd(self, cmd):
         '''sends a command to the lakeshore and returns the response'''
         tmp = cmd + '\r\n'
 
-        # open if need to (should need to as it's a bad idea to leave open permanently)
-        if not self.com.isOpen():
-            self.com.open()
+        with self._lock:
+            # open if need to (should need to as it's a bad idea to leave
+            # open permanently outside a session)
+            if not self.com.isOpen():
+                self.com.open()
 
-        # flush IO buffers
-        self.com.flushInput()
-        self.com.flushOutput()
+            # flush IO buffers
+            self.com.flushInput()
+            self.com.flushOutput()
+
+            # send command to lakeshore
+            self.com.write(tmp)
+            # get response
+            rep = self.com.readline()
 
-        # send command to lakeshore
-        self.com.write(tmp)
-        # get response
-        rep = self.com.readline()
+            #close down unless in a session
+            if not self._session and self.com.isOpen():
+                self.com.close()
 
-        #close down
-        if self.com.isOpen():
-            self.com.close()
         # strip leading and trailing whitespace from response and return
         return rep.lstrip().rstrip()
 
+    def query(self, cmd):
+        '''sends a query, e.g. '*IDN?', and returns the response'''
+        return self._cmd(cmd)
+
+    def read(self):
+        '''gets both temperatures and the heater power in one go, returning
+        a Reading. The three queries are sent as one compound command
+        (queries separated by ';') and come back on one line.'''
+        try:
+            t = time.time()
+            vals = self._cmd('KRDG? A;KRDG? B;HTR?').split(';')
+            tempa, tempb, heater = [float(val) for val in vals]
+            return Reading(t, tempa, tempb, heater)
+        except:
+            e = LakeshoreError('Cannot get temperatures and heater power from lakeshore')
+            raise e
+
     def tempa(self):
         '''gets the A temperature probe value (this should be the chip temp)'''
         try:
@@ -79,47 +148,181 @@ class Lakeshore(object):
             e = LakeshoreError('Cannot get heater power from lakeshore')
             raise e
 
+# Binary log files. A 16 byte header (magic string, version, record size)
+# is followed by fixed size records of the time (UNIX seconds, float64),
+# the two temperatures and the heater power (float32), little-endian, in
+# time order.
+BINARY_MAGIC   = 'LAKEBIN\0'
+BINARY_VERSION = 1
+BINARY_HEADER  = struct.Struct('<8sII')
+BINARY_RECORD  = struct.Struct('<dfff')
+
+class BinaryLogWriter(object):
+    """
+    Appends Readings to a binary log file, which is created with its header
+    if it does not exist. The file is kept open.
+    """
+
+    def __init__(self, fname):
+        self.fname = fname
+        new = not os.path.exists(fname) or os.path.getsize(fname) == 0
+        self.fp = open(fname, 'ab')
+        if new:
+            self.fp.write(BINARY_HEADER.pack(
+                BINARY_MAGIC, BINARY_VERSION, BINARY_RECORD.size))
+            self.fp.flush()
+        else:
+            # check that we are adding to the right sort of file, and
+            # drop any partial record left by a crash
+            nrec  = len(BinaryLog(fname))
+            whole = BINARY_HEADER.size + nrec*BINARY_RECORD.size
+            if os.path.getsize(fname) != whole:
+                self.fp.truncate(whole)
+
+    def append(self, reading):
+        """
+        Adds a Reading
+        """
+        self.fp.write(BINARY_RECORD.pack(
+            reading.time, reading.tempa, reading.tempb, reading.heater))
+        self.fp.flush()
+
+    def close(self):
+        self.fp.close()
+
+class BinaryLog(object):
+    """
+    Reads a binary log file. 'latest' reads just the last record; 'range'
+    returns all records between two times using a binary search of a
+    memory map of the file, and needs numpy.
+    """
+
+    def __init__(self, fname):
+        self.fname = fname
+        with open(fname, 'rb') as fin:
+            header = fin.read(BINARY_HEADER.size)
+        if len(header) < BINARY_HEADER.size:
+            raise LakeshoreError('No header in ' + fname)
+        magic, version, recsize = BINARY_HEADER.unpack(header)
+        if magic != BINARY_MAGIC or version != BINARY_VERSION or \
+           recsize != BINARY_RECORD.size:
+            raise LakeshoreError(fname + ' is not a Lakeshore binary log')
+
+    def __len__(self):
+        """
+        Number of complete records
+        """
+        return (os.path.getsize(self.fname) - BINARY_HEADER.size) // \
+            BINARY_RECORD.size
+
+    def latest(self):
+        """
+        Returns the last Reading in the file
+        """
+        nrec = len(self)
+        if nrec == 0:
+            raise LakeshoreError('No readings in ' + self.fname)
+        with open(self.fname, 'rb') as fin:
+            fin.seek(BINARY_HEADER.size + (nrec-1)*BINARY_RECORD.size)
+            return Reading(*BINARY_RECORD.unpack(
+                fin.read(BINARY_RECORD.size)))
+
+    def range(self, t1=None, t2=None):
+        """
+        Returns a numpy structured array with fields 'time', 'tempa',
+        'tempb' and 'heater' of the readings with t1 <= time <= t2. t1 and
+        t2 default to the start and end of the file.
+        """
+        if np is None:
+            raise LakeshoreError('lakeshore.BinaryLog.range: numpy is needed')
+        dtype = np.dtype([('time','<f8'),('tempa','<f4'),('tempb','<f4'),
+                          ('heater','<f4')])
+        nrec  = len(self)
+        if nrec == 0:
+            return np.empty(0, dtype)
+        data  = np.memmap(self.fname, dtype, 'r', BINARY_HEADER.size, (nrec,))
+        times = data['time']
+        n1 = 0 if t1 is None else np.searchsorted(times, t1, 'left')
+        n2 = nrec if t2 is None else np.searchsorted(times, t2, 'right')
+        return np.array(data[n1:n2])
 
 class LakeFile(object):
     """
     Class to get temperature infor from Lakeshore log file to avoid
-    interacting via serial port
+    interacting via serial port.
+
+    The name of the newest log file is kept, and the directory is only
+    searched again when its modification time changes, i.e. when a file is
+    added or removed. The last line is found by reading backwards from
+    the end of the file so the time taken does not grow as the file does.
+    Binary log files (ending '.bin') are read with BinaryLog.
     """
 
     DDIR = '/home/observer/Lakeshore/'
 
+    # size of the blocks read from the end of the file, bytes
+    BLOCK = 1024
+
     def __init__(self):
         """
         Try to read a log file to see whether there is one
         """
+        self.dmtime = None
+        self.fname  = None
         self.temps()
 
-    def temps(self):
+    def newest(self):
         """
-        Get temperatures and heater percentage from log file in one go
+        Returns the name of the most recently modified log file
         """
+        dmtime = os.stat(LakeFile.DDIR).st_mtime
+        if self.fname is not None and dmtime == self.dmtime:
+            return self.fname
 
         # find log files
         fnames = [os.path.join(LakeFile.DDIR, fname) for fname in os.listdir(LakeFile.DDIR) \
-                      if fname.startswith('Lakeshore_log') > -1]
+                      if fname.startswith('Lakeshore_log')]
         if len(fnames) == 0:
             raise LakeshoreError('Failed to find any Lakeshore log files in ' + LakeFile.DDIR)
 
         # find most recently modified file
-        mtime_max = os.stat(fnames[0]).st_mtime
-        fname_max = fnames[0]
-        for fname in fnames[1:]:
-            mtime = os.stat(fname).st_mtime
-            if mtime > mtime_max:
-                mtime_max = mtime
-                fname_max = fname
-
-        # open it and read the last line
-        with open(fname_max) as fin:
-            for line in fin:
-                last = line
-
-        elems = last.split(',')
+        self.fname  = max(fnames, key=lambda fname: os.stat(fname).st_mtime)
+        self.dmtime = dmtime
+        return self.fname
+
+    @staticmethod
+    def lastLine(fname):
+        """
+        Returns the last complete line of a file, reading backwards from
+        the end. A final line without a newline is assumed to be still
+        being written and is skipped.
+        """
+        with open(fname, 'rb') as fin:
+            fin.seek(0, os.SEEK_END)
+            pos  = fin.tell()
+            tail = ''
+            while pos > 0:
+                nread = min(LakeFile.BLOCK, pos)
+                pos  -= nread
+                fin.seek(pos)
+                tail  = fin.read(nread) + tail
+                lines = tail.rstrip('\r\n').splitlines() \
+                    if tail.endswith('\n') else tail.splitlines()[:-1]
+                # need a newline before the last line unless at the start
+                if len(lines) > 1 or (pos == 0 and lines):
+                    return lines[-1]
+        raise LakeshoreError('No complete lines in ' + fname)
+
+    def temps(self):
+        """
+        Get temperatures and heater percentage from log file in one go
+        """
+        fname = self.newest()
+        if fname.endswith('.bin'):
+            reading = BinaryLog(fname).latest()
+            return (reading.tempa,reading.tempb,reading.heater)
+
+        elems = LakeFile.lastLine(fname).split(',')
 
         tempa  = float(elems[5])
         tempb  = float(elems[6])
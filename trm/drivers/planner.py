@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+
+"""
+Headless count rate and signal-to-noise estimates for planning.
+
+This implements the same model as the 'Count & S-to-N estimator' of
+usdriver (uspec.CountsFrame.counts) but with no reference to the GUI, and
+over numpy arrays so that many targets, filters and setups can be
+evaluated at once. All the array arguments are broadcast against each
+other. The zeropoints, sky brightness and extinction come from g.TINS,
+g.SKY and g.EXTINCTION.
+
+Setups are specified by::
+
+  xbin      : binning factor in X
+  ybin      : binning factor in Y
+  speed     : readout speed, names ('Slow', 'Medium', 'Fast') or codes
+              (0, 1, 2)
+  avalanche : True for the avalanche output
+
+and the observing conditions by::
+
+  mag       : magnitude of the target
+  seeing    : seeing FWHM, arcsec
+  airmass   : airmass
+  moon      : 'd', 'g' or 'b' for dark, grey or bright
+  filtnam   : filter, 'u', 'g', 'r', 'i' or 'z'
+
+Exposure and cycle times for a given setup can be computed with
+uspec.timingBatch. Requires numpy.
+"""
+
+from __future__ import print_function
+import math
+from collections import namedtuple
+import numpy as np
+
+import globals as g
+import uspec
+
+class Counts(namedtuple('Counts', 'total peak peakSat peakWarn ston ston3')):
+    """
+    Results of 'counts', all arrays::
+
+      total    : total number of object counts in aperture
+      peak     : peak counts in a pixel
+      peakSat  : flag to indicate saturation
+      peakWarn : flag to indication level approaching saturation
+      ston     : signal-to-noise per exposure
+      ston3    : signal-to-noise after 3 hours on target
+    """
+    __slots__ = ()
+
+_erf = np.vectorize(math.erf, otypes=[float])
+
+def _lookup(table, keys):
+    """
+    Returns an array of table[key] for each element of the array of keys
+    """
+    keys = np.asarray(keys)
+    ukeys, inverse = np.unique(keys, return_inverse=True)
+    values = np.array([table[key] for key in ukeys])
+    return values[inverse].reshape(keys.shape)
+
+def _model(mag, seeing, airmass, moon, filtnam, xbin, ybin, speed,
+           avalanche, telins, ap_scale):
+    """
+    Computes the rates which define the model, in electrons per second
+    unless stated. Returns (rate, pfrac, signal, fixed, variable, gain,
+    lnormal) where 'rate' is the total rate from the target, 'pfrac' the
+    fraction of it in the peak pixel, 'signal' the rate in the aperture, and
+    the noise squared in electrons**2 after a time t is fixed + variable*t.
+    """
+    tinfo   = g.TINS[g.cpars['telins_name'] if telins is None else telins]
+    lnormal = np.logical_not(avalanche)
+    seeing  = np.asarray(seeing, dtype=float)
+    xbin    = np.asarray(xbin, dtype=float)
+    ybin    = np.asarray(ybin, dtype=float)
+
+    speed = np.asarray(speed)
+    if speed.dtype.kind in 'SU':
+        speed = _lookup(dict((s, n) for n, s in enumerate(uspec.SPEEDS)),
+                        speed)
+
+    # GAIN, RNO
+    gain = np.where(lnormal, np.take(uspec.GAIN_NORM, speed),
+                    np.take(uspec.GAIN_AV, speed))
+    read = np.where(lnormal, np.take(uspec.RNO_NORM, speed),
+                    np.take(uspec.RNO_AV, speed))
+
+    # zeropoint, extinction and sky
+    zero = _lookup(tinfo['zerop'], filtnam)
+    ext  = _lookup(g.EXTINCTION, filtnam)
+    moon, filtnam = np.broadcast_arrays(np.asarray(moon), np.asarray(filtnam))
+    sky  = np.full(moon.shape, np.nan)
+    for mkey, msky in g.SKY.iteritems():
+        for fkey, value in msky.iteritems():
+            sky[(moon == mkey) & (filtnam == fkey)] = value
+    missing = np.isnan(sky)
+    if missing.any():
+        raise ValueError('no sky brightness for moon = ' +
+                         repr(moon[missing][0]) + ', filter = ' +
+                         repr(filtnam[missing][0]))
+
+    plateScale = tinfo['plateScale']
+
+    # expected electrons from the target
+    rate = 10.**((zero-mag-airmass*ext)/2.5)
+
+    # fraction that falls in central pixel, integrated exactly as in
+    # uspec.peakFraction
+    scale = 2.*math.sqrt(2.)*seeing/g.EFAC/plateScale
+    pfrac = _erf(xbin/scale)*_erf(ybin/scale)
+
+    # Work out fraction of flux in aperture with radius ap_scale*seeing
+    correct = 1. - math.exp(-(g.EFAC*ap_scale)**2/2.)
+
+    # expected sky e- per arcsec
+    skyPerArcsec = 10.**((zero-sky)/2.5)
+    narcsec      = math.pi*(ap_scale*seeing)**2
+    npix         = math.pi*(ap_scale*seeing/plateScale)**2/xbin/ybin
+
+    signal  = correct*rate
+    readTot = npix*read**2
+    varying = npix*uspec.DARK_E + skyPerArcsec*narcsec + signal
+
+    # noise. Assume high gain observations in proportional mode for the
+    # avalanche output.
+    fixed    = np.where(lnormal, readTot,
+                        readTot/uspec.AVALANCHE_GAIN_9**2 + uspec.CIC)
+    variable = np.where(lnormal, 1., 2.)*varying
+
+    return (rate, pfrac, signal, fixed, variable, gain, lnormal)
+
+def counts(mag, seeing, airmass, moon, filtnam, expTime, cycleTime=None,
+           xbin=1, ybin=1, speed='Slow', avalanche=False, telins=None,
+           ap_scale=1.6):
+    """
+    Computes total and peak counts, saturation flags and signal-to-noise
+    for arrays of targets, conditions and setups. See the module
+    documentation for most of the arguments.
+
+      expTime   : exposure time per frame (seconds)
+      cycleTime : sampling, cadence (seconds). Defaults to expTime
+      telins    : telescope/instrument, a key of g.TINS. Defaults to the
+                  configuration parameter 'telins_name'
+      ap_scale  : aperture radius as multiple of seeing
+
+    Returns a Counts.
+    """
+    rate, pfrac, signal, fixed, variable, gain, lnormal = \
+        _model(mag, seeing, airmass, moon, filtnam, xbin, ybin, speed,
+               avalanche, telins, ap_scale)
+
+    expTime   = np.asarray(expTime, dtype=float)
+    cycleTime = expTime if cycleTime is None else \
+        np.asarray(cycleTime, dtype=float)
+
+    # convert from electrons to counts
+    total = rate*expTime/gain
+    peak  = total*pfrac
+
+    noise = np.sqrt(fixed + variable*expTime)
+    ston  = signal*expTime/noise
+    ston3 = ston*np.sqrt(3*3600./cycleTime)
+
+    # saturation levels; see CountsFrame.counts
+    sat  = np.where(lnormal, 60000.,
+                    uspec.AVALANCHE_SATURATE/uspec.AVALANCHE_GAIN_9/5/gain)
+    warn = np.where(lnormal, 25000.,
+                    uspec.AVALANCHE_SATURATE/uspec.AVALANCHE_GAIN_9/3/gain)
+
+    return Counts(total, peak, peak > sat, peak > warn, ston, ston3)
+
+def exposureForSN(ston, mag, seeing, airmass, moon, filtnam, xbin=1, ybin=1,
+                  speed='Slow', avalanche=False, telins=None, ap_scale=1.6):
+    """
+    Returns the shortest exposure time per frame (seconds) that reaches a
+    signal-to-noise 'ston' in one frame. See 'counts' for the other
+    arguments.
+
+    With signal S*t and noise**2 N0 + B*t, the signal-to-noise reaches
+    'ston' when t is the positive root of the quadratic
+    S**2*t**2 - ston**2*B*t - ston**2*N0 = 0.
+    """
+    rate, pfrac, signal, fixed, variable, gain, lnormal = \
+        _model(mag, seeing, airmass, moon, filtnam, xbin, ybin, speed,
+               avalanche, telins, ap_scale)
+
+    s2 = np.asarray(ston, dtype=float)**2
+    return (s2*variable + np.sqrt((s2*variable)**2 + 4.*signal**2*s2*fixed)) \
+        / (2.*signal**2)
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+
+"""
+Background polling of the ATC camera, data and file servers.
+
+Several widgets need to know whether a run is active, which run it is
+and how many frames it has. Rather than each of them querying the servers
+from the Tk main thread (which freezes the GUI whenever a server is slow
+to respond), a single StatusPoller thread makes the queries and publishes
+the results as a Status snapshot. Widgets read 'g.poller.snapshot' which
+never blocks.
+
+The interval between polls is set by the configuration parameter
+'status_poll_interval'.
+"""
+
+from __future__ import print_function
+import threading, time, urllib2
+from collections import namedtuple
+
+import globals as g
+import drivers as drvs
+
+# Default interval between polls, seconds
+INTERVAL = 1.0
+
+class Status(namedtuple('Status', 'time active run nframe error')):
+    """
+    Snapshot of the server status. Attributes::
+
+      time   : time.time() at which the poll finished
+      active : True if a run is active, False if not, None if unknown
+      run    : current run number, None if unknown
+      nframe : number of frames in the current run, None if unknown
+      error  : message from the last failure, None if all was well
+    """
+    __slots__ = ()
+
+# initial state, before anything is known
+UNKNOWN = Status(0., None, None, None, None)
+
+class StatusPoller(threading.Thread):
+    """
+    Thread which polls the servers every 'status_poll_interval' seconds,
+    or sooner if 'refresh' is called. Requests for a refresh made while a
+    poll is pending are merged into that one poll.
+    """
+
+    def __init__(self):
+        threading.Thread.__init__(self, name='StatusPoller')
+        self.daemon   = True
+        self.snapshot = UNKNOWN
+        self._wake    = threading.Event()
+        self._halt    = threading.Event()
+
+    def refresh(self):
+        """
+        Asks for a poll to be made as soon as possible, e.g. after a run
+        has been started or stopped.
+        """
+        self._wake.set()
+
+    def stop(self):
+        """
+        Stops the thread at the end of the current poll
+        """
+        self._halt.set()
+        self._wake.set()
+
+    def run(self):
+        while not self._halt.is_set():
+            interval = g.cpars.get('status_poll_interval', INTERVAL)
+            self._wake.wait(interval)
+            self._wake.clear()
+            if not self._halt.is_set():
+                self.snapshot = self.poll(self.snapshot)
+
+    def poll(self, last):
+        """
+        Queries the servers and returns a new Status. 'last' is the
+        previous Status which is used to track the run number while a run
+        is active, when the data server cannot be asked for it.
+        """
+        if not g.cpars['cdf_servers_on']:
+            return Status(time.time(), None, None, None,
+                          'servers are not active')
+
+        try:
+            active = drvs.isRunActive()
+        except Exception, err:
+            return Status(time.time(), None, last.run, last.nframe, str(err))
+
+        if not g.cpars['servers_initialised']:
+            return Status(time.time(), active, None, None, None)
+
+        run, nframe, error = last.run, None, None
+        try:
+            if not active:
+                run = drvs.getRunNumber(True)
+            elif last.active is False and last.run is not None:
+                # run has just started
+                run = last.run + 1
+            elif run is None:
+                run = drvs.getRunFromDirectory()
+        except Exception, err:
+            error = 'Error trying to set run: ' + str(err)
+
+        if run is not None:
+            try:
+                nframe = drvs.getFrameNumber(run)
+            except urllib2.HTTPError, err:
+                if err.code == 404:
+                    nframe = 0
+                else:
+                    error = 'Error trying to set frame: ' + str(err)
+            except Exception, err:
+                error = 'Error trying to set frame: ' + str(err)
+
+        return Status(time.time(), active, run, nframe, error)
@@ -7,7 +7,7 @@ Written by Stu.
 """
 
 from __future__ import print_function
-import serial, struct, threading, time
+import serial, struct, threading, time, contextlib
 import Tkinter as tk
 import drivers as drvs
 import globals as g
@@ -80,6 +80,29 @@ MIN_TIMEOUT      = 2
 MAX_TIMEOUT      = 70
 
 class Slide(object):
+    """
+    Talks to the slide over a serial port. Commands and replies are 6-byte
+    packets. Access is serialised with a lock so that the slide can be used
+    from several threads. Commands other than 'stop' are refused rather
+    than kept waiting while the slide moves. By default the port is opened and closed for each
+    exchange of packets; within a session (see 'openSession' and
+    'session') it is kept open. Several packets can be sent in one go with
+    '_transact'.
+
+    Whether the slide has been homed is remembered once it is known to
+    be True, until a reset or restore, or until 'forget' is called. This
+    is done automatically if a command fails, or if the slide sends
+    anything it was not asked for, since either may mean that it has been
+    switched off and on.
+
+    The position is also remembered, from the replies to commands which
+    move the slide, which report where it ended up. It is forgotten while
+    the slide moves and after a reset or restore, and is not used while
+    manual adjustment (the potentiometer) is enabled. Position reads when
+    the slide is known to be stationary need no traffic with the slide,
+    except for 'report_position' (the 'position' button) which always asks
+    the slide so that it can be used to check it.
+    """
 
     def __init__(self,log=None,port='/dev/slide'):
         """
@@ -97,6 +120,13 @@ class Slide(object):
             self.log = drvs.Logger('SLD') 
         else:
             self.log = log
+        self.moving   = False
+        self._stopped = False
+        self._homed   = False
+        self._manual  = None
+        self._position = None
+        self._session = 0
+        self._lock    = threading.RLock()
 
     def _open_port(self):
         try:
@@ -112,11 +142,77 @@ class Slide(object):
         except Exception as e:
             raise SlideError(e)
 
+    def openSession(self):
+        """
+        Keeps the port open until closeSession is called. Sessions can be
+        nested; the port is closed when the last one ends.
+        """
+        with self._lock:
+            self._session += 1
+
+    def closeSession(self):
+        """
+        Ends a session started by openSession
+        """
+        with self._lock:
+            self._session = max(0, self._session - 1)
+            if not self._session and self.connected:
+                self._close_port()
+
+    @contextlib.contextmanager
+    def session(self):
+        """
+        Context manager which keeps the port open while in use
+        """
+        self.openSession()
+        try:
+            yield self
+        finally:
+            self.closeSession()
+
+    @contextlib.contextmanager
+    def _locked(self):
+        """
+        Context manager which holds the lock, raising a SlideError rather
+        than waiting if another thread holds it for a move, which can take
+        over a minute.
+        """
+        while not self._lock.acquire(False):
+            if self.moving:
+                raise SlideError('the slide is moving; wait for it to ' +
+                                 'finish or press "stop"')
+            time.sleep(0.005)
+        try:
+            yield
+        finally:
+            self._lock.release()
+
+    def forget(self):
+        """
+        Forgets whether the slide has been homed, e.g. after it has been
+        switched off and on.
+        """
+        with self._locked():
+            self._homed    = False
+            self._position = None
+            self._manual   = None
+
+    def _discardInput(self):
+        """
+        Discards anything waiting to be read. Since every reply is read by
+        the command that asked for it, anything left means that the slide
+        did something unasked, or that an earlier command failed, so what
+        is known about it is forgotten as well.
+        """
+        if self.connected and self.ser.inWaiting():
+            self.ser.flushInput()
+            self.forget()
+
     def _sendByteArr(self,byteArr,timeout):
         if self.connected:
             self.ser.timeout = timeout
             bytes_sent = self.ser.write(byteArr)
-            if bytes_sent != 6:
+            if bytes_sent != len(byteArr):
                 raise SlideError('failed to send bytes to slide')
         else:
             raise SlideError('cannot send bytes to an unconnected slide')
@@ -132,6 +228,100 @@ class Slide(object):
         else:
             raise SlideError('cannot send bytes to an unconnected slide')
 
+    def _transact(self,byteArrs,timeout=None):
+        """
+        Sends one or more 6-byte commands back-to-back and returns their
+        replies, in order. timeout is the time to wait for each reply
+        (default_timeout if not set).
+        """
+        if timeout is None:
+            timeout = self.default_timeout
+        with self._locked():
+            if not self.connected:
+                self._open_port()
+            try:
+                self._discardInput()
+                self._sendByteArr(bytearray().join(byteArrs),
+                                  self.default_timeout)
+                return [self._readBytes(timeout) for byteArr in byteArrs]
+            except:
+                self.forget()
+                raise
+            finally:
+                if not self._session and self.connected:
+                    self._close_port()
+
+    def _move(self,byteArr,timeout):
+        """
+        Sends a command which moves the slide and waits for the reply,
+        up to timeout seconds. 'moving' is True meanwhile. The position
+        in the reply is remembered.
+
+        'stop' may send a STOP meanwhile from another thread, so the
+        replies are told apart by their command bytes and that to the
+        STOP is read here too. Returns the reply to the move, or to the
+        STOP if the move did not send one.
+        """
+        with self._locked():
+            self.moving    = True
+            self._stopped  = False
+            self._position = None
+            try:
+                if not self.connected:
+                    self._open_port()
+                try:
+                    self._discardInput()
+                    self._sendByteArr(byteArr,self.default_timeout)
+                    byteArr = self._awaitMove(timeout)
+                except:
+                    self.forget()
+                    raise
+                finally:
+                    if not self._session and self.connected:
+                        self._close_port()
+                self._remember(byteArr)
+                return byteArr
+            finally:
+                self.moving = False
+
+    def _awaitMove(self,timeout):
+        """
+        reads the replies to a move and to any STOP sent while it is
+        under way
+        """
+        moveReply = stopReply = None
+        while moveReply is None:
+            if stopReply is None:
+                reply = self._readBytes(timeout)
+            else:
+                # stopped; any reply to the move comes straight away
+                try:
+                    reply = self._readBytes(self.default_timeout)
+                except SlideError:
+                    break
+            if reply[1] == STOP:
+                stopReply = reply
+            else:
+                moveReply = reply
+
+        if self._stopped and stopReply is None:
+            # the move finished before the STOP arrived
+            try:
+                stopReply = self._readBytes(self.default_timeout)
+            except SlideError:
+                pass
+        return stopReply if moveReply is None else moveReply
+
+    def _remember(self,byteArr):
+        """
+        remembers the position from the reply to a move, home, stop or
+        position command
+        """
+        if byteArr[1] == ERROR:
+            self._position = None
+        else:
+            self._position = self._decodeCommandData(byteArr)
+
     def _decodeCommandData(self,byteArr):
         return struct.unpack('<L',byteArr[2:])[0]
 
@@ -158,41 +348,65 @@ class Slide(object):
         timeout = timeout if timeout < MAX_TIMEOUT else MAX_TIMEOUT
         return timeout
 
-    def _getPosition(self):
-        """
-        returns current position of the slide in microsteps
-        """
-        if not self._hasBeenHomed():
-            raise SlideError('position of slide is undefined until slide homed')
-        if not self.connected:
-            self._open_port()
-        byteArr = self._encodeByteArr([UNIT,POSITION,NULL,NULL,NULL,NULL])
-        self._sendByteArr(byteArr,self.default_timeout)
-        byteArr = self._readBytes(timeout=self.default_timeout)
-        self._close_port()
-        pos = self._decodeCommandData(byteArr)
+    def _getPosition(self,verify=False):
+        """
+        returns current position of the slide in microsteps. The
+        remembered position is used if possible unless verify=True, when
+        the slide is asked for its position and whether it has been homed.
+        """
+        if self.moving:
+            raise SlideError('position of slide is undefined while it moves')
+
+        position = self._encodeByteArr([UNIT,POSITION,NULL,NULL,NULL,NULL])
+        with self._locked():
+            self._discardInput()
+            if not verify and self._homed and self._manual is False and \
+               self._position is not None:
+                return self._position
+            elif not verify and self._homed:
+                byteArr = self._transact([position])[0]
+            else:
+                # ask whether it has been homed at the same time
+                setting, byteArr = self._transact(
+                    [self._settingByteArr(), position])
+                if not self._checkHomed(setting):
+                    self._position = None
+                    raise SlideError(
+                        'position of slide is undefined until slide homed')
+            self._remember(byteArr)
+            pos = self._decodeCommandData(byteArr)
         return pos
 
-    def _hasBeenHomed(self):
+    def _settingByteArr(self):
+        return self._encodeByteArr([UNIT,RETURN_SETTING,
+                                    SET_MODE,NULL,NULL,NULL])
+
+    def _checkHomed(self,byteArr):
         """
-        returns true if the slide has been homed and has a calibrated
-        position
+        interprets the reply to a request for the mode setting, returning
+        True if the slide has been homed
         """
-        if not self.connected:
-            self._open_port()
-        byteArr = self._encodeByteArr([UNIT,RETURN_SETTING,
-                                       SET_MODE,NULL,NULL,NULL])
-        self._sendByteArr(byteArr,self.default_timeout)
-        byteArr = self._readBytes(timeout=self.default_timeout)
-        self._close_port()
         if byteArr[1] == ERROR:
             raise SlideError('Error trying to get the setting byte')
 
+        # if 4th bit is set manual adjustment is disabled
+        self._manual = not (byteArr[2] & POTENTIOM_OFF)
+
         # if 7th bit is set, we have been homed
-        if byteArr[2] & 128:
-            return True
-        else:
-            return False
+        self._homed = bool(byteArr[2] & 128)
+        return self._homed
+
+    def _hasBeenHomed(self):
+        """
+        returns true if the slide has been homed and has a calibrated
+        position
+        """
+        if self.moving:
+            raise SlideError('cannot check the slide while it moves')
+        with self._locked():
+            if self._homed:
+                return True
+            return self._checkHomed(self._transact([self._settingByteArr()])[0])
 
     def _move_absolute(self,nstep,timeout=None):
         """
@@ -203,7 +417,7 @@ class Slide(object):
                                  " which is out of range %d to %d" %
                              (nstep,MIN_MS,MAX_MS) )
         if not timeout:
-            timeout = time_absolute(nstep)
+            timeout = self.compute_timeout(nstep-self._getPosition())
 
         # encode command bytes into bytearray
         byteArr = self._encodeCommandData(nstep)
@@ -211,11 +425,7 @@ class Slide(object):
         # add bytes to define instruction at start of array
         byteArr.insert(0,chr(MOVE_ABSOLUTE))
         byteArr.insert(0,chr(UNIT))
-        if not self.connected:
-            self._open_port()
-        self._sendByteArr(byteArr,self.default_timeout)
-        byteArr = self._readBytes(timeout=timeout)
-        self._close_port()
+        byteArr = self._move(byteArr,timeout)
 
     def _move_relative(self,nstep,timeout=None):
         """
@@ -238,11 +448,7 @@ class Slide(object):
         # add bytes to define instruction at start of array
         byteArr.insert(0,chr(MOVE_RELATIVE))
         byteArr.insert(0,chr(UNIT))
-        if not self.connected:
-            self._open_port()
-        self._sendByteArr(byteArr,self.default_timeout)
-        byteArr = self._readBytes(timeout=timeout)
-        self._close_port()
+        byteArr = self._move(byteArr,timeout)
 
     def _convert_to_microstep(self, amount, units):
         """"
@@ -257,16 +463,18 @@ class Slide(object):
         elif units.upper() == 'PX':
             nstep = MIN_MS + int( (MAX_MS-MIN_MS)*
                                   (amount-MIN_PX) / (MAX_PX-MIN_PX) + 0.5 )
-        elif units.upper() == 'MS':
+        elif units.upper() == 'MM':
             nstep = MIN_MS + int( (MAX_MS-MIN_MS)*
                                   (amount-MIN_MM) / (MAX_MM-MIN_MM) + 0.5 )
         return nstep
 
-    def time_absolute(self, nstep, units):
+    def time_absolute(self, amount, units):
         """
-        Returns estimate of time to carry out a move to absolute value nstep
-        Have to separate this from because of threading issues.
+        Returns estimate of time to carry out a move to absolute value amount
+        in the given units. Have to separate this from because of threading
+        issues.
         """
+        nstep = self._convert_to_microstep(amount, units)
         start_pos = self._getPosition()
         return self.compute_timeout(nstep-start_pos)
 
@@ -292,13 +500,10 @@ class Slide(object):
             timeout = self.time_home()
 
         byteArr = self._encodeByteArr([UNIT,HOME,NULL,NULL,NULL,NULL])
-        if not self.connected:
-            self._open_port()
-        self._sendByteArr(byteArr,self.default_timeout)
-        byteArr = self._readBytes(timeout=timeout)
-        self._close_port()
+        byteArr = self._move(byteArr,timeout)
         if byteArr[1] == ERROR:
             raise SlideError('Error occurred setting to the home position')
+        self._homed = True
         self.log.info('Slide returned to home position ' +
                       '(click "position" to confirm)')
 
@@ -309,11 +514,9 @@ class Slide(object):
         needed
         """
         byteArr = self._encodeByteArr([UNIT,RESET,NULL,NULL,NULL,NULL])
-        if not self.connected:
-            self._open_port()
-        self._sendByteArr(byteArr,self.default_timeout)
-        byteArr = self._readBytes(timeout=self.default_timeout)
-        self._close_port()
+        with self._locked():
+            self.forget()
+            byteArr = self._transact([byteArr])[0]
         return byteArr
 
     def restore(self):
@@ -323,11 +526,9 @@ class Slide(object):
         """
         byteArr = self._encodeByteArr([UNIT,RESTORE,PERIPHERAL_ID,
                                        NULL,NULL,NULL])
-        if not self.connected:
-            self._open_port()
-        self._sendByteArr(byteArr,self.default_timeout)
-        byteArr = self._readBytes(timeout=self.default_timeout)
-        self._close_port()
+        with self._locked():
+            self.forget()
+            byteArr = self._transact([byteArr])[0]
         self.log.info('finished restore')
         return byteArr
 
@@ -338,11 +539,10 @@ class Slide(object):
         """
         byteArr = self._encodeByteArr([UNIT,SET_MODE,POTENTIOM_OFF,
                                        NULL,NULL,NULL])
-        if not self.connected:
-            self._open_port()
-        self._sendByteArr(byteArr,self.default_timeout)
-        byteArr = self._readBytes(timeout=self.default_timeout)
-        self._close_port()
+        with self._locked():
+            byteArr = self._transact([byteArr])[0]
+            if byteArr[1] != ERROR:
+                self._manual = False
         self.log.info('manual adjustment disabled')
         return byteArr
 
@@ -353,22 +553,27 @@ class Slide(object):
         """
         byteArr = self._encodeByteArr([UNIT,SET_MODE,POTENTIOM_ON,
                                        NULL,NULL,NULL])
-        if not self.connected:
-            self._open_port()
-        self._sendByteArr(byteArr,self.default_timeout)
-        byteArr = self._readBytes(timeout=self.default_timeout)
-        self._close_port()
+        with self._locked():
+            self._manual = True
+            byteArr = self._transact([byteArr])[0]
         self.log.info('manual adjustment enabled')
         return byteArr
 
     def stop(self):
         """stop the slide"""
         byteArr = self._encodeByteArr([UNIT,STOP,NULL,NULL,NULL,NULL])
-        if not self.connected:
-            self._open_port()
-        self._sendByteArr(byteArr,self.default_timeout)
-        byteArr = self._readBytes(timeout=self.default_timeout)
-        self._close_port()
+        if self.moving:
+            # the port is held open and read by the thread waiting for
+            # the move to finish, which will get the reply. Only write,
+            # without the lock or changing the port's timeout.
+            self._stopped = True
+            if self.ser.write(byteArr) != len(byteArr):
+                raise SlideError('failed to send bytes to slide')
+            self.log.info('stop sent to moving slide')
+            return
+        with self._locked():
+            byteArr = self._transact([byteArr])[0]
+            self._remember(byteArr)
         if byteArr[1] == ERROR:
             raise SlideError('Error stopping the slide')
         else:
@@ -403,22 +608,23 @@ class Slide(object):
         self.log.info('Moved slide to ' + str(amount) + ' ' + units +
                           ' (click "position" to confirm)')
 
-    def return_position(self):
+    def return_position(self,verify=False):
         """
         Returns position in microsteps, mm and pixels. Returns
-        (ms,mm,px)
+        (ms,mm,px). The remembered position is returned if there is one,
+        unless verify=True.
         """
-        pos_ms = self._getPosition()
+        pos_ms = self._getPosition(verify)
         pos_mm = MIN_MM + (MAX_MM-MIN_MM)*(pos_ms-MIN_MS)/(MAX_MS-MIN_MS)
         pos_px = MIN_PX + (MAX_PX-MIN_PX)*(pos_ms-MIN_MS)/(MAX_MS-MIN_MS)
         return (pos_ms, pos_mm, pos_px)
 
     def report_position(self):
         """
-        Reports position in microsteps, mm and pixels. Returns
-        (ms,mm,px)
+        Reports position in microsteps, mm and pixels, as read from the
+        slide. Returns (ms,mm,px)
         """
-        pos_ms,pos_mm,pos_px = self.return_position()
+        pos_ms,pos_mm,pos_px = self.return_position(verify=True)
         self.log.info('Current position = {0:6.1f} pixels'.format(pos_px))
 
 class FocalPlaneSlide(tk.LabelFrame):
@@ -482,6 +688,9 @@ class FocalPlaneSlide(tk.LabelFrame):
         self.where = 'UNDEF'
         self.slide = Slide(self.log)
 
+        # keep the port open rather than opening it for every command
+        self.slide.openSession()
+
     def setExpertLevel(self):
         """
         Modifies widget according to expertise level, which in this
@@ -1,13 +1,85 @@
 """
 TCS access routines
+
+The TCS is polled in the background by a TcsClient (g.tcs) which keeps the
+latest sample and a short history of recent ones. The GUI and 'Start' read
+these rather than querying the TCS themselves. Requires numpy.
 """
 
 from __future__ import print_function
-import urllib2
-import json
-import math
+import json, ast
+import math, time, threading
+from collections import namedtuple
+import numpy as np
+
+import globals as g
+import httpclient
+
+# TNT TCS access
+
+#   url = \
+#    'http://192.168.20.190/TCSDataSharing/DataRequest.asmx/GetTelescopeData'
+# New URL as of 28 Nov 2016 (after e-mail from Pakawat Prasit)
+TNT_URL = 'http://192.168.20.190:8094/TCSDataSharing/TCSHosting'
+
+# Defaults used if the configuration parameters are not available
+INTERVAL = 2.
+TIMEOUT  = 2.
 
-def getTntTcs():
+# Number of samples kept by TcsClient, and default period over which
+# the drift rates are computed, seconds
+NHISTORY = 64
+WINDOW   = 60.
+
+# Rotator limits, degrees of engineering PA
+ENGPA_MIN = -220.
+ENGPA_MAX = 250.
+
+class TcsError(Exception):
+    pass
+
+class Sample(namedtuple('Sample', 'time ra dec pa focus tflag engpa')):
+    """
+    One reading of the TCS. Attributes::
+
+      time   : time.time() at which it was received
+      ra     : RA, degrees (float)
+      dec    : Declination, degrees (float)
+      pa     : position angle, degrees (float), 0 to 360
+      focus  : focus, mm (float)
+      tflag  : tracking status string returned by the TCS
+      engpa  : engineering PA, degrees (float)
+    """
+    __slots__ = ()
+
+def parseTntTcs(string):
+    """
+    Interprets the reply of the TNT TCS, which is a JSON string holding
+    a Python-style list of lists. Returns (ra,dec,posang,focus,tflag,engpa);
+    see getTntTcs.
+    """
+    jsonData = json.loads(string)
+    try:
+        # it is usually valid JSON as well, which is quicker
+        listData = json.loads(jsonData)
+    except ValueError:
+        listData = ast.literal_eval(jsonData)
+    ignore,ra,dec,pa,focus,tracking,engpa = listData[0]
+
+    ra     = math.degrees(float(ra))
+    dec    = math.degrees(float(dec))
+    pa     = math.degrees(float(pa))
+    if pa < 0:
+        pa += 360.
+    elif pa >= 360.:
+        pa -= 360.
+    focus  = 1000.*float(focus)
+    tracking = str(tracking)
+    engpa  = math.degrees(float(engpa))
+
+    return (ra,dec,pa,focus,tracking,engpa)
+
+def getTntTcs(timeout=TIMEOUT):
     """
     Accesses TCS on TNT. Returns (ra,dec,posang,focus,tflag)
     where::
@@ -23,33 +95,190 @@ def getTntTcs():
       engpa  : PA, degrees, related to instrument position. Not quite
                sure what it refers to but it runs from -220 to +250 deg.
                (float)
+
+    This makes a request to the TCS each time; the GUI should use
+    g.tcs instead.
     """
+    response = httpclient.client().get(
+        TNT_URL, timeout=timeout, retries=0,
+        headers={'content-type':'application/json'})
+    return parseTntTcs(response.read())
 
-    # TNT TCS access
+class Drift(namedtuple('Drift', 'nsample span raRate decRate jitter paRate '
+                       'engpaRate toLimit')):
+    """
+    Rates of change of the TCS position, from straight line fits to
+    recent samples. Attributes::
 
-    #   url = \
-    #    'http://192.168.20.190/TCSDataSharing/DataRequest.asmx/GetTelescopeData'
-    # New URL as of 28 Nov 2016 (after e-mail from Pakawat Prasit)
-    url = 'http://192.168.20.190:8094/TCSDataSharing/TCSHosting'
+      nsample   : number of samples used
+      span      : time between the first and last of them, seconds
+      raRate    : rate of change of RA, arcsec (on the sky) per minute
+      decRate   : rate of change of Dec, arcsec per minute
+      jitter    : RMS scatter of RA and Dec about the fits, arcsec
+      paRate    : rate of change of PA, degrees per minute
+      engpaRate : rate of change of engineering PA, degrees per minute
+      toLimit   : minutes until the rotator limit at the current rate,
+                  None if the engineering PA is not changing
+    """
+    __slots__ = ()
 
-    # get data from server
-    req = urllib2.Request(url,headers={'content-type':'application/json'})
-    response = urllib2.urlopen(req,timeout=2)
-    string   = response.read()
+class TcsHistory(object):
+    """
+    The last 'size' TCS samples held in an array which is used as a ring
+    buffer so that adding a sample takes the same time however many are
+    held. Thread safe.
+    """
 
-    # interpret it
-    jsonData = json.loads(string)
-    listData = eval(jsonData)
-    ignore,ra,dec,pa,focus,tracking,engpa = listData[0]
+    # columns of the array
+    TIME, RA, DEC, PA, FOCUS, ENGPA, TFLAG = range(7)
 
-    ra     = math.degrees(float(ra))
-    dec    = math.degrees(float(dec))
-    pa     = math.degrees(float(pa))
-    if pa < 0:
-        pa += 360.
-    elif pa >= 360.:
-        pa -= 360.
-    focus  = 1000.*float(focus)
-    engpa  = math.degrees(float(engpa))
+    def __init__(self, size=NHISTORY):
+        self._data  = np.empty((size, 7))
+        self._next  = 0
+        self._count = 0
+        self._lock  = threading.Lock()
 
-    return (ra,dec,pa,focus,tracking,engpa)
+    def __len__(self):
+        return self._count
+
+    def append(self, sample):
+        """
+        Adds a Sample, over-writing the oldest if full
+        """
+        with self._lock:
+            self._data[self._next] = (
+                sample.time, sample.ra, sample.dec, sample.pa, sample.focus,
+                sample.engpa, 'track' in sample.tflag.lower())
+            self._next   = (self._next + 1) % len(self._data)
+            self._count  = min(self._count + 1, len(self._data))
+
+    def rows(self, window=None):
+        """
+        Returns a copy of the samples as a 2D array, oldest first, with
+        columns TIME, RA etc. If window is set, only the samples taken
+        within window seconds of the last are returned.
+        """
+        with self._lock:
+            rows = np.roll(self._data, -self._next, axis=0)
+            rows = rows[len(rows)-self._count:]
+        if window is not None and len(rows):
+            rows = rows[rows[:,self.TIME] >= rows[-1,self.TIME]-window]
+        return rows
+
+    def drift(self, window=None):
+        """
+        Returns a Drift computed from the samples of the last window
+        seconds (default 'tcs_stats_window'), or None if there are fewer
+        than three.
+        """
+        if window is None:
+            window = g.cpars.get('tcs_stats_window', WINDOW)
+        rows = self.rows(window)
+        if len(rows) < 3:
+            return None
+
+        last = rows[-1]
+        t    = (rows[:,self.TIME] - last[self.TIME])/60.
+        cdec = math.cos(math.radians(last[self.DEC]))
+
+        # offsets from the last sample, wrapping angles
+        dra  = 3600.*cdec*((rows[:,self.RA]-last[self.RA]+180.) % 360. - 180.)
+        ddec = 3600.*(rows[:,self.DEC]-last[self.DEC])
+        dpa  = (rows[:,self.PA]-last[self.PA]+180.) % 360. - 180.
+        deng = rows[:,self.ENGPA]-last[self.ENGPA]
+
+        # straight line fits to all four at once
+        A = np.column_stack((t, np.ones_like(t)))
+        coeffs, resid, rank, sv = np.linalg.lstsq(
+            A, np.column_stack((dra, ddec, dpa, deng)), rcond=-1)
+        if rank < 2:
+            return None
+        model  = A.dot(coeffs)
+        jitter = math.sqrt(((dra-model[:,0])**2 +
+                            (ddec-model[:,1])**2).mean())
+
+        raRate, decRate, paRate, engpaRate = coeffs[0]
+        engpa = last[self.ENGPA]
+        if engpaRate > 1.e-4:
+            toLimit = max(0., (ENGPA_MAX - engpa)/engpaRate)
+        elif engpaRate < -1.e-4:
+            toLimit = max(0., (ENGPA_MIN - engpa)/engpaRate)
+        else:
+            toLimit = None
+
+        return Drift(len(rows), -t[0]*60., raRate, decRate, jitter,
+                     paRate, engpaRate, toLimit)
+
+class TcsClient(threading.Thread):
+    """
+    Thread which polls the TCS every 'tcs_poll_interval' seconds. The
+    latest Sample is 'latest' (None until one arrives) and the message from
+    the last failure is 'error' (None if the last poll worked). 'history'
+    is a TcsHistory of recent samples which is used to judge whether the
+    telescope is tracking and how fast it is drifting.
+    """
+
+    def __init__(self):
+        threading.Thread.__init__(self, name='TcsClient')
+        self.daemon  = True
+        self.latest  = None
+        self.error   = None
+        self.history = TcsHistory()
+        self._halt   = threading.Event()
+
+    def stop(self):
+        """
+        Stops the thread after the current poll
+        """
+        self._halt.set()
+
+    def run(self):
+        while not self._halt.is_set():
+            interval = g.cpars.get('tcs_poll_interval', INTERVAL)
+            if g.cpars['tcs_on'] and g.cpars['telins_name'] == 'TNO-USPEC':
+                try:
+                    sample = Sample(time.time(), *getTntTcs())
+                    self.history.append(sample)
+                    self.latest = sample
+                    self.error  = None
+                except Exception, err:
+                    self.error = str(err)
+            self._halt.wait(interval)
+
+    def sample(self, maxage=None):
+        """
+        Returns the latest Sample. Raises a TcsError if there is none or
+        if it is more than maxage seconds old (default: three poll
+        intervals).
+        """
+        if maxage is None:
+            maxage = 3.*g.cpars.get('tcs_poll_interval', INTERVAL)
+        sample = self.latest
+        if sample is None or time.time() - sample.time > maxage:
+            raise TcsError('no recent TCS data' + (
+                '' if self.error is None else ': ' + self.error))
+        return sample
+
+    def tracking(self):
+        """
+        Returns True if the RA and Dec of the last two samples agree to
+        within 0.001 degrees. The telescope often reports 'slewing'
+        even when tracking, so this is more reliable than the flag.
+        """
+        rows = self.history.rows()
+        if len(rows) < 2:
+            return False
+        last, prev = rows[-1], rows[-2]
+        return abs(last[TcsHistory.RA]-prev[TcsHistory.RA]) < 1.e-3 and \
+            abs(last[TcsHistory.DEC]-prev[TcsHistory.DEC]) < 1.e-3
+
+    def paChanging(self):
+        """
+        Returns True if the PA of the last two samples differs by more
+        than 0.1 degrees
+        """
+        rows = self.history.rows()
+        if len(rows) < 2:
+            return False
+        dpa = abs(rows[-1,TcsHistory.PA]-rows[-2,TcsHistory.PA])
+        return dpa > 0.1 and abs(dpa-360.) > 0.1
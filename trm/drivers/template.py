@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+
+"""
+Cache of the parsed application templates.
+
+Every Start, Save and Quit creates an application from a template, which
+used to mean reading and parsing the template from disk or fetching it
+from the camera server each time. The templates are instead parsed once
+and held here as AppSchema objects, keyed by the application label. An
+AppSchema knows where each CCD parameter lives in its template so that
+applications can be created from a dictionary of settings, and read back
+into one, without searching the tree.
+
+Templates read from local files are re-read if the file's modification
+time changes. Templates fetched from the camera server are kept until
+'refresh' is called, which re-validates them with the server's ETag if it
+sent one.
+"""
+
+from __future__ import print_function
+import os, copy, threading
+import xml.etree.ElementTree as ET
+
+import globals as g
+import httpclient
+
+class AppSchema(object):
+    """
+    Index of the CCD parameters of an application. Attributes::
+
+      root  : the pristine xml.etree.ElementTree.Element of the template
+      slots : dictionary of the positions of the set_parameter elements
+              within configure_camera, keyed by parameter name ('ref')
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self._cconfig = self._index(root, 'configure_camera')
+        self._user    = self._index(root, 'user')
+        if self._cconfig is None:
+            raise KeyError('template has no configure_camera element')
+        self.slots = {}
+        for n, param in enumerate(root[self._cconfig]):
+            if param.tag == 'set_parameter':
+                self.slots[param.attrib['ref']] = n
+
+    @staticmethod
+    def _index(root, tag):
+        for n, elem in enumerate(root):
+            if elem.tag == tag:
+                return n
+        return None
+
+    def render(self, pars):
+        """
+        Returns a new application (xml.etree.ElementTree.Element) with the
+        parameter values set from 'pars', a dictionary of string values keyed
+        by parameter name. Raises a KeyError if a parameter is not in the
+        template.
+        """
+        root    = copy.deepcopy(self.root)
+        cconfig = root[self._cconfig]
+        for ref, value in pars.iteritems():
+            cconfig[self.slots[ref]].set('value', value)
+        return root
+
+    def user(self, root):
+        """
+        Returns the 'user' element of an application made by 'render'
+        """
+        if self._user is None:
+            raise KeyError('template has no user element')
+        return root[self._user]
+
+    def values(self, root=None):
+        """
+        Returns a dictionary of the parameter values keyed by name, of the
+        template or of an application made from it.
+        """
+        cconfig = (self.root if root is None else root)[self._cconfig]
+        return dict((ref, cconfig[n].attrib['value'])
+                    for ref, n in self.slots.iteritems())
+
+class Entry(object):
+    """
+    A parsed template and the information needed to tell if it is current.
+
+      source : file name or URL the template was loaded from
+      schema : the AppSchema of the template
+      mtime  : modification time of a local file
+      etag   : ETag sent by the server, None if not sent
+      stale  : True if a server template must be re-validated
+    """
+
+    def __init__(self, source, schema, mtime=None, etag=None):
+        self.source = source
+        self.schema = schema
+        self.mtime  = mtime
+        self.etag   = etag
+        self.stale  = False
+
+class TemplateCache(object):
+    """
+    Parsed templates keyed by application label. Thread safe, so
+    templates can be loaded in the background.
+    """
+
+    def __init__(self):
+        self._entries = {}
+        self._lock    = threading.Lock()
+
+    def local(self, label, lfile):
+        """
+        Returns the AppSchema of application 'label' read from
+        file 'lfile', parsing the file only if it has not been seen before
+        or has changed since.
+        """
+        mtime = os.path.getmtime(lfile)
+        with self._lock:
+            entry = self._entries.get(label)
+            if entry is None or entry.source != lfile or entry.mtime != mtime:
+                entry = Entry(lfile, AppSchema(ET.parse(lfile).getroot()),
+                              mtime=mtime)
+                self._entries[label] = entry
+            return entry.schema
+
+    def remote(self, label, url):
+        """
+        Returns the AppSchema of application 'label' fetched
+        from 'url', only going to the server if the template has not been
+        fetched before or 'refresh' has been called since. The lock is
+        only held to read and store the entry, not while the server is
+        asked.
+        """
+        with self._lock:
+            entry = self._entries.get(label)
+            if entry is not None and entry.source != url:
+                entry = None
+            if entry is not None and not entry.stale:
+                return entry.schema
+
+        fetched = self._fetch(url, entry)
+        with self._lock:
+            if fetched is entry:
+                entry.stale = False
+            self._entries[label] = fetched
+        return fetched.schema
+
+    def _fetch(self, url, entry):
+        """
+        Gets a template from the server, re-using 'entry' if it has an ETag
+        and the server says that it is still current.
+        """
+        headers = {}
+        if entry is not None and entry.etag is not None:
+            headers['If-None-Match'] = entry.etag
+        response = httpclient.client().get(url, headers=headers)
+        if response.status == 304:
+            return entry
+        return Entry(url, AppSchema(ET.fromstring(response.read())),
+                     etag=response.headers.get('etag'))
+
+    def refresh(self, label=None):
+        """
+        Marks server templates as needing to be re-validated when next
+        used. Applies to all of them if label is None. Local files are
+        checked every time anyway.
+        """
+        with self._lock:
+            for lab, entry in self._entries.iteritems():
+                if label is None or lab == label:
+                    entry.stale = True
+
+    def clear(self):
+        """
+        Empties the cache
+        """
+        with self._lock:
+            self._entries.clear()
+
+_cache = TemplateCache()
+
+def cache():
+    """
+    Returns the TemplateCache shared by all users
+    """
+    return _cache
+
+def getSchema(app):
+    """
+    Returns the AppSchema of application 'app' (e.g. 'Windows'),
+    from the camera server or from the template directory according to the
+    configuration parameters.
+    """
+    if g.cpars['template_from_server']:
+        url = g.cpars['http_camera_server'] + g.HTTP_PATH_GET + '?' + \
+            g.HTTP_SEARCH_ATTR_NAME + '=' + g.cpars['templates'][app]['app']
+        return _cache.remote(app, url)
+    else:
+        lfile = os.path.join(g.cpars['template_directory'],
+                             g.cpars['templates'][app]['app'])
+        return _cache.local(app, lfile)
+
+def preload():
+    """
+    Loads all the templates, so that the first Start does not have to
+    """
+    for app in g.cpars['templates']:
+        getSchema(app)
@@ -16,6 +16,8 @@ import xml.etree.ElementTree as ET
 import os
 import re
 
+import template
+
 class WindowPair (object):
     """
     Needs work this; half-done at the the mo'
@@ -400,14 +402,14 @@ def createXML(config, ccdpars, userpars):
         print('DEBUG: createXML: application = ' + appLab)
         print('DEBUG: createXML: application vals = ' + str(config.templates[appLab]))
 
+    # get the schema of the (cached) template
     if config.template_from_server:
         # get template from server
         url = config.http_camera_server + config.http_path_get + '?' + \
-            config.http_search_attr_name + '='  + config.templates[appLab]
+            config.http_search_attr_name + '='  + config.templates[appLab]['app']
         if config.debug:
             print ('DEBUG: url = ' + url)
-        sxml = urllib2.urlopen(url).read()
-        txml = ET.fromstring(sxml)
+        schema = template.cache().remote(appLab, url)
     else:
         # get template from local file
         if config.debug:
@@ -415,44 +417,38 @@ def createXML(config, ccdpars, userpars):
         lfile = os.path.join(config.template_directory, config.templates[appLab]['app'])
         if config.debug:
             print ('DEBUG: local file = ' + lfile)
-        tree = ET.parse(lfile)
-        txml = tree.getroot()
+        schema = template.cache().local(appLab, lfile)
 
-    # Find all CCD parameters
-    cconfig = txml.find('configure_camera')
+    # Collect the CCD parameters. This is designed so that
+    # missing parameters will cause exceptions to be raised.
     pdict = {}
-    for param in cconfig.findall('set_parameter'):
-        pdict[param.attrib['ref']] = param.attrib
-
-    # Set them. This is designed so that missing 
-    # parameters will cause exceptions to be raised.
 
     # X-binning factor
-    pdict['X_BIN']['value'] = ccdpars.xbin.get()
+    pdict['X_BIN'] = ccdpars.xbin.get()
 
     # Y-binning factor
-    pdict['X_BIN']['value'] = ccdpars.ybin.get()
+    pdict['Y_BIN'] = ccdpars.ybin.get()
 
     # Number of exposures
-    pdict['NUM_EXPS']['value'] = '-1' if ccdpars.number.value() == 0 else ccdpars.number.get()
+    pdict['NUM_EXPS'] = '-1' if ccdpars.number.value() == 0 else ccdpars.number.get()
 
     # LED level
-    pdict['LED_FLSH']['value'] = ccdpars.led.get()
+    pdict['LED_FLSH'] = ccdpars.led.get()
 
     # Avalanche or normal
-    pdict['OUTPUT']['value'] = str(ccdpars.avalanche())
+    pdict['OUTPUT'] = str(ccdpars.avalanche())
 
     # Avalanche gain
-    pdict['HV_GAIN']['value'] = ccdpars.avgain.get()
+    pdict['HV_GAIN'] = ccdpars.avgain.get()
 
     # Clear or not
-    pdict['EN_CLR']['value'] = str(ccdpars.clear())
+    pdict['EN_CLR'] = str(ccdpars.clear())
 
     # Dwell
-    pdict['DWELL']['value'] = ccdpars.expose.get()
+    pdict['DWELL'] = ccdpars.expose.get()
 
     # Readout speed
-    pdict['SPEED']['value'] = '0' if ccdpars.readout == 'Slow' else '1' \
+    pdict['SPEED'] = '0' if ccdpars.readout == 'Slow' else '1' \
         if ccdpars.readout == 'Medium' else '2'
 
     # Number of windows -- needed to set output parameters correctly
@@ -461,18 +457,19 @@ def createXML(config, ccdpars, userpars):
     # Load up enabled windows, null disabled windows
     for nw, win in ccdpars.wframe.wins:
         if nw < nwin:
-            pdict['X' + str(nw+1) + '_START']['value'] = win.xstart.get()
-            pdict['Y' + str(nw+1) + '_START']['value'] = win.ystart.get()
-            pdict['X' + str(nw+1) + '_SIZE']['value']  = win.nx.get()
-            pdict['Y' + str(nw+1) + '_SIZE']['value']  = win.ny.get()
+            pdict['X' + str(nw+1) + '_START'] = win.xstart.get()
+            pdict['Y' + str(nw+1) + '_START'] = win.ystart.get()
+            pdict['X' + str(nw+1) + '_SIZE']  = win.nx.get()
+            pdict['Y' + str(nw+1) + '_SIZE']  = win.ny.get()
         else:
-            pdict['X' + str(nw+1) + '_START']['value'] = '1'
-            pdict['Y' + str(nw+1) + '_START']['value'] = '1'
-            pdict['X' + str(nw+1) + '_SIZE']['value']  = '0'
-            pdict['Y' + str(nw+1) + '_SIZE']['value']  = '0'
-
-    # Load the user parameters
-    uconfig = txml.find('user')
+            pdict['X' + str(nw+1) + '_START'] = '1'
+            pdict['Y' + str(nw+1) + '_START'] = '1'
+            pdict['X' + str(nw+1) + '_SIZE']  = '0'
+            pdict['Y' + str(nw+1) + '_SIZE']  = '0'
+
+    # Create the application and load the user parameters
+    txml    = schema.render(pdict)
+    uconfig = schema.user(txml)
     uconfig.set('target', userpars.target.get())
     uconfig.set('comment', userpars.comment.get())
     uconfig.set('ID', userpars.progid.get())
@@ -8,13 +8,21 @@ from __future__ import print_function
 import Tkinter as tk
 import tkFont, tkMessageBox, tkFileDialog
 import xml.etree.ElementTree as ET
-import os, urllib2, math
+import os, urllib2, math, time
+from collections import namedtuple
+
+# third party
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 # mine
 import globals as g
 import drivers as drvs
 import lakeshore as lake
-import tcs
+import httpclient
+import template
 
 # Timing, gain, noise parameters lifted from java usdriver
 VCLOCK           =  14.4e-6  # vertical clocking time
@@ -61,6 +69,243 @@ RNO_AV_SLOW    =  5.6 # electrons per pixel
 DARK_E         =  0.001 # electrons/pix/sec
 CIC            =  0.010 # Clock induced charge, electrons/pix
 
+# video sample times, gains and readout noise indexed by readout speed code
+# (0 = Slow, 1 = Medium, 2 = Fast, as for the SPEED parameter)
+SPEEDS         = ('Slow', 'Medium', 'Fast')
+VIDEO_NORM     = (VIDEO_NORM_SLOW, VIDEO_NORM_MED, VIDEO_NORM_FAST)
+VIDEO_AV       = (VIDEO_AV_SLOW, VIDEO_AV_MED, VIDEO_AV_FAST)
+GAIN_NORM      = (GAIN_NORM_SLOW, GAIN_NORM_MED, GAIN_NORM_FAST)
+GAIN_AV        = (GAIN_AV_SLOW, GAIN_AV_MED, GAIN_AV_FAST)
+RNO_NORM       = (RNO_NORM_SLOW, RNO_NORM_MED, RNO_NORM_FAST)
+RNO_AV         = (RNO_AV_SLOW, RNO_AV_MED, RNO_AV_FAST)
+
+class Setup(namedtuple('Setup', 'mode speed avalanche clear xbin ybin ' +
+                       'windows expose')):
+    """
+    Hashable description of a setup for the timing model. Attributes::
+
+      mode      : 'Windows' or 'Drift'
+      speed     : readout speed, 'Slow', 'Medium' or 'Fast'
+      avalanche : True for the avalanche output
+      clear     : True to clear the chip before each exposure. Ignored in
+                  drift mode.
+      xbin      : binning factor in X
+      ybin      : binning factor in Y
+      windows   : tuple of (ys, nx, ny) for each window in order of ys,
+                  unbinned pixels. One (ys, nx, ny) for the pair in drift
+                  mode. The X start positions do not affect the timing.
+      expose    : exposure delay, seconds
+    """
+    __slots__ = ()
+
+@drvs.lruCache(512)
+def timing(setup):
+    """
+    Estimates timing information for a setup.
+
+    setup : a Setup
+
+    Returns: (expTime, deadTime, cycleTime, dutyCycle, frameRate)
+
+    expTime   : exposure time per frame (seconds)
+    deadTime  : dead time per frame (seconds)
+    cycleTime : sampling time (cadence), (seconds)
+    dutyCycle : percentage time exposing.
+    frameRate : number of frames per second
+    """
+
+    lnormal = not setup.avalanche
+    HCLOCK  = HCLOCK_NORM if lnormal else HCLOCK_AV
+
+    isDriftMode = setup.mode == 'Drift'
+
+    if setup.speed not in SPEEDS:
+        raise UspecError('uspec.timing: readout speed = ' \
+                             + str(setup.speed) + ' not recognised.')
+    nspeed = SPEEDS.index(setup.speed)
+    video  = VIDEO_NORM[nspeed] if lnormal else VIDEO_AV[nspeed]
+
+    xbin, ybin = setup.xbin, setup.ybin
+    lclear     = not isDriftMode and setup.clear
+
+    # clear chip by VCLOCK-ing the image and storage areas
+    if lclear:
+        # accomodate changes to clearing made by DA to fix dark current
+        # when clearing charge along normal output
+        clear_time = 2.0*(FFY*VCLOCK+39.e-6) + FFX*HCLOCK_NORM + \
+            2162.0*HCLOCK_AV
+    else:
+        clear_time = 0.0
+
+    hclockFactor = 1.0 if lnormal else 2.0
+
+    # After placing a window adjacent to the serial register, the register
+    # must be cleared by clocking out the entire register, taking FFX
+    # hclocks (we no longer open the dump gates, which took only 8 hclock
+    # cycles to complete, but gave ramps and bright rows in the bias). We
+    # think dave does 2*FFX hclocks in avalanche mode, but need to check
+    # this with him.
+    line_clear = hclockFactor*FFX*HCLOCK
+
+    # the charge in a row after a window used to be dumped, taking
+    # 8 HCLOCK cycles. This created ramps and bright rows/columns in
+    # the images, so was removed.
+    numhclocks = FFX if lnormal else FFX + AVALANCHE_PIXELS
+
+    if isDriftMode:
+        # for drift mode, we need the number of windows in the pipeline
+        # and the pipeshift
+        dys, dnx, dny = setup.windows[0]
+        pnwin  = int(((1037. / dny) + 1.)/2.)
+        pshift = 1037.- (2.*pnwin-1.)*dny
+        frame_transfer = (dny+dys-1.)*VCLOCK + 49.0e-6
+
+        yshift    = (dys-1.0)*VCLOCK
+        line_read = VCLOCK*ybin + numhclocks*HCLOCK + video*2.0*dnx/xbin
+        readout   = (dny//ybin) * line_read
+
+        cycleTime = setup.expose + clear_time + frame_transfer + \
+            pshift*VCLOCK + yshift + (line_clear if yshift != 0 else 0.) + \
+            readout
+
+    else:
+        # If not drift mode, move entire image into storage area
+        # the -35 component is because Derek only shifts 1037 pixels
+        # (composed of 1024 active rows, 5 dark reference rows, 2
+        # transition rows and 6 extra overscan rows for good measure)
+        frame_transfer = (FFY-35)*VCLOCK + 49.0e-6
+
+        cycleTime = setup.expose + clear_time + frame_transfer
+        yend = 1
+        for ys, nx, ny in setup.windows:
+            yshift = (ys-yend)*VCLOCK
+            yend   = ys + ny
+
+            # time to shift one row into the serial register, shift along
+            # it and read out the data, times the number of rows
+            line_read = VCLOCK*ybin + numhclocks*HCLOCK + video*nx/xbin
+            readout   = (ny//ybin) * line_read
+            cycleTime += yshift + (line_clear if yshift != 0 else 0.) + \
+                readout
+
+    frameRate = 1.0/cycleTime
+    expTime   = setup.expose if lclear else cycleTime - frame_transfer
+    deadTime  = cycleTime - expTime
+    dutyCycle = 100.0*expTime/cycleTime
+
+    return (expTime, deadTime, cycleTime, dutyCycle, frameRate)
+
+def peakFraction(xbin, ybin, sigma, psf=None, ndiv=5):
+    """
+    Returns the fraction of the flux of a star centred on a (binned) pixel
+    that falls in that pixel.
+
+    xbin  : binning factor in X
+    ybin  : binning factor in Y
+    sigma : RMS of the gaussian seeing profile, unbinned pixels
+    psf   : if set, a function psf(x, y, sigma) returning the profile at
+            offsets x and y (numpy arrays, unbinned pixels) from the centre,
+            normalised to unit integral, to use instead of a gaussian.
+            Requires numpy.
+    ndiv  : number of points per unbinned pixel in X and Y at which psf is
+            evaluated
+
+    The gaussian is integrated exactly since it separates into the
+    product of error functions in X and Y.
+    """
+    if psf is None:
+        scale = 2.*math.sqrt(2.)*sigma
+        return math.erf(xbin/scale)*math.erf(ybin/scale)
+
+    if np is None:
+        raise UspecError('uspec.peakFraction: numpy is needed for a psf')
+
+    # sample the centre of each of xbin*ndiv by ybin*ndiv sub-pixels
+    x = (np.arange(xbin*ndiv)+0.5)/ndiv - xbin/2.
+    y = (np.arange(ybin*ndiv)+0.5)/ndiv - ybin/2.
+    return psf(x[np.newaxis,:], y[:,np.newaxis], sigma).sum()/ndiv**2
+
+def timingBatch(drift, speed, avalanche, clear, xbin, ybin, ys, nx, ny,
+                expose, nwin=None):
+    """
+    Vectorised version of 'timing' for evaluating many setups at once.
+    Requires numpy. All arguments other than 'drift' can be arrays, and are
+    broadcast against each other.
+
+      drift     : True for drift mode, False for windows mode
+      speed     : readout speed code, 0 = Slow, 1 = Medium, 2 = Fast
+      avalanche : True for the avalanche output
+      clear     : True to clear the chip; ignored in drift mode
+      xbin      : binning factor in X
+      ybin      : binning factor in Y
+      ys        : Y start of each window, unbinned. The last axis runs over
+                  the windows; it has length 1 in drift mode.
+      nx        : X dimension of each window, unbinned, as for ys
+      ny        : Y dimension of each window, unbinned, as for ys
+      expose    : exposure delay, seconds
+      nwin      : number of windows in use, if less than the length of the
+                  window axis (windows mode only)
+
+    Returns: (expTime, deadTime, cycleTime, dutyCycle, frameRate) as arrays
+    """
+    if np is None:
+        raise UspecError('uspec.timingBatch: numpy is needed')
+
+    speed     = np.asarray(speed)
+    lnormal   = np.logical_not(avalanche)
+    HCLOCK    = np.where(lnormal, HCLOCK_NORM, HCLOCK_AV)
+    video     = np.where(lnormal, np.take(VIDEO_NORM, speed),
+                         np.take(VIDEO_AV, speed))
+    xbin      = np.asarray(xbin)[...,np.newaxis]
+    ybin      = np.asarray(ybin)[...,np.newaxis]
+    ys, nx, ny = np.asarray(ys), np.asarray(nx), np.asarray(ny)
+    expose    = np.asarray(expose, dtype=float)
+
+    lclear = np.logical_and(np.logical_not(drift), clear)
+    clear_time = np.where(lclear, 2.0*(FFY*VCLOCK+39.e-6) + FFX*HCLOCK_NORM +
+                          2162.0*HCLOCK_AV, 0.)
+    line_clear = np.where(lnormal, 1.0, 2.0)*FFX*HCLOCK
+    numhclocks = np.where(lnormal, FFX, FFX + AVALANCHE_PIXELS)
+
+    if drift:
+        dys, dnx, dny = ys[...,0], nx[...,0], ny[...,0]
+        pnwin  = (((1037. / dny) + 1.)/2.).astype(int)
+        pshift = 1037.- (2.*pnwin-1.)*dny
+        frame_transfer = (dny+dys-1.)*VCLOCK + 49.0e-6
+
+        yshift    = (dys-1.0)*VCLOCK
+        line_read = VCLOCK*ybin[...,0] + numhclocks*HCLOCK + \
+            video*2.0*dnx/xbin[...,0]
+        readout   = (dny//ybin[...,0]) * line_read
+        windows   = pshift*VCLOCK + yshift + \
+            np.where(yshift != 0, line_clear, 0.) + readout
+
+    else:
+        frame_transfer = (FFY-35)*VCLOCK + 49.0e-6
+
+        yend = np.concatenate(
+            (np.ones_like(ys[...,:1]), ys[...,:-1] + ny[...,:-1]), axis=-1)
+        yshift = (ys-yend)*VCLOCK
+
+        line_read = VCLOCK*ybin + (numhclocks*HCLOCK)[...,np.newaxis] + \
+            video[...,np.newaxis]*nx/xbin
+        readout   = (ny//ybin) * line_read
+        terms     = yshift + np.where(yshift != 0,
+                                      line_clear[...,np.newaxis], 0.) + readout
+
+        if nwin is not None:
+            terms = np.where(np.arange(ys.shape[-1]) <
+                             np.asarray(nwin)[...,np.newaxis], terms, 0.)
+        windows = terms.sum(axis=-1)
+
+    cycleTime = expose + clear_time + frame_transfer + windows
+    frameRate = 1.0/cycleTime
+    expTime   = np.where(lclear, expose, cycleTime - frame_transfer)
+    deadTime  = cycleTime - expTime
+    dutyCycle = 100.0*expTime/cycleTime
+
+    return (expTime, deadTime, cycleTime, dutyCycle, frameRate)
+
 class InstPars(tk.LabelFrame):
     """
     Ultraspec instrument parameters block.
@@ -180,6 +425,12 @@ class InstPars(tk.LabelFrame):
         # stores current avalanche setting to check for changes
         self.oldAvalanche = False
 
+        # application whose windows are currently shown
+        self.shown = None
+
+        # windows as served to rtplot, updated by check
+        self.rtplotWins = drvs.RtplotWins()
+
         self.setExpertLevel()
 
     def setExpertLevel(self):
@@ -238,10 +489,7 @@ class InstPars(tk.LabelFrame):
             raise drvs.DriverError('Do not recognize application id = ' + xmlid)
 
         # find parameters
-        cconfig = xml.find('configure_camera')
-        pdict = {}
-        for param in cconfig.findall('set_parameter'):
-            pdict[param.attrib['ref']] = param.attrib['value']
+        pdict = template.AppSchema(xml).values()
 
         xbin, ybin = int(pdict['X_BIN']), int(pdict['Y_BIN'])
 
@@ -375,18 +623,23 @@ class InstPars(tk.LabelFrame):
 
         This can only be run once the 'observe' are defined.
         """
-        # Switch visible widget according to the application
+        # Switch visible widget according to the application, if it has
+        # changed
         if self.isDrift():
-            self.wframe.grid_forget()
-            self.pframe.grid(row=2,column=0,columnspan=3,sticky=tk.W+tk.N)
-            self.clearLab.config(state='disable')
+            if self.shown != 'Drift':
+                self.wframe.grid_forget()
+                self.pframe.grid(row=2,column=0,columnspan=3,sticky=tk.W+tk.N)
+                self.clearLab.config(state='disable')
+                self.shown = 'Drift'
             if not self.frozen:
                 self.clear.config(state='disable')
                 self.pframe.enable()
         else:
-            self.pframe.grid_forget()
-            self.wframe.grid(row=2,column=0,columnspan=3,sticky=tk.W+tk.N)
-            self.clearLab.config(state='normal')
+            if self.shown != 'Windows':
+                self.pframe.grid_forget()
+                self.wframe.grid(row=2,column=0,columnspan=3,sticky=tk.W+tk.N)
+                self.clearLab.config(state='normal')
+                self.shown = 'Windows'
             if not self.frozen:
                 self.clear.config(state='normal')
                 self.wframe.enable()
@@ -414,9 +667,9 @@ class InstPars(tk.LabelFrame):
 
         # exposure delay
         if self.expose.ok():
-            self.expose.config(bg=g.COL['main'])
+            drvs.setBackground(self.expose, g.COL['main'])
         else:
-            self.expose.config(bg=g.COL['warn'])
+            drvs.setBackground(self.expose, g.COL['warn'])
             status = False
 
         # allow posting according to whether the parameters are ok
@@ -424,12 +677,15 @@ class InstPars(tk.LabelFrame):
         if status:
             if g.cpars['cdf_servers_on'] and \
                     g.cpars['servers_initialised'] and \
-                    not drvs.isRunActive():
+                    not drvs.isRunActive(2*g.cpars['status_poll_interval']):
                 g.observe.start.enable()
             g.count.update()
         else:
             g.observe.start.disable()
 
+        # pass on any change of windows to rtplot
+        self.rtplotWins.publish(self.getRtplotWins())
+
         return status
 
     def freeze(self):
@@ -470,37 +726,55 @@ class InstPars(tk.LabelFrame):
         it asks for window parameters. Returns null string '' if
         the windows are not OK. This operates on the basis of
         trying to send something back, even if it might not be
-        OK as a window setup. Note that we have to take care
-        here not to update any GUI components because this is
-        called outside of the main thread.
+        OK as a window setup. This reads the GUI so it must be
+        called from the main thread; the rtplot server gets the
+        result from 'rtplotWins', which is updated by 'check'.
         """
         try:
             xbin = self.wframe.xbin.value()
             ybin = self.wframe.ybin.value()
             if self.app.value() == 'Windows':
-                nwin = self.wframe.nwin.value()
-                ret  = str(xbin) + ' ' + str(ybin) + ' ' + str(nwin) + '\r\n'
+                nwin  = self.wframe.nwin.value()
+                lines = ['{0} {1} {2}'.format(xbin, ybin, nwin)]
                 for xs, ys, nx, ny in self.wframe:
-                    ret   += str(xs) + ' ' + str(ys) + ' ' + str(nx) + ' ' + \
-                        str(ny) + '\r\n'
+                    lines.append('{0} {1} {2} {3}'.format(xs, ys, nx, ny))
             elif self.app.value() == 'Drift':
-                ret  = str(xbin) + ' ' + str(ybin) + ' 2\r\n'
+                lines = ['{0} {1} 2'.format(xbin, ybin)]
                 for xsl, xsr, ys, nx, ny in self.pframe:
-                    ret   += str(xsl) + ' ' + str(ys) + ' ' + str(nx) + ' ' + \
-                        str(ny) + '\r\n'
-                    ret   += str(xsr) + ' ' + str(ys) + ' ' + str(nx) + ' ' + \
-                        str(ny) + '\r\n'
+                    lines.append('{0} {1} {2} {3}'.format(xsl, ys, nx, ny))
+                    lines.append('{0} {1} {2} {3}'.format(xsr, ys, nx, ny))
 
-            return ret
+            return ''.join(line + '\r\n' for line in lines)
         except:
             return ''
 
+    def setup(self):
+        """
+        Returns the current setup as a Setup for the timing model.
+        You should run a check on the instrument parameters before
+        calling this.
+        """
+        isDriftMode = self.app.value() == 'Drift'
+        if isDriftMode:
+            p = self.pframe
+            xbin, ybin = p.xbin.value(), p.ybin.value()
+            windows = ((p.ys[0].value(), p.nx[0].value(), p.ny[0].value()),)
+        else:
+            w = self.wframe
+            xbin, ybin = w.xbin.value(), w.ybin.value()
+            windows = tuple((ys, nx, ny) for xs, ys, nx, ny in w)
+
+        return Setup(self.app.value(), self.readSpeed.value(),
+                     bool(self.avalanche()), not isDriftMode and
+                     bool(self.clear()), xbin, ybin, windows,
+                     self.expose.value())
+
     def timing(self):
         """
         Estimates timing information for the current setup. You should
         run a check on the instrument parameters before calling this.
 
-        Returns: (expTime, deadTime, cycleTime, dutyCycle)
+        Returns: (expTime, deadTime, cycleTime, dutyCycle, frameRate)
 
         expTime   : exposure time per frame (seconds)
         deadTime  : dead time per frame (seconds)
@@ -508,173 +782,7 @@ class InstPars(tk.LabelFrame):
         dutyCycle : percentage time exposing.
         frameRate : number of frames per second
         """
-
-        # avalanche mode y/n?
-        lnormal = not self.avalanche()
-        HCLOCK  = HCLOCK_NORM if lnormal else HCLOCK_AV
-
-        # drift mode y/n?
-        isDriftMode = self.app.value() == 'Drift'
-
-        # Set the readout speed
-        readSpeed = self.readSpeed.value()
-
-        if readSpeed == 'Fast':
-            video = VIDEO_NORM_FAST if lnormal else VIDEO_AV_FAST
-        elif readSpeed == 'Medium':
-            video = VIDEO_NORM_MED if lnormal else VIDEO_AV_MED
-        elif readSpeed == 'Slow':
-            video = VIDEO_NORM_SLOW if lnormal else VIDEO_AV_SLOW
-        else:
-            raise UspecError('uspec.InstPars.timing: readout speed = ' \
-                                 + readSpeed + ' not recognised.')
-
-        # clear chip on/off?
-        lclear = not isDriftMode and self.clear()
-
-        # get exposure delay
-        expose = self.expose.value()
-
-        # window parameters
-        if isDriftMode:
-            xbin    = self.pframe.xbin.value()
-            ybin    = self.pframe.ybin.value()
-            dxleft  = self.pframe.xsl[0].value()
-            dxright = self.pframe.xsr[0].value()
-            dys     = self.pframe.ys[0].value()
-            dnx     = self.pframe.nx[0].value()
-            dny     = self.pframe.ny[0].value()
-        else:
-            xbin   = self.wframe.xbin.value()
-            ybin   = self.wframe.ybin.value()
-            xs, ys, nx, ny = [], [], [], []
-            nwin = self.wframe.nwin.value()
-            for xsv, ysv, nxv, nyv in self.wframe:
-                xs.append(xsv)
-                ys.append(ysv)
-                nx.append(nxv)
-                ny.append(nyv)
-
-        if lnormal:
-            # normal mode convert xs by ignoring 16 overscan pixel
-            if isDriftMode:
-                dxleft  += 16
-                dxright += 16
-            else:
-                for nw in xrange(nwin):
-                    xs[nw] += 16
-        else:
-            if isDriftMode:
-                dxright = FFX - (dxright-1) - (dnx-1)
-                dxleft  = FFX - (dxleft-1) - (dnx-1)
-
-                # in drift mode, also need to swap the windows around
-                dxright, dxleft = dxleft, dxright
-            else:
-                # in avalanche mode, need to swap windows around
-                for nw in xrange(nwin):
-                    xs[nw] = FFX - (xs[nw]-1) - (nx[nw]-1)
-
-        # convert timing parameters to seconds
-        expose_delay = expose
-
-        # clear chip by VCLOCK-ing the image and storage areas
-        if lclear:
-            # accomodate changes to clearing made by DA to fix dark current
-            # when clearing charge along normal output
-            clear_time = 2.0*(FFY*VCLOCK+39.e-6) + FFX*HCLOCK_NORM + \
-                2162.0*HCLOCK_AV
-        else:
-            clear_time = 0.0
-
-        hclockFactor = 1.0 if lnormal else 2.0
-
-        if isDriftMode:
-            # for drift mode, we need the number of windows in the pipeline
-            # and the pipeshift
-            pnwin  = int(((1037. / dny) + 1.)/2.)
-            pshift = 1037.- (2.*pnwin-1.)*dny
-            frame_transfer = (dny+dys-1.)*VCLOCK + 49.0e-6
-
-            yshift   = [0.]
-            yshift[0]=(dys-1.0)*VCLOCK
-
-            # After placing the window adjacent to the serial register, the
-            # register must be cleared by clocking out the entire register,
-            # taking FFX hclocks (we no longer open the dump gates, which
-            # took only 8 hclock cycles to complete, but gave ramps and
-            # bright rows in the bias). We think dave does 2*FFX hclocks
-            # in avalanche mode, but need to check this with him.
-            line_clear = [0.]
-            if yshift[0] != 0:
-                line_clear[0] = hclockFactor*FFX*HCLOCK
-
-            numhclocks = [0]
-            numhclocks[0] = FFX
-            if not lnormal:
-                numhclocks[0] += AVALANCHE_PIXELS
-
-            line_read = [0.]
-            line_read[0] = VCLOCK*ybin + numhclocks[0]*HCLOCK + \
-                video*2.0*dnx/xbin
-
-            readout = [0.]
-            readout[0] = (dny/ybin) * line_read[0]
-
-        else:
-            # If not drift mode, move entire image into storage area
-            # the -35 component is because Derek only shifts 1037 pixels
-            # (composed of 1024 active rows, 5 dark reference rows, 2
-            # transition rows and 6 extra overscan rows for good measure)
-            # If drift mode, just move the window into the storage area
-            frame_transfer = (FFY-35)*VCLOCK + 49.0e-6
-
-            yshift = nwin*[0.]
-            yshift[0]=(ys[0]-1.0)*VCLOCK
-            for nw in xrange(1,nwin):
-                yshift[nw] = (ys[nw]-ys[nw-1]-ny[nw-1])*VCLOCK
-
-            line_clear = nwin*[0.]
-            for nw in xrange(nwin):
-                if yshift[nw] != 0:
-                    line_clear[nw] = hclockFactor*FFX*HCLOCK
-
-            # calculate how long it takes to shift one row into the serial
-            # register shift along serial register and then read out the data.
-            # The charge in a row after a window used to be dumped, taking
-            # 8 HCLOCK cycles. This created ramps and bright rows/columns in
-            # the images, so was removed.
-            numhclocks = nwin*[0]
-            for nw in xrange(nwin):
-                numhclocks[nw] = FFX;
-                if not lnormal:
-                    numhclocks[nw] += AVALANCHE_PIXELS
-
-            line_read = nwin*[0.]
-            for nw in xrange(nwin):
-                line_read[nw] = VCLOCK*ybin + numhclocks[nw]*HCLOCK + \
-                    video*nx[nw]/xbin
-
-            # multiply time to shift one row into serial register by
-            # number of rows for total readout time
-            readout = nwin*[0.]
-            for nw in xrange(nwin):
-                readout[nw] = (ny[nw]/ybin) * line_read[nw]
-
-        # now get the total time to read out one exposure.
-        cycleTime = expose_delay + clear_time + frame_transfer
-        if isDriftMode:
-            cycleTime += pshift*VCLOCK+yshift[0]+line_clear[0]+readout[0]
-        else:
-            for nw in xrange(nwin):
-                cycleTime += yshift[nw] + line_clear[nw] + readout[nw]
-
-        frameRate = 1.0/cycleTime
-        expTime   = expose_delay if lclear else cycleTime - frame_transfer
-        deadTime  = cycleTime - expTime
-        dutyCycle = 100.0*expTime/cycleTime
-
-        return (expTime, deadTime, cycleTime, dutyCycle, frameRate)
+        return timing(self.setup())
 
 class RunPars(tk.LabelFrame):
     """
@@ -889,59 +997,40 @@ def createXML(post):
     g.clog.debug('createXML: application vals = ' + \
                      str(g.cpars['templates'][app]))
 
-    if g.cpars['template_from_server']:
-        # get template from server
-        url = g.cpars['http_camera_server'] + g.HTTP_PATH_GET + '?' + \
-              g.HTTP_SEARCH_ATTR_NAME + '=' + g.cpars['templates'][app]['app']
-        g.clog.debug('url = ' + url)
-        sxml = urllib2.urlopen(url).read()
-        root = ET.fromstring(sxml)
-
-    else:
-        # get template from local file
-        g.clog.debug('directory = ' + g.cpars['template_directory'])
-
-        lfile = os.path.join(g.cpars['template_directory'],
-                             g.cpars['templates'][app]['app'])
-        g.clog.debug('local file = ' + lfile)
-        tree = ET.parse(lfile)
-        root = tree.getroot()
-
-    # Find all CCD parameters
-    cconfig = root.find('configure_camera')
-    pdict = {}
-    for param in cconfig.findall('set_parameter'):
-        pdict[param.attrib['ref']] = param.attrib
+    # get the schema of the template, from the server or a local file
+    # according to 'template_from_server'. These are cached after the
+    # first time.
+    schema = template.getSchema(app)
 
-    # Set them. This is designed so that missing
-    # parameters will cause exceptions to be raised.
+    # Collect the CCD parameters. These are set in the template in one go
+    # below; any missing from it will cause exceptions to be raised.
+    # 'user' collects extra user parameters in order.
+    pars, user = {}, []
 
     # Number of exposures
-    pdict['NUM_EXPS']['value'] = '-1' if g.ipars.number.value() == 0 \
+    pars['NUM_EXPS'] = '-1' if g.ipars.number.value() == 0 \
         else str(g.ipars.number.value())
 
     # LED level
-    pdict['LED_FLSH']['value'] = str(g.ipars.led.value())
+    pars['LED_FLSH'] = str(g.ipars.led.value())
 
     # Avalanche or normal
-    pdict['OUTPUT']['value'] = str(g.ipars.avalanche())
+    pars['OUTPUT'] = str(g.ipars.avalanche())
 
     # Avalanche gain
-    pdict['HV_GAIN']['value'] = str(g.ipars.avgain.value())
+    pars['HV_GAIN'] = str(g.ipars.avgain.value())
 
     # Dwell
-    pdict['DWELL']['value'] = str(g.ipars.expose.ivalue())
+    pars['DWELL'] = str(g.ipars.expose.ivalue())
 
     # Readout speed
-    pdict['SPEED']['value'] = '0' if g.ipars.readSpeed.value() == 'Slow' \
+    pars['SPEED'] = '0' if g.ipars.readSpeed.value() == 'Slow' \
         else '1' if g.ipars.readSpeed.value() == 'Medium' else '2'
 
-    # Find the user parameters
-    uconfig    = root.find('user')
 
     if app == 'Windows':
         # Clear or not
-        pdict['EN_CLR']['value'] = str(g.ipars.clear())
+        pars['EN_CLR'] = str(g.ipars.clear())
 
         w = g.ipars.wframe
 
@@ -951,10 +1040,10 @@ def createXML(post):
         xbin, ybin = w.xbin.value(), w.ybin.value()
 
         # X-binning factor
-        pdict['X_BIN']['value'] = str(xbin)
+        pars['X_BIN'] = str(xbin)
 
         # Y-binning factor
-        pdict['Y_BIN']['value'] = str(ybin)
+        pars['Y_BIN'] = str(ybin)
 
         # Load up enabled windows, null disabled windows
         npix = 0
@@ -963,24 +1052,23 @@ def createXML(post):
                 w.nx[nw].value(), w.ny[nw].value()
 
             # save for Vik's autologger
-            xstart = ET.SubElement(uconfig, 'X' + str(nw+1) + '_START')
-            xstart.text  = str(xs)
+            user.append(('X' + str(nw+1) + '_START', str(xs)))
 
             # re-jig so that user always refers to same part of
             # the CCD regardless of the output being used. 'Derek coords'
             xs = 1074 - xs - nx if g.ipars.avalanche() else xs + 16
-            pdict['X' + str(nw+1) + '_START']['value'] = str(xs)
-            pdict['Y' + str(nw+1) + '_START']['value'] = str(ys)
-            pdict['X' + str(nw+1) + '_SIZE']['value']  = str(nx // xbin)
-            pdict['Y' + str(nw+1) + '_SIZE']['value']  = str(ny // ybin)
+            pars['X' + str(nw+1) + '_START'] = str(xs)
+            pars['Y' + str(nw+1) + '_START'] = str(ys)
+            pars['X' + str(nw+1) + '_SIZE']  = str(nx // xbin)
+            pars['Y' + str(nw+1) + '_SIZE']  = str(ny // ybin)
             npix += (nx // xbin)*(ny // ybin)
 
 
         for nw in xrange(nwin,4):
-            pdict['X' + str(nw+1) + '_START']['value'] = '1'
-            pdict['Y' + str(nw+1) + '_START']['value'] = '1'
-            pdict['X' + str(nw+1) + '_SIZE']['value']  = '0'
-            pdict['Y' + str(nw+1) + '_SIZE']['value']  = '0'
+            pars['X' + str(nw+1) + '_START'] = '1'
+            pars['Y' + str(nw+1) + '_START'] = '1'
+            pars['X' + str(nw+1) + '_SIZE']  = '0'
+            pars['Y' + str(nw+1) + '_SIZE']  = '0'
 
     else:
 
@@ -997,19 +1085,17 @@ def createXML(post):
         xbin, ybin = p.xbin.value(), p.ybin.value()
 
         # X-binning factor
-        pdict['X_BIN']['value'] = str(xbin)
+        pars['X_BIN'] = str(xbin)
 
         # Y-binning factor
-        pdict['Y_BIN']['value'] = str(ybin)
+        pars['Y_BIN'] = str(ybin)
 
         xsl, xsr, ys, nx, ny = p.xsl[0].value(), p.xsr[0].value(), \
             p.ys[0].value(), p.nx[0].value(), p.ny[0].value()
 
         # save for Vik's autologger
-        x1start = ET.SubElement(uconfig, 'X1_START')
-        x1start.text  = str(xsl)
-        x2start = ET.SubElement(uconfig, 'X2_START')
-        x2start.text  = str(xsr)
+        user.append(('X1_START', str(xsl)))
+        user.append(('X2_START', str(xsr)))
 
         # re-jig so that user always refers to same part of
         # the CCD regardless of the output being used. 'Derek coords'
@@ -1025,16 +1111,25 @@ def createXML(post):
 
         # note we make X dimensions same for each window
         # although this is not strictly required
-        pdict['X1_START']['value'] = str(xsl)
-        pdict['X2_START']['value'] = str(xsr)
-        pdict['X1_SIZE']['value']  = str(nx // xbin)
-        pdict['X2_SIZE']['value']  = str(nx // xbin)
-        pdict['Y1_START']['value'] = str(ys)
-        pdict['Y1_SIZE']['value']  = str(ny // ybin)
+        pars['X1_START'] = str(xsl)
+        pars['X2_START'] = str(xsr)
+        pars['X1_SIZE']  = str(nx // xbin)
+        pars['X2_SIZE']  = str(nx // xbin)
+        pars['Y1_START'] = str(ys)
+        pars['Y1_SIZE']  = str(ny // ybin)
         npix = 2*(nx // xbin)*(ny // ybin)
 
-    pdict['X_SIZE']['value']  = str(npix)
-    pdict['Y_SIZE']['value']  = '1'
+    pars['X_SIZE']  = str(npix)
+    pars['Y_SIZE']  = '1'
+
+    # Create the application and find the user parameters
+    root    = schema.render(pars)
+    uconfig = schema.user(root)
+
+    # save for Vik's autologger
+    for name, value in user:
+        elem      = ET.SubElement(uconfig, name)
+        elem.text = value
 
     flag = g.rpars.dtype.value()
     if flag == 'bias':
@@ -1083,7 +1178,7 @@ def createXML(post):
                 url = g.cpars['http_camera_server'] + g.HTTP_PATH_EXEC + \
                     '?RM,X,0x2E'
                 g.clog.info('exec = "' + url + '"')
-                response = urllib2.urlopen(url)
+                response = httpclient.client().get(url)
                 rs = drvs.ReadServer(response.read())
                 g.rlog.info('Camera response =\n' + rs.resp())
                 if rs.ok:
@@ -1106,10 +1201,32 @@ def createXML(post):
     # finally return with the XML
     return root
 
+def _changeFilter(position):
+    """
+    Moves the filter wheel to 'position' (1 to 6) unless it is already
+    there, connecting to it if need be. Returns the position it was at
+    beforehand. Run by the worker pool during 'Start'.
+    """
+    g.wheel.ready()
+    current = g.wheel.getPos()
+    if current != position:
+        g.wheel.goto(position)
+    return current
+
+def _readTemps():
+    """
+    Returns the CCD and finger temperatures and the heater percentage from
+    the Lakeshore log. Run by the worker pool during 'Start'.
+    """
+    if g.lakeshore is None:
+        g.lakeshore = lake.LakeFile()
+    return g.lakeshore.temps()
+
 class Start(drvs.ActButton):
     """
     Class defining the 'Start' button's operation. This carries out
-    both the old Post and Start buttons' operation in one. This involves:
+    both the old Post and Start buttons' operation in one. The slower
+    steps run in the background (see 'act'). This involves:
 
     -- checking that the instrument and run parameters are OK
     -- (optionally) querying when the target has changed or avalanche gain on
@@ -1132,6 +1249,9 @@ class Start(drvs.ActButton):
                                 text='Start')
         self.target = None
 
+        # state of a start which is under way, None if there is none
+        self.pending = None
+
     def enable(self):
         """
         Enable the button.
@@ -1167,11 +1287,19 @@ class Start(drvs.ActButton):
         else:
             self.disable()
 
+    # interval between checks on the background steps, millisecs
+    POLL = 20
+
     def act(self):
         """
-        Carries out the action associated with Start button
+        Carries out the action associated with Start button. Returns True
+        if the start is under way; it finishes in the background.
         """
 
+        if self.pending is not None:
+            g.clog.warn('A start is already under way')
+            return False
+
         # Check the instrument parameters
         if not g.ipars.check():
             g.clog.warn('Invalid instrument parameters.')
@@ -1222,8 +1350,14 @@ class Start(drvs.ActButton):
                 # get positional info from telescope
                 if g.cpars['telins_name'] == 'TNO-USPEC':
                     try:
-                        ra,dec,pa,focus,tracking,epa = tcs.getTntTcs()
-                        if not g.info.tracking and \
+                        # latest sample from the TCS client, rather than
+                        # waiting for the TCS
+                        samp = g.tcs.sample()
+                        ra, dec, pa = samp.ra, samp.dec, samp.pa
+                        focus, epa  = samp.focus, samp.engpa
+                        tracking    = samp.tflag
+                        isTracking = g.tcs.tracking()
+                        if not isTracking and \
                                 not tkMessageBox.askokcancel(
                             'TCS error',
                             'The telescope does not appear to be tracking and the\n' +
@@ -1255,11 +1389,27 @@ class Start(drvs.ActButton):
                         tfocus.text = '{0:+6.2f}'.format(focus)
                         tepa        = ET.SubElement(uconfig, 'Eng_PA')
                         tepa.text   = '{0:+7.2f}'.format(epa)
-                        tracking    = ET.SubElement(uconfig, 'Tracking')
-                        tracking.text = 'yes' if g.info.tracking else 'no'
+                        ttrack      = ET.SubElement(uconfig, 'Tracking')
+                        ttrack.text = 'yes' if isTracking else 'no'
                         ttflag      = ET.SubElement(uconfig, 'TTflag')
                         ttflag.text = tracking
 
+                        # drift rates over the last minute or so, and
+                        # time until the rotator limit
+                        drift = g.tcs.history.drift()
+                        if drift is not None:
+                            tdrift      = ET.SubElement(uconfig, 'RA_drift')
+                            tdrift.text = '{0:+7.3f}'.format(drift.raRate)
+                            tdrift      = ET.SubElement(uconfig, 'Dec_drift')
+                            tdrift.text = '{0:+7.3f}'.format(drift.decRate)
+                            tjitter     = ET.SubElement(uconfig, 'Jitter')
+                            tjitter.text = '{0:6.3f}'.format(drift.jitter)
+                            tepar       = ET.SubElement(uconfig, 'Eng_PA_rate')
+                            tepar.text  = '{0:+7.3f}'.format(drift.engpaRate)
+                            if drift.toLimit is not None:
+                                tlim      = ET.SubElement(uconfig, 'Rot_limit')
+                                tlim.text = '{0:.1f}'.format(drift.toLimit)
+
                     except Exception, err:
                         g.clog.warn(err)
                         if not tkMessageBox.askokcancel(
@@ -1278,43 +1428,97 @@ class Start(drvs.ActButton):
                         g.clog.warn('Start operation cancelled')
                         return False
 
-            # Change the filter if necessary. Try to connect to the
-            # wheel. Raises an Exception if no wheel available
-            if not g.wheel.connected:
-                g.wheel.connect()
+            # The filter change and the reads of the slide and the
+            # Lakeshore are independent of each other so they are run at
+            # the same time by the worker pool. Rather than wait for them,
+            # which would freeze the GUI during a filter change, the rest
+            # of the start is chained on with _whenDone: the application
+            # is posted once all three have finished and the filter is in
+            # place (_hardwareDone), and the run is started once the
+            # servers have accepted it (_postDone).
+            desiredPosition = g.rpars.filter.getIndex() + 1
+            pool = drvs.workers()
+            self.pending = {
+                'root'   : root,
+                'filter' : desiredPosition,
+                'tstart' : time.time(),
+                'ftask'  : pool.submit('filter change', _changeFilter,
+                                       desiredPosition),
+                'stask'  : pool.submit('slide read',
+                                       g.fpslide.slide.return_position),
+                'ltask'  : pool.submit('temperature read', _readTemps),
+            }
+
+            # the application has been made, so no changes until the run
+            # has started or the start has failed
+            self.disable()
+            g.observe.load.disable()
+            g.ipars.freeze()
+            g.rpars.freeze()
+            self._whenDone((self.pending['ftask'], self.pending['stask'],
+                            self.pending['ltask']), self._hardwareDone)
+            return True
+
+        except Exception, err:
+            g.clog.warn('Failed to start run')
+            g.clog.warn(str(err))
+            return False
 
-            if not g.wheel.initialised:
-                g.wheel.init()
+    def _whenDone(self, tasks, callback):
+        """
+        Calls callback() once all the drvs.Tasks in 'tasks' have finished,
+        checking every POLL millisecs so that the GUI carries on meanwhile.
+        """
+        if all(task.done() for task in tasks):
+            callback()
+        else:
+            self.after(self.POLL, self._whenDone, tasks, callback)
 
-            currentPosition = g.wheel.getPos()
-            desiredPosition = g.rpars.filter.getIndex() + 1
+    def _fail(self, message, err=None):
+        """
+        Abandons a start which is under way
+        """
+        g.clog.warn(message)
+        if err is not None:
+            g.clog.warn(str(err))
+        self.pending = None
+        g.ipars.unfreeze()
+        g.rpars.unfreeze()
+        g.observe.load.enable()
+        self.enable()
+
+    def _hardwareDone(self):
+        """
+        Second stage of 'Start'. Adds the filter, slide position and
+        temperatures to the application and starts posting it.
+        """
+        pending = self.pending
+        uconfig = pending['root'].find('user')
+        desiredPosition = pending['filter']
+        current_filter  = g.cpars['active_filter_names'][desiredPosition-1]
+        try:
+            # the filter must be in place before the application is
+            # posted
+            try:
+                currentPosition = pending['ftask'].result()
+            except Exception, err:
+                g.clog.warn('Filter change failed')
+                raise
 
             if currentPosition != desiredPosition:
-                # We must change the filter before starting the run. This means
-                # that we also have to update the filters element of the 'user'
-                # part of the xml
                 g.clog.info(
-                    'Changing filter from "' + \
+                    'Changed filter from "' + \
                     g.cpars['active_filter_names'][currentPosition-1] + \
-                    '" to "' + \
-                    g.cpars['active_filter_names'][desiredPosition-1] + \
-                    '"')
-                g.wheel.goto(desiredPosition)
-                g.wheel.close()
-                current_filter = g.cpars['active_filter_names'][desiredPosition-1]
-
-                # update the XML
-                filtr      = uconfig.find('filters')
-                filtr.text = current_filter
-
+                    '" to "' + current_filter + '"')
             else:
-                # No action needed
                 g.clog.info('No filter change needed')
-                g.wheel.close()
-                current_filter = g.cpars['active_filter_names'][currentPosition-1]
+
+            # update the XML
+            filtr      = uconfig.find('filters')
+            filtr.text = current_filter
 
             # Set position of slide
-            pos_ms,pos_mm,pos_px = g.fpslide.slide.return_position()
+            pos_ms,pos_mm,pos_px = pending['stask'].result()
             fpslide = ET.SubElement(uconfig, 'SlidePos')
             fpslide.text = '{0:d}'.format(int(round(pos_px)))
 
@@ -1325,15 +1529,12 @@ class Start(drvs.ActButton):
             heater_percent = ET.SubElement(uconfig, 'heater_percent')
 
             try:
-                if g.lakeshore is None:
-                    g.lakeshore = lake.LakeFile()
-
-                tempa, tempb, heater = g.lakeshore.temps()
+                tempa, tempb, heater = pending['ltask'].result()
                 ccd_temp.text = '{0:5.1f}'.format(tempa)
                 finger_temp.text = '{0:5.1f}'.format(tempb)
                 heater_percent.text = '{0:4.1f}'.format(heater)
 
-            except:
+            except Exception, err:
                 if g.cpars['ccd_temperature_on']:
                     raise
                 else:
@@ -1343,69 +1544,94 @@ class Start(drvs.ActButton):
                     finger_temp.text = 'UNDEF'
                     heater_percent.text = 'UNDEF'
 
+            g.clog.debug(
+                'Start: filter {0:.0f} ms, slide {1:.0f} ms, temperatures '
+                '{2:.0f} ms'.format(1000.*pending['ftask'].elapsed,
+                                    1000.*pending['stask'].elapsed,
+                                    1000.*pending['ltask'].elapsed))
+
             # Post the XML it to the server
             g.clog.info('Posting application to the servers')
-
-            if drvs.postXML(root):
-                g.clog.info('Post successful; starting run')
-
-                if drvs.execCommand('GO'):
-                    # start the exposure timer
-                    g.info.timer.start()
-
-                    g.clog.info('Run started on target = ' + \
-                                    g.rpars.target.value())
-
-                    # configure buttons
-                    self.disable()
-                    g.observe.stop.enable()
-                    g.observe.load.disable()
-                    g.observe.unfreeze.enable()
-                    g.setup.resetSDSUhard.disable()
-                    g.setup.resetSDSUsoft.disable()
-                    g.setup.resetPCI.disable()
-                    g.setup.setupServers.disable()
-                    g.setup.powerOn.disable()
-                    g.setup.powerOff.disable()
-
-                    # freeze instrument and run parameters
-                    g.ipars.freeze()
-                    g.rpars.freeze()
-
-                    # update the run number
-                    try:
-                        run  = int(g.info.run.cget('text'))
-                        run += 1
-                        g.info.run.configure(text='{0:03d}'.format(run))
-                    except Exception, err:
-                        g.clog.warn('Failed to update run number')
-
-                    # take it that if we have successfully started a
-                    # run then we have also initialised the
-                    # servers. This is necessary to account for when
-                    # one starts usdriver with the servers already
-                    # initialised. Rather than re-initialising and
-                    # hence incurring another poweron, one can switch
-                    # to expert mode and start a run and hence make it
-                    # look as though the servers have been
-                    # initialised.
-                    g.cpars['servers_initialised'] = True
-
-                    # store filter name for use by InfoFrame
-                    g.start_filter = current_filter
-
-                    return True
-                else:
-                    g.clog.warn('Failed to start run')
-                    return False
+            pending['name']  = current_filter
+            pending['posts'] = drvs.startPost(pending['root'])
+            if pending['posts'] is None:
+                self._fail('Failed to post the application')
             else:
-                g.clog.warn('Failed to post the application')
-                return False
+                self._whenDone(pending['posts'], self._postDone)
 
         except Exception, err:
-            g.clog.warn('Failed to start run')
-            g.clog.warn(str(err))
-            return False
+            self._fail('Failed to start run', err)
+
+    def _postDone(self):
+        """
+        Last stage of 'Start'. Starts the run once the servers have
+        accepted the application.
+        """
+        pending = self.pending
+        try:
+            posted = drvs.postResult(pending['posts'])
+        except Exception, err:
+            self._fail('Failed to post the application', err)
+            return
+
+        if not posted:
+            self._fail('Failed to post the application')
+            return
+
+        g.clog.info('Post successful; starting run')
+        tgo = time.time()
+        if not drvs.execCommand('GO'):
+            self._fail('Failed to start run')
+            return
+
+        g.clog.debug('Start: GO {0:.0f} ms, all {1:.0f} ms'.format(
+            1000.*(time.time()-tgo), 1000.*(time.time()-pending['tstart'])))
+        self.pending = None
+
+        # start the exposure timer
+        g.info.timer.start()
+        g.poller.refresh()
+
+        g.clog.info('Run started on target = ' + \
+                        g.rpars.target.value())
+
+        # configure buttons
+        self.disable()
+        g.observe.stop.enable()
+        g.observe.load.disable()
+        g.observe.unfreeze.enable()
+        g.setup.resetSDSUhard.disable()
+        g.setup.resetSDSUsoft.disable()
+        g.setup.resetPCI.disable()
+        g.setup.setupServers.disable()
+        g.setup.powerOn.disable()
+        g.setup.powerOff.disable()
+
+        # freeze instrument and run parameters
+        g.ipars.freeze()
+        g.rpars.freeze()
+
+        # update the run number
+        try:
+            run  = int(g.info.run.cget('text'))
+            run += 1
+            g.info.run.configure(text='{0:03d}'.format(run))
+        except Exception, err:
+            g.clog.warn('Failed to update run number')
+
+        # take it that if we have successfully started a
+        # run then we have also initialised the
+        # servers. This is necessary to account for when
+        # one starts usdriver with the servers already
+        # initialised. Rather than re-initialising and
+        # hence incurring another poweron, one can switch
+        # to expert mode and start a run and hence make it
+        # look as though the servers have been
+        # initialised.
+        g.cpars['servers_initialised'] = True
+
+        # store filter name for use by InfoFrame
+        g.start_filter = pending['name']
 
 class Load(drvs.ActButton):
     """
@@ -1684,21 +1910,21 @@ class CountsFrame(tk.LabelFrame):
         status = True
 
         if self.mag.ok():
-            self.mag.config(bg=g.COL['main'])
+            drvs.setBackground(self.mag, g.COL['main'])
         else:
-            self.mag.config(bg=g.COL['warn'])
+            drvs.setBackground(self.mag, g.COL['warn'])
             status = False
 
         if self.airmass.ok():
-            self.airmass.config(bg=g.COL['main'])
+            drvs.setBackground(self.airmass, g.COL['main'])
         else:
-            self.airmass.config(bg=g.COL['warn'])
+            drvs.setBackground(self.airmass, g.COL['warn'])
             status = False
 
         if self.seeing.ok():
-            self.seeing.config(bg=g.COL['main'])
+            drvs.setBackground(self.seeing, g.COL['main'])
         else:
-            self.seeing.config(bg=g.COL['warn'])
+            drvs.setBackground(self.seeing, g.COL['warn'])
             status = False
 
         return status
@@ -1757,7 +1983,7 @@ class CountsFrame(tk.LabelFrame):
         self.ston.config(text='{0:.1f}'.format(ston))
         self.ston3.config(text='{0:.1f}'.format(ston3))
 
-    def counts(self, expTime, cycleTime, ap_scale=1.6, ndiv=5):
+    def counts(self, expTime, cycleTime, ap_scale=1.6, ndiv=5, psf=None):
         """
         Computes counts per pixel, total counts, sky counts
         etc given current magnitude, seeing etc. You should
@@ -1767,6 +1993,8 @@ class CountsFrame(tk.LabelFrame):
         expTime   : exposure time per frame (seconds)
         cycleTime : sampling, cadence (seconds)
         ap_scale  : aperture radius as multiple of seeing
+        ndiv      : sub-division of pixels for a non-gaussian psf
+        psf       : non-gaussian profile, see peakFraction
 
         Returns: (total, peak, peakSat, peakWarn, ston, ston3)
 
@@ -1797,7 +2025,7 @@ class CountsFrame(tk.LabelFrame):
                 'drivers.CountsFrame.counts: readout speed = '
                 + readSpeed + ' not recognised.')
 
-        if g.ipars.app == 'Windows':
+        if g.ipars.app.value() == 'Windows':
             xbin, ybin = g.ipars.wframe.xbin.value(), g.ipars.wframe.ybin.value()
         else:
             xbin, ybin = g.ipars.pframe.xbin.value(), g.ipars.pframe.ybin.value()
@@ -1835,24 +2063,10 @@ class CountsFrame(tk.LabelFrame):
         total   = 10.**((zero-mag-airmass*g.EXTINCTION[filtnam])/2.5)*expTime
 
         # compute fraction that fall in central pixel
-        # assuming target exactly at its centre. Do this
-        # by splitting each pixel of the central (potentially
-        # binned) pixel into ndiv * ndiv points at
-        # which the seeing profile is added. sigma is the
+        # assuming target exactly at its centre. sigma is the
         # RMS seeing in terms of pixels.
         sigma = seeing/g.EFAC/plateScale
-
-        sum = 0.
-        for iyp in range(ybin):
-            yoff = -ybin/2.+iyp
-            for ixp in range(xbin):
-                xoff = -xbin/2.+ixp
-                for iys in range(ndiv):
-                    y = (yoff + (iys+0.5)/ndiv)/sigma
-                    for ixs in range(ndiv):
-                        x = (xoff + (ixs+0.5)/ndiv)/sigma
-                        sum += math.exp(-(x*x+y*y)/2.)
-        peak = total*sum/(2.*math.pi*sigma**2*ndiv**2)
+        peak  = total*peakFraction(xbin, ybin, sigma, psf, ndiv)
 
 #        peak    = total*xbin*ybin*(plateScale/(seeing/EFAC))**2/(2.*math.pi)
 
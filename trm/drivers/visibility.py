@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+
+"""
+Visibility of targets from the telescope.
+
+Computes the altitude, azimuth, hour angle, airmass, distance from the
+Moon and whether the telescope is obstructed for any number of targets at
+any number of times at once, using numpy. The site comes from g.TINS and
+the sidereal time and the Moon from an ephemeris.Ephemeris, so the times
+must lie within its tables. The same Visibility serves the 'Current run &
+telescope status' panel, which looks at one target at the current time,
+and the planning of a night, which looks at many targets over the night.
+
+Target positions are J2000 RA and Dec in degrees, as returned by the TCS.
+They are precessed to the date of the tables once per target and cached.
+Nutation and aberration (< 1 arcmin) are ignored. Altitudes include
+a standard amount of refraction, as pyephem would compute by default.
+"""
+
+from __future__ import print_function
+import math
+from collections import namedtuple, OrderedDict
+import numpy as np
+
+import ephem
+
+import globals as g
+import ephemeris
+
+# Number of targets to remember
+MAXCACHE = 64
+
+class Sky(namedtuple('Sky', 'alt az ha airmass mdist obstructed')):
+    """
+    Visibility of one or more targets at one or more times. Attributes::
+
+      alt        : altitude, degrees
+      az         : azimuth, degrees East of North
+      ha         : hour angle, hours, -12 to +12
+      airmass    : airmass, 1/sin(alt)
+      mdist      : distance from the Moon, degrees
+      obstructed : True if the site's obstruction (g.TINS 'mast') is in the
+                   way
+    """
+    __slots__ = ()
+
+def precess(ra, dec, jd):
+    """
+    Precesses J2000 coordinates to Julian date 'jd' (IAU 1976). ra and dec
+    in radians; returns (ra, dec) in radians.
+    """
+    t = (jd - 2451545.0)/36525.
+    zeta  = math.radians((2306.2181*t + 0.30188*t**2 + 0.017998*t**3)/3600.)
+    z     = math.radians((2306.2181*t + 1.09468*t**2 + 0.018203*t**3)/3600.)
+    theta = math.radians((2004.3109*t - 0.42665*t**2 - 0.041833*t**3)/3600.)
+
+    cdec = np.cos(dec)
+    a = cdec*np.sin(ra+zeta)
+    b = math.cos(theta)*cdec*np.cos(ra+zeta) - math.sin(theta)*np.sin(dec)
+    c = math.sin(theta)*cdec*np.cos(ra+zeta) + math.cos(theta)*np.sin(dec)
+    return (np.arctan2(a, b) + z) % (2.*math.pi), np.arcsin(c)
+
+def refraction(alt):
+    """
+    Returns the refraction (degrees) at apparent altitude alt (degrees) for
+    a pressure of 1010 mbar and a temperature of 15C. Held at its value at
+    the horizon below the horizon.
+    """
+    alt = np.maximum(alt, -0.5)
+    return 1.02/np.tan(np.radians(alt + 10.3/(alt + 5.11)))/60.
+
+def obstructed(alt, az, mast):
+    """
+    Tests whether positions lie behind a triangular obstruction which rises
+    from altitude 'base' at azimuths 'left' and 'right' to 'top' at
+    azimuth 'peak'. Azimuths are first moved 'margin' degrees closer to
+    the peak to give a bit of warning.
+
+    alt, az : positions, degrees
+    mast    : (left, peak, right, base, top, margin), degrees
+    """
+    left, peak, right, base, top, margin = mast
+    az = np.where(az > peak, np.maximum(peak, az-margin),
+                  np.minimum(peak, az+margin))
+    limit = np.where(az < peak,
+                     top - (peak-az)/(peak-left)*(top-base),
+                     top - (az-peak)/(right-peak)*(top-base))
+    return (az > left) & (az < right) & (alt < limit)
+
+class Visibility(object):
+    """
+    Computes Sky for targets from the site of telescope/instrument
+    'telins' (a key of g.TINS, by default the configuration parameter
+    'telins_name') using the sidereal time and Moon from Ephemeris 'eph'.
+    """
+
+    def __init__(self, eph, telins=None):
+        if telins is None:
+            telins = g.cpars['telins_name']
+        tins      = g.TINS[telins]
+        self.eph  = eph
+        self.lat  = float(ephem.degrees(tins['latitude']))
+        self.mast = tins.get('mast')
+
+        # Julian date to precess to, the middle of the tables
+        self._jd = ephem.julian_date(
+            ephemeris.toEphem((eph.start+eph.end)/2.))
+        self._targets = OrderedDict()
+
+        # grid of times, LST and Moon of the tables
+        self.times = np.arange(eph.start, eph.end+eph.step/2., eph.step)
+        self._lst  = np.array([eph.lst(t) for t in self.times])
+        moon = np.array([eph.moon(t)[:2] for t in self.times])
+        self._mra, self._mdec = moon[:,0], moon[:,1]
+
+    def target(self, ra, dec):
+        """
+        Returns the cached entry for one target, a dictionary with the
+        precessed 'ra' and 'dec' (radians), and 'track', the Sky on the
+        tables' time grid once it has been asked for.
+        """
+        key = (round(ra, 4), round(dec, 4))
+        entry = self._targets.pop(key, None)
+        if entry is None:
+            pra, pdec = precess(math.radians(ra), math.radians(dec), self._jd)
+            entry = {'ra' : float(pra), 'dec' : float(pdec), 'track' : None}
+            if len(self._targets) >= MAXCACHE:
+                self._targets.popitem(last=False)
+        self._targets[key] = entry
+        return entry
+
+    def compute(self, ra, dec, lst, mra, mdec):
+        """
+        Computes Sky from apparent positions. All arguments are arrays of
+        radians which are broadcast against each other.
+
+        ra, dec   : target
+        lst       : local sidereal time
+        mra, mdec : Moon
+        """
+        ha = lst - ra
+        sdec, cdec = np.sin(dec), np.cos(dec)
+        slat, clat = math.sin(self.lat), math.cos(self.lat)
+        salt = sdec*slat + cdec*clat*np.cos(ha)
+        alt  = np.degrees(np.arcsin(salt))
+        az   = np.degrees(np.arctan2(-cdec*np.sin(ha),
+                                     sdec*clat - cdec*slat*np.cos(ha))) % 360.
+        alt += refraction(alt)
+
+        ha = (np.degrees(ha)/15. + 12.) % 24. - 12.
+
+        cmd = np.sin(mdec)*sdec + np.cos(mdec)*cdec*np.cos(mra-ra)
+        mdist = np.degrees(np.arccos(np.clip(cmd, -1., 1.)))
+
+        with np.errstate(divide='ignore'):
+            airmass = 1./np.sin(np.radians(alt))
+
+        if self.mast is None:
+            flag = np.zeros(np.shape(alt), dtype=bool)
+        else:
+            flag = obstructed(alt, az, self.mast)
+
+        return Sky(alt, az, ha, airmass, mdist, flag)
+
+    def at(self, ra, dec, utc):
+        """
+        Returns Sky for one target at one time, as floats. ra and dec
+        are J2000, degrees; utc a UNIX time.
+        """
+        entry = self.target(ra, dec)
+        mra, mdec, malt, phase = self.eph.moon(utc)
+        sky = self.compute(entry['ra'], entry['dec'], self.eph.lst(utc),
+                           mra, mdec)
+        return Sky(*[x.item() for x in sky])
+
+    def track(self, ra, dec):
+        """
+        Returns Sky for one target at all the times of the tables (see
+        'times'). The result is cached.
+        """
+        entry = self.target(ra, dec)
+        if entry['track'] is None:
+            entry['track'] = self.compute(entry['ra'], entry['dec'],
+                                          self._lst, self._mra, self._mdec)
+        return entry['track']
+
+    def grid(self, ras, decs, times=None):
+        """
+        Returns Sky for many targets at many times as 2D arrays with one row
+        per target. Used for planning.
+
+        ras, decs : sequences of J2000 RA and Dec, degrees
+        times     : UNIX times, within the tables. Defaults to 'times'.
+        """
+        entries = [self.target(ra, dec) for ra, dec in zip(ras, decs)]
+        ra  = np.array([entry['ra'] for entry in entries])[:,np.newaxis]
+        dec = np.array([entry['dec'] for entry in entries])[:,np.newaxis]
+        if times is None:
+            lst, mra, mdec = self._lst, self._mra, self._mdec
+        else:
+            times = np.asarray(times, dtype=float)
+            lst  = np.interp(times, self.times, np.unwrap(self._lst))
+            mra  = np.interp(times, self.times, np.unwrap(self._mra))
+            mdec = np.interp(times, self.times, self._mdec)
+        return self.compute(ra, dec, lst, mra, mdec)